@@ -20,10 +20,12 @@ if not apps.ready:
 from backend.ahs_core.consumers.channelsmultiplexer import AsyncJsonWebsocketDemultiplexer
 from backend.ahs_core.consumers.terminal_dispatcher import AsyncWebsocketTerminal
 from backend.ahs_core.consumers.command_dispatcher import AHSCommandConsumer
+from backend.ahs_core.lifespan import lifespan_application
 
 # Configure protocol routing
 application = ProtocolTypeRouter({
     'http': django_asgi_app,
+    'lifespan': lifespan_application,
     'websocket': AllowedHostsOriginValidator(
         AuthMiddlewareStack(
             URLRouter([
@@ -0,0 +1,139 @@
+"""
+Store of the short-lived state of WebAuthn ceremonies, keyed by the `random` handed
+to the client together with the registration or authentication options.
+
+Values are compact CBOR arrays ``[challenge, username, user_id]``. :meth:`take`
+reads and deletes a challenge in one step, so each challenge is consumed at most
+once, even by concurrent requests. With the Redis cache (django-redis) that is one
+GETDEL round trip, which needs Redis 6.2 or newer. Keys are built by the cache's
+`make_key`, so they carry its `KEY_PREFIX` and version. Other caches fall back to a
+process-local store, which only works if a ceremony's requests hit the same worker.
+
+The async methods run the blocking Redis calls in a thread of their own
+(``thread_sensitive=False``), not on the worker's single thread-sensitive executor.
+
+Configured by `AHS_WEBAUTHN_CHALLENGE_STORE`.
+"""
+import logging
+import threading
+import time
+from dataclasses import dataclass
+
+import cbor2
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'ahs:webauthn:'
+
+
+@dataclass(frozen=True, slots=True)
+class Challenge:
+    challenge: bytes
+    username: str | None = None
+    user_id: str | None = None
+
+    def dumps(self) -> bytes:
+        return cbor2.dumps([self.challenge, self.username, self.user_id])
+
+    @classmethod
+    def loads(cls, data: bytes) -> "Challenge":
+        return cls(*cbor2.loads(data))
+
+
+class RedisChallengeBackend:
+    def __init__(self, cache_alias: str = 'default'):
+        self.cache = caches[cache_alias]
+        self.client = self.cache.client.get_client(write=True)
+
+    def set(self, key: str, value: bytes, timeout: int):
+        self.client.set(self.cache.make_key(key), value, ex=timeout)
+
+    def take(self, key: str) -> bytes | None:
+        return self.client.getdel(self.cache.make_key(key))
+
+
+class LocalChallengeBackend:
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._values: dict[str, tuple[float, bytes]] = {}
+        self._lock = threading.Lock()
+
+    def set(self, key: str, value: bytes, timeout: int):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._values) >= self.maxsize:
+                self._values = {k: v for k, v in self._values.items() if v[0] > now}
+                if len(self._values) >= self.maxsize:
+                    del self._values[next(iter(self._values))]
+            self._values[key] = (now + timeout, value)
+
+    def take(self, key: str) -> bytes | None:
+        with self._lock:
+            entry = self._values.pop(key, None)
+        if entry is None or entry[0] <= time.monotonic():
+            return None
+        return entry[1]
+
+
+def get_backend(backend: str = 'redis', cache_alias: str = 'default'):
+    if backend == 'local':
+        return LocalChallengeBackend()
+    if backend != 'redis':
+        raise ValueError(f"Unsupported WebAuthn challenge store backend '{backend}'")
+    try:
+        return RedisChallengeBackend(cache_alias)
+    except AttributeError:
+        logger.warning(f"Cache '{cache_alias}' is not a django-redis cache, WebAuthn challenges are kept per process")
+        return LocalChallengeBackend()
+
+
+class ChallengeStore:
+    def __init__(self, backend: str = 'redis', cache_alias: str = 'default', timeout: int = 120):
+        self.backend_name = backend
+        self.cache_alias = cache_alias
+        self.timeout = timeout
+        self._backend = None
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = get_backend(self.backend_name, self.cache_alias)
+        return self._backend
+
+    def set(self, random: str, challenge: Challenge, timeout: int = None):
+        self.backend.set(KEY_PREFIX + random, challenge.dumps(), timeout or self.timeout)
+
+    def take(self, random: str) -> Challenge | None:
+        """Return and delete the challenge stored for `random`, None if there is none (anymore)."""
+        if not random:
+            return None
+        value = self.backend.take(KEY_PREFIX + random)
+        if value is None:
+            return None
+        try:
+            return Challenge.loads(value)
+        except (cbor2.CBORDecodeError, TypeError) as exc:
+            logger.warning(f"Discarding malformed WebAuthn challenge: {exc!r}")
+            return None
+
+    async def aset(self, random: str, challenge: Challenge, timeout: int = None):
+        if isinstance(self.backend, LocalChallengeBackend):
+            return self.set(random, challenge, timeout)
+        await sync_to_async(self.set, thread_sensitive=False)(random, challenge, timeout)
+
+    async def atake(self, random: str) -> Challenge | None:
+        if isinstance(self.backend, LocalChallengeBackend):
+            return self.take(random)
+        return await sync_to_async(self.take, thread_sensitive=False)(random)
+
+
+_config = getattr(settings, 'AHS_WEBAUTHN_CHALLENGE_STORE', {})
+
+challenges = ChallengeStore(
+    backend=_config.get('backend', 'redis'),
+    cache_alias=_config.get('cache_alias', 'default'),
+    timeout=_config.get('timeout', 120),
+)
@@ -16,7 +16,7 @@ from django.contrib.sessions.exceptions import SessionInterrupted
 from django.http import HttpRequest
 from django.utils.cache import patch_vary_headers
 from django.utils.deprecation import MiddlewareMixin
-from django.utils.functional import SimpleLazyObject
+from django.utils.functional import SimpleLazyObject, empty
 from django.utils.http import http_date
 
 from backend.ahs_core.utils import get_ahs_session_store
@@ -30,19 +30,67 @@ logger = logging.getLogger(__name__)
 User = get_user_model()
 SessionStore = get_ahs_session_store()
 
+# Route classes of the AHS middlewares. Static and health routes get no session, user,
+# token or messages at all, API routes get no message storage.
+ROUTE_STATIC = 'static'
+ROUTE_HEALTH = 'health'
+ROUTE_API = 'api'
+ROUTE_HTML = 'html'
+
+ROUTE_CLASSES = getattr(settings, 'AHS_MIDDLEWARE_ROUTE_CLASSES', {
+    ROUTE_STATIC: (settings.STATIC_URL, settings.MEDIA_URL, '/favicon.ico'),
+    ROUTE_HEALTH: ('/health',),
+    ROUTE_API: ('/api/',),
+})
+# Per route class: the prefixes as paths ('/health') and as directories ('/health/').
+_route_prefixes = tuple(
+    (
+        route_class,
+        frozenset('/' + prefix.strip('/') for prefix in prefixes if prefix),
+        tuple(('/' + prefix.strip('/') + '/').replace('//', '/') for prefix in prefixes if prefix),
+    )
+    for route_class, prefixes in ROUTE_CLASSES.items()
+)
+PASSTHROUGH_ROUTES = frozenset((ROUTE_STATIC, ROUTE_HEALTH))
+
+
+def get_route_class(path: str) -> str:
+    """
+    Return the route class of the first prefix matching `path`, `ROUTE_HTML` otherwise.
+    A prefix matches itself and the paths below it, '/health' matches '/health' and
+    '/health/db' but not '/healthcheck'.
+    """
+    for route_class, paths, directories in _route_prefixes:
+        if path in paths or path.startswith(directories):
+            return route_class
+    return ROUTE_HTML
+
+
+def is_evaluated(obj) -> bool:
+    """False for a lazy object which was never accessed."""
+    return not isinstance(obj, SimpleLazyObject) or obj._wrapped is not empty  # noqa
+
+
+async def update_messages(request: HttpRequest, response):
+    """Store the messages of `request`, unless its message storage was never used."""
+    messages = getattr(request, "_messages", None)
+    if messages is None or not is_evaluated(messages):
+        return
+    unstored_messages = await sync_to_async(messages.update)(response)
+    if unstored_messages and settings.DEBUG:
+        raise ValueError("Not all temporary messages could be stored.")
+
 
 def get_cached_user(request: HttpRequest) -> AnonymousUser | AbstractBaseUser:
-    _cached_user = None
     if not hasattr(request, "_cached_user"):
         request._cached_user = get_user_from_token_request(request)
-    return _cached_user  # noqa
+    return request._cached_user  # noqa
 
 
 async def get_acached_user(request: HttpRequest) -> AnonymousUser | AbstractBaseUser:
-    _acached_user = None
     if not hasattr(request, "_acached_user"):
         request._acached_user = await aget_user_from_token_request(request)
-    return _acached_user  # noqa
+    return request._acached_user  # noqa
 
 
 
@@ -70,7 +118,7 @@ class SessionAuthMsgsMiddleware(MiddlewareMixin):
     async def process_request(self, request: HttpRequest) -> None:
         # Session Middleware
         session_key = request.COOKIES.get(self.cookie_name)
-        request.session = self.SessionStore(session_key)
+        request.session = SimpleLazyObject(partial(self.SessionStore, session_key))
 
         # Auth Middleware
         async def resolve_user():
@@ -80,16 +128,14 @@ class SessionAuthMsgsMiddleware(MiddlewareMixin):
         request.auser = partial(auser, request)
 
         # Messages Middleware
-        request._messages = await sync_to_async(default_storage)(request)
+        request._messages = SimpleLazyObject(partial(default_storage, request))
 
     async def process_response(self, request: HttpRequest, response):
         # Messages
-        if hasattr(request, "_messages"):
-            unstored_messages = await sync_to_async(request._messages.update)(response)  # noqa
-            if unstored_messages and settings.DEBUG:
-                raise ValueError("Not all temporary messages could be stored.")
+        await update_messages(request, response)
         # Session
-
+        if not is_evaluated(getattr(request, "session", None)):
+            return response
         try:
             accessed = request.session.accessed
             modified = request.session.modified
@@ -143,43 +189,64 @@ class SessionAuthMsgsMiddleware(MiddlewareMixin):
 
 
 class AHSMiddleware(SessionAuthMsgsMiddleware):
+    """
+    Session, token authentication and messages for everything outside of /admin.
+
+    Requests are classified by :func:`get_route_class`: static and health routes pass
+    straight through with an anonymous user, API routes get no message storage.
+    Session and message storage are lazy and only saved if the view used them.
+    """
     async_capable = True
     sync_capable = False
 
-
     def __init__(self, get_response):
         MiddlewareMixin.__init__(self, get_response)
         engine = import_module(settings.SESSION_ENGINE_AHS)
-        self.SessionStore = engine.AHSToken
+        self.SessionStore = engine.SessionStore
         self.cookie_name = settings.SESSION_COOKIE_NAME_AHS
         self.cookie_path = settings.SESSION_COOKIE_PATH_AHS
+        self.cookie_domain = getattr(settings, 'SESSION_COOKIE_DOMAIN_AHS', settings.SESSION_COOKIE_DOMAIN)
 
     async def __call__(self, request: HttpRequest):
         if request.path.startswith('/admin'):
             return await self.get_response(request)
+        request.route_class = get_route_class(request.path)
+        if request.route_class in PASSTHROUGH_ROUTES:
+            self.process_passthrough_request(request)
+            return await self.get_response(request)
         await self.process_request(request)
         response = await self.get_response(request)
         response = await self.process_response(request, response)
         return response
 
+    @staticmethod
+    def process_passthrough_request(request: HttpRequest) -> None:
+        """Static and health routes skip authentication, views still find an anonymous `user`."""
+        user = AnonymousUser()
+
+        async def anonymous_user():
+            return user
+
+        request.user = user
+        request.auser = anonymous_user
+
     async def process_request(self, request: HttpRequest) -> None:
         session_key = request.COOKIES.get(self.cookie_name)
-        request.session = self.SessionStore(session_key)
+        request.session = SimpleLazyObject(partial(self.SessionStore, session_key))
         token_str = request.headers.get('X-AHS-Token', None)
         request.user = SimpleLazyObject(lambda: get_cached_user(request))  # noqa
-        request.auser = partial(auser, request)
+        request.auser = partial(get_acached_user, request)
         request.token = await AHSToken.afrom_request(token_str)
-        request._messages = await sync_to_async(default_storage)(request)
+        if getattr(request, 'route_class', ROUTE_HTML) != ROUTE_API:
+            request._messages = SimpleLazyObject(partial(default_storage, request))
         return None
 
     async def process_response(self, request, response):
         # Messages
-        if hasattr(request, "_messages"):
-            unstored_messages = await sync_to_async(request._messages.update)(response)  # noqa
-            if unstored_messages and settings.DEBUG:
-                raise ValueError("Not all temporary messages could be stored.")
+        await update_messages(request, response)
         # Session
-
+        if not is_evaluated(getattr(request, "session", None)):
+            return response
         try:
             accessed = request.session.accessed
             modified = request.session.modified
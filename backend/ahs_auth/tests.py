@@ -1,7 +1,21 @@
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.sessions.backends.cache import SessionStore as CacheSessionStore
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
 from django.urls import reverse
 from rest_framework import status
 from rest_framework.test import APITestCase
 
+from backend.ahs_auth.challenges import Challenge, ChallengeStore
+from backend.ahs_auth.middleware import (
+    AHSMiddleware, ROUTE_API, ROUTE_HEALTH, ROUTE_HTML, ROUTE_STATIC, get_route_class,
+)
+from backend.ahs_auth.token import AHSToken, b64url_encode, verified_tokens
+
 class WebAuthnAPITests(APITestCase):
     def test_register_options_returns_challenge(self):
         url = reverse('auth:webauthn_reg')
@@ -56,3 +70,141 @@ class WebAuthnAPITests(APITestCase):
 
     def test_authentication_verify_valid_user(self):
         ...
+
+
+class AHSTokenTests(SimpleTestCase):
+    def setUp(self):
+        verified_tokens.clear()
+
+    def test_roundtrip(self):
+        token = str(AHSToken.create(SimpleNamespace(pk=7), session_key='abc'))
+        verified = AHSToken.verify(token)
+        self.assertEqual((verified.user_id, verified.session_key), (7, 'abc'))
+        self.assertIs(AHSToken.verify(token), verified)
+
+    def test_tampered_payload(self):
+        header, _, signature = str(AHSToken.create(SimpleNamespace(pk=7))).split('.')
+        payload = b64url_encode(b'{"user_id":1}')
+        self.assertIsNone(AHSToken.verify(f'{header}.{payload}.{signature}'))
+
+    def test_concurrent_verification_with_evictions(self):
+        tokens = [str(AHSToken.create(SimpleNamespace(pk=pk))) for pk in range(8)]
+        maxsize, verified_tokens.maxsize = verified_tokens.maxsize, 2
+        try:
+            with ThreadPoolExecutor(8) as executor:
+                results = list(executor.map(lambda i: AHSToken.verify(tokens[i % len(tokens)]), range(2000)))
+        finally:
+            verified_tokens.maxsize = maxsize
+        self.assertEqual([token.user_id for token in results[:8]], list(range(8)))
+        self.assertLessEqual(len(verified_tokens), 2)
+
+    def test_expired(self):
+        self.assertIsNone(AHSToken.verify(str(AHSToken.create(SimpleNamespace(pk=7), lifetime=-1))))
+
+    def test_malformed(self):
+        for token in ('', 'a.b', 'e30.e30.e30', '!!.??.##'):
+            self.assertIsNone(AHSToken.verify(token))
+
+
+class ChallengeStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.store = ChallengeStore(backend='local')
+
+    def test_take_once(self):
+        self.store.set('random', Challenge(b'challenge', 'alice', 'id'))
+        self.assertEqual(self.store.take('random'), Challenge(b'challenge', 'alice', 'id'))
+        self.assertIsNone(self.store.take('random'))
+        self.assertIsNone(self.store.take(None))
+
+    def test_expired(self):
+        self.store.set('random', Challenge(b'challenge'), timeout=-1)
+        self.assertIsNone(self.store.take('random'))
+
+
+class FakeRedisClient:
+    def __init__(self):
+        self.values = {}
+
+    def set(self, key, value, ex=None):
+        self.values[key] = value
+
+    def getdel(self, key):
+        return self.values.pop(key, None)
+
+
+@override_settings(CACHES={'challenges': {
+    'BACKEND': 'django_redis.cache.RedisCache',
+    'LOCATION': 'redis://localhost:6379/0',
+    'KEY_PREFIX': 'site',
+}})
+class RedisChallengeBackendTests(SimpleTestCase):
+    async def test_keys_use_cache_prefix_and_version(self):
+        store = ChallengeStore(backend='redis', cache_alias='challenges')
+        store.backend.client = FakeRedisClient()
+        await store.aset('random', Challenge(b'challenge'))
+        self.assertEqual(list(store.backend.client.values), ['site:1:ahs:webauthn:random'])
+        self.assertEqual(await store.atake('random'), Challenge(b'challenge'))
+        self.assertIsNone(await store.atake('random'))
+
+
+class RouteClassTests(SimpleTestCase):
+    def test_prefixes_match_whole_segments(self):
+        self.assertEqual(get_route_class('/health'), ROUTE_HEALTH)
+        self.assertEqual(get_route_class('/health/db'), ROUTE_HEALTH)
+        self.assertEqual(get_route_class('/healthcheck'), ROUTE_HTML)
+        self.assertEqual(get_route_class('/api'), ROUTE_API)
+        self.assertEqual(get_route_class('/api/users/'), ROUTE_API)
+        self.assertEqual(get_route_class('/apis'), ROUTE_HTML)
+        self.assertEqual(get_route_class('/favicon.ico'), ROUTE_STATIC)
+        self.assertEqual(get_route_class('/favicon.icon'), ROUTE_HTML)
+
+
+class RecordingSessionStore(CacheSessionStore):
+    saved = []
+
+    async def asave(self, must_create=False):
+        self.saved.append(self.session_key)
+        await super().asave(must_create)
+
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    MESSAGE_STORAGE='django.contrib.messages.storage.cookie.CookieStorage',
+)
+class AHSMiddlewareTests(SimpleTestCase):
+    def setUp(self):
+        RecordingSessionStore.saved = []
+
+    async def get_response(self, path, view):
+        middleware = AHSMiddleware(view)
+        middleware.SessionStore = RecordingSessionStore
+        return await middleware(RequestFactory().get(path))
+
+    async def test_passthrough_routes_get_anonymous_user(self):
+        async def view(request):
+            self.assertFalse(hasattr(request, 'session'))
+            self.assertFalse(request.user.is_authenticated)
+            self.assertIs(await request.auser(), request.user)
+            return HttpResponse()
+
+        await self.get_response('/health', view)
+
+    async def test_untouched_session_and_messages_are_not_saved(self):
+        async def view(request):
+            return HttpResponse()
+
+        response = await self.get_response('/dashboard/', view)
+        self.assertEqual(RecordingSessionStore.saved, [])
+        self.assertNotIn('messages', response.cookies)
+        self.assertNotIn(settings.SESSION_COOKIE_NAME_AHS, response.cookies)
+
+    async def test_touched_session_and_messages_are_saved(self):
+        async def view(request):
+            request.session['visited'] = True
+            messages.info(request, 'saved')
+            return HttpResponse()
+
+        response = await self.get_response('/dashboard/', view)
+        self.assertTrue(RecordingSessionStore.saved)
+        self.assertIn('messages', response.cookies)
+        self.assertIn(settings.SESSION_COOKIE_NAME_AHS, response.cookies)
@@ -1,61 +1,214 @@
+"""
+Stateless, signed AHS tokens.
+
+A token is ``base64url(header).base64url(payload).base64url(signature)``, header and
+payload are compact JSON objects. The signature covers ``header.payload`` and is made
+with an HMAC-SHA256 subkey of `SECRET_KEY` (``HS256``) or with the ECC root key
+(``ES512``), see `AHS_TOKEN_ALGORITHM`. Tokens carry everything needed to
+authenticate a request, verifying them needs neither the database nor Redis.
+
+Verified tokens are kept in a process-local LRU keyed by the raw token string, so a
+client sending the same token again costs a dict lookup and an expiry check.
+"""
 import base64
-import dataclasses
+import binascii
+import hashlib
+import hmac
+import json
 import logging
-from dataclasses import field
+import secrets
+import threading
+import time
+from collections import OrderedDict
 from enum import Enum
+from functools import cached_property, partial
 
-from django.contrib.auth import get_user_model
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.hashes import SHA256
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.conf import settings
 from django.contrib.auth.base_user import AbstractBaseUser
+from django.utils.encoding import force_bytes
+from typing_extensions import Dict, Optional
 
-from rest_framework.utils.encoders import JSONEncoder
-from typing_extensions import NamedTuple, Dict, Union, Optional
+from backend.ahs_core.crypto_executor import run_crypto
 
-from backend.ahs_core.serializers import TokenHeaderSerializer
-
-json_encode = JSONEncoder().encode
-header_serializer = TokenHeaderSerializer
 logger = logging.getLogger(__name__)
-User = get_user_model()
+security_logger = logging.getLogger("django.security.SuspiciousSession")
+
+TOKEN_TYPE = 'AHS'
+
+
+def b64url_encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def b64url_decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def json_encode(data: dict) -> bytes:
+    return json.dumps(data, separators=(',', ':'), sort_keys=True).encode()
+
+
+class TokenError(ValueError):
+    pass
+
 
 class TokenType(Enum):
     DEFAULT = 0
     AUTH = 1
 
 
+class HMACTokenSigner:
+    """HMAC-SHA256 with a subkey derived from `SECRET_KEY` (HKDF)."""
+    algorithm = 'HS256'
+    blocking = False
+
+    @cached_property
+    def key(self) -> bytes:
+        return HKDF(
+            algorithm=SHA256(),
+            length=32,
+            salt=None,
+            info=b"AHS token signing key",
+        ).derive(force_bytes(settings.SECRET_KEY))
+
+    def sign(self, message: bytes) -> bytes:
+        return hmac.new(self.key, message, hashlib.sha256).digest()
+
+    def verify(self, message: bytes, signature: bytes) -> bool:
+        return hmac.compare_digest(self.sign(message), signature)
+
+
+class ECCTokenSigner:
+    """ECDSA with the root key of :class:`backend.ahs_core.ecc.ECC`."""
+    algorithm = 'ES512'
+    blocking = True
+
+    def sign(self, message: bytes) -> bytes:
+        from backend.ahs_core.ecc import ECC
+        return ECC.root_private_key.sign(message, ECC.default_sign_algorithm)
+
+    def verify(self, message: bytes, signature: bytes) -> bool:
+        from backend.ahs_core.ecc import ECC
+        try:
+            ECC.root_public_key.verify(signature, message, ECC.default_sign_algorithm)
+        except InvalidSignature:
+            return False
+        return True
+
+
+SIGNERS = {signer.algorithm: signer for signer in (HMACTokenSigner(), ECCTokenSigner())}
+
+
+def get_signer():
+    algorithm = getattr(settings, 'AHS_TOKEN_ALGORITHM', 'HS256')
+    try:
+        return SIGNERS[algorithm]
+    except KeyError:
+        raise TokenError(f"Unsupported token algorithm '{algorithm}'")
+
+
 class TokenHeader:
-    __slots__ = ('errors', 'algo',)
-    serializer = TokenHeaderSerializer
+    __slots__ = ('algo', 'token_id', 'token_type', 'created', 'expires')
+
+    def __init__(self, algo: str, token_id: str, token_type: TokenType, created: int, expires: int):
+        self.algo = algo
+        self.token_id = token_id
+        self.token_type = token_type
+        self.created = created
+        self.expires = expires
+
+    def to_dict(self) -> Dict:
+        return {
+            'alg': self.algo,
+            'typ': TOKEN_TYPE,
+            'jti': self.token_id,
+            'tt': self.token_type.value,
+            'iat': self.created,
+            'exp': self.expires,
+        }
 
-    async def aencode(self):
-        return await self.serializer(self).adata
+    @classmethod
+    def from_dict(cls, data: Dict) -> "TokenHeader":
+        try:
+            typ = data['typ']
+            header = cls(data['alg'], data['jti'], TokenType(data['tt']), int(data['iat']), int(data['exp']))
+        except (KeyError, TypeError, ValueError) as exc:
+            raise TokenError(f"Invalid token header: {exc!r}")
+        if typ != TOKEN_TYPE:
+            raise TokenError(f"Invalid token type '{typ}'")
+        return header
 
     def __repr__(self):
-        return f"<TokenHeader created={self.created} expires={self.expires}>"
+        return f"<TokenHeader {self.algo} id={self.token_id} created={self.created} expires={self.expires}>"
+
+
+class VerifiedTokenCache:
+    """
+    Process-local LRU of verified tokens, keyed by the raw token string.
+
+    ES512 tokens are verified on the crypto pool's threads, hence the lock.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._tokens: "OrderedDict[str, AHSToken]" = OrderedDict()
+        self._lock = threading.Lock()
 
+    def __len__(self):
+        return len(self._tokens)
 
-class TokenPayload:
-    __slots__ = ('errors', 'payload', '_payload')
-    serializer = TokenHeaderSerializer
+    def get(self, token: str) -> Optional["AHSToken"]:
+        with self._lock:
+            inst = self._tokens.get(token)
+            if inst is None:
+                return None
+            if inst.is_expired():
+                del self._tokens[token]
+                return None
+            self._tokens.move_to_end(token)
+            return inst
 
-    async def aencode(self):
-        return await self.serializer(self).adata
+    def set(self, token: str, inst: "AHSToken"):
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._tokens[token] = inst
+            self._tokens.move_to_end(token)
+            while len(self._tokens) > self.maxsize:
+                self._tokens.popitem(last=False)
 
-class TokenSignature:
-    __slots__ = ('signature', '_signature', 'errors')
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
 
 
+verified_tokens = VerifiedTokenCache(getattr(settings, 'AHS_TOKEN_CACHE_SIZE', 4096))
 
 
 class AHSToken:
-    __slots__ = ('header', 'payload', 'signature', '_errors', '_token',
-                 '_header', '_payload', '_signature')
+    """
+    A signed token, the payload holds the claims (`user_id`, `sess_id`, ...).
+
+    Create tokens with :meth:`create`, parse and verify them with :meth:`verify`.
+    """
+    __slots__ = ('header', 'payload', 'signature', '_token')
+
+    def __init__(self, header: TokenHeader, payload: Dict, signature: bytes, token: str):
+        self.header = header
+        self.payload = payload
+        self.signature = signature
+        self._token = token
 
     @property
-    def user(self):
-        return self.payload.user
+    def user_id(self):
+        return self.payload.get('user_id')
 
-    async def auser(self):
-        return self.payload.auser
+    @property
+    def session_key(self):
+        return self.payload.get('sess_id')
 
     @property
     def id(self):
@@ -69,74 +222,95 @@ class AHSToken:
     def expires(self):
         return self.header.expires
 
-    def is_valid(self) -> bool:
-        return len(self._errors) == 0
-
-    async def _encrypt_payload(self, payload):
-        """Encrypt the payload with a secret key"""
-        return
+    def is_expired(self, now: float = None) -> bool:
+        return (time.time() if now is None else now) >= self.header.expires
 
-    async def _decrypt_payload(self, payload):
-        """Decrypt the payload with a secret key"""
-        return payload
-
-    async def asign(self, ):
-        pass
+    @classmethod
+    def create(
+            cls,
+            user: AbstractBaseUser,
+            session_key: str = None,
+            lifetime: int = None,
+            token_type: TokenType = TokenType.AUTH,
+            **claims,
+    ) -> "AHSToken":
+        """Create and sign a token for `user`, valid for `lifetime` seconds."""
+        signer = get_signer()
+        if lifetime is None:
+            lifetime = getattr(settings, 'AHS_TOKEN_LIFETIME', 12 * 60 * 60)
+        created = int(time.time())
+        header = TokenHeader(signer.algorithm, secrets.token_urlsafe(16), token_type, created, created + lifetime)
+        payload = {**claims, 'user_id': user.pk}
+        if session_key:
+            payload['sess_id'] = session_key
+        signing_input = f"{b64url_encode(json_encode(header.to_dict()))}.{b64url_encode(json_encode(payload))}"
+        signature = signer.sign(signing_input.encode('ascii'))
+        return cls(header, payload, signature, f"{signing_input}.{b64url_encode(signature)}")
 
-    async def averify(self):
-        pass
+    @classmethod
+    async def acreate(cls, user: AbstractBaseUser, session_key: str = None, lifetime: int = None, **kwargs):
+        if get_signer().blocking:
+            return await run_crypto(partial(cls.create, user, session_key, lifetime, **kwargs))
+        return cls.create(user, session_key, lifetime, **kwargs)
 
     @classmethod
-    async def afrom_request(cls, token: str = None) -> Optional["AHSToken"]:
+    def from_string(cls, token: str) -> "AHSToken":
         """
-        Create an instance of AHSSessionToken from a token string.
-        """
-        errors = []
-        if not token:
-            return None
+        Parse and verify `token`, bypassing the verified-token cache.
 
+        Raises:
+            TokenError: If the token is malformed, not signed by us or expired.
+        """
         try:
             h, p, s = token.split('.')
-        except ValueError as e:
-            logging.getLogger("django.security.SuspiciousSession").warning(
-                'Possible token manipulation detected. ' + f'{e}')
-            return None
-
-
-        # Decode the token
+            header = json.loads(b64url_decode(h))
+            signature = b64url_decode(s)
+        except (ValueError, binascii.Error) as exc:
+            raise TokenError(f"Malformed token: {exc!r}")
+        header = TokenHeader.from_dict(header)
+        signer = get_signer()
+        if header.algo != signer.algorithm:
+            raise TokenError(f"Unexpected token algorithm '{header.algo}'")
+        if not signer.verify(f"{h}.{p}".encode('ascii'), signature):
+            raise TokenError("Invalid token signature")
         try:
-            signature = await TokenSignature.decode_and_validate(s, f"{h}.{p}")
-            header = await TokenHeader.decode(h)
-            payload = await TokenPayload.decode(p)
-        except Exception as e:
-            errors.append(f"Error during token instantiation, AHSSessionToken: {e}")
-            return None
-
-        errors = header.errors + payload.errors + signature.errors
+            payload = json.loads(b64url_decode(p))
+        except (ValueError, binascii.Error) as exc:
+            raise TokenError(f"Malformed token payload: {exc!r}")
+        if not isinstance(payload, dict):
+            raise TokenError("Malformed token payload")
+        inst = cls(header, payload, signature, token)
+        if inst.is_expired():
+            raise TokenError("Token expired")
+        return inst
 
-        if errors:
-            logging.getLogger("django.security.SuspiciousSession").warning(
-                'Possible token manipulation detected. ' + ' '.join(errors)
-            )
+    @classmethod
+    def verify(cls, token: str = None) -> Optional["AHSToken"]:
+        """Return the verified token, or None if `token` is missing or invalid."""
+        if not token:
             return None
-
-        # Create an instance of AHSSessionToken
-        inst = cls()
-        inst._token = token
-        inst.header = header
-        inst.payload = payload
-        inst.signature = signature
+        inst = verified_tokens.get(token)
+        if inst is not None:
+            return inst
+        try:
+            inst = cls.from_string(token)
+        except TokenError as exc:
+            security_logger.warning(f"Possible token manipulation detected. {exc}")
+            return None
+        verified_tokens.set(token, inst)
         return inst
 
+    @classmethod
+    async def afrom_request(cls, token: str = None) -> Optional["AHSToken"]:
+        """
+        Verify the token of a request's `X-AHS-Token` header.
+        """
+        if token and get_signer().blocking and verified_tokens.get(token) is None:
+            return await run_crypto(cls.verify, token)
+        return cls.verify(token)
+
     def __str__(self):
         return self._token
 
-    @classmethod
-    async def acreate(cls, user: AbstractBaseUser, token_id: str = None):
-        inst = cls()
-        inst.header = await TokenHeader.acreate()
-        inst.payload = await TokenPayload.acreate()
-        inst.signature = await TokenSignature.acreate()
-
-    async def to_string(self):
-        return f"{self.header}"
\ No newline at end of file
+    def __repr__(self):
+        return f"<AHSToken id={self.id} user_id={self.user_id} expires={self.expires}>"
@@ -5,7 +5,6 @@ import uuid
 from adrf.decorators import api_view
 
 from django.contrib.auth import get_user_model, alogin
-from django.core.cache import cache
 from django.db.models import QuerySet
 from rest_framework.response import Response
 from webauthn.helpers import parse_authentication_credential_json
@@ -29,6 +28,7 @@ from webauthn.authentication.generate_authentication_options import generate_aut
 from webauthn.authentication.verify_authentication_response import verify_authentication_response, \
     VerifiedAuthentication
 
+from backend.ahs_auth.challenges import Challenge, challenges
 from backend.ahs_auth.models import WebAuthnCredential, AuthMethod
 from backend.ahs_auth.webauthn import EXPECTED_RP_ID, EXPECTED_ORIGIN, SUPPORTED_ALGOS
 from backend.ahs_core.utils import aencode_b64
@@ -93,7 +93,7 @@ async def webauthn_register_view(request):
 
     json_options = options_to_json(options=options)
 
-    await cache.aset(f"{random}", f"{challenge}.|.{username}.|.{user_id}", 120)
+    await challenges.aset(random, Challenge(challenge.encode('utf-8'), username, user_id))
     return Response(
         {
             "message": "Generated registration options successfully.",
@@ -109,8 +109,7 @@ async def webauthn_verify_registration_view(request):
     data = request.data
     json_cred = data.get("credential")
     random = data.get("random", None)
-    cached_value = await cache.aget(random, None)
-    await cache.adelete(random)
+    cached_challenge = await challenges.atake(random)
 
     if not json_cred or not random:
         return Response(
@@ -118,18 +117,18 @@ async def webauthn_verify_registration_view(request):
             status=400,
         )
 
-    if not cached_value:
+    if cached_challenge is None:
         return Response(
             {"errors": "Registration timed out. Please try again."},
             status=400,
         )
 
-    challenge, username, user_id = cached_value.split('.|.')
+    username, user_id = cached_challenge.username, cached_challenge.user_id
 
     try:
         verified_registration: VerifiedRegistration = verify_registration_response(
             credential=json_cred,
-            expected_challenge=challenge.encode('utf-8'),
+            expected_challenge=cached_challenge.challenge,
             expected_rp_id=request.get_host(),
             expected_origin=EXPECTED_ORIGIN,
             supported_pub_key_algs=SUPPORTED_ALGOS,
@@ -199,7 +198,7 @@ async def webauthn_authentication_view(request):
         ],
     )
 
-    await cache.aset(f"{random}", f"{challenge}", 120)
+    await challenges.aset(random, Challenge(challenge.encode('utf-8'), username))
 
     json_options = options_to_json(options=options)
 
@@ -219,15 +218,27 @@ async def webauthn_verify_authentication_view(request):
     json_auth_cred = data.get("credential")
     random = data.get("random")
     username = data.get("username")
-    auth_cred = parse_authentication_credential_json(json_auth_cred)
+    cached_challenge = await challenges.atake(random)
 
-    cached_challenge = await cache.aget(random, None)
-    if not cached_challenge:
+    if not json_auth_cred or not username:
+        return Response(
+            {"errors": AUTHENTICATION_ERROR},
+            status=400
+        )
+
+    if cached_challenge is None:
         return Response(
             {"errors": "Authentication timed out. Please try again."},
             status=400
         )
-    await cache.adelete(random)
+
+    if cached_challenge.username != username:
+        return Response(
+            {"errors": AUTHENTICATION_ERROR},
+            status=400
+        )
+
+    auth_cred = parse_authentication_credential_json(json_auth_cred)
 
     user = await User.objects.aget(username=username)
 
@@ -244,7 +255,7 @@ async def webauthn_verify_authentication_view(request):
     try:
         verified_auth: VerifiedAuthentication = verify_authentication_response(
             credential=json_auth_cred,
-            expected_challenge=cached_challenge.encode('utf-8'),
+            expected_challenge=cached_challenge.challenge,
             expected_rp_id=EXPECTED_RP_ID,
             expected_origin=EXPECTED_ORIGIN,
             require_user_verification=True,
@@ -1,5 +1,4 @@
 import cbor2
-from asgiref.sync import sync_to_async
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import ec, rsa
 from django.conf import settings
@@ -7,6 +6,8 @@ from webauthn.helpers import decode_credential_public_key, decoded_public_key_to
 
 from webauthn.helpers.cose import COSEAlgorithmIdentifier
 
+from backend.ahs_core.crypto_executor import run_crypto
+
 
 RP_NAME = settings.SITE_NAME
 EXPECTED_RP_ID = settings.DOMAIN_NAME
@@ -70,7 +71,7 @@ def convert_publickey_pem_to_cbor(pubkey: bytes) -> bytes:
 
 
 async def aconvert_publickey_pem_to_cbor(pubkey: bytes) -> bytes:
-    return await sync_to_async(convert_publickey_pem_to_cbor)(pubkey)
+    return await run_crypto(convert_publickey_pem_to_cbor, pubkey)
 
 
 def convert_publickey_cbor_to_pem(pubkey: bytes) -> bytes:
@@ -103,4 +104,4 @@ def convert_publickey_cbor_to_pem(pubkey: bytes) -> bytes:
 
 
 async def aconvert_publickey_cbor_to_pem(pubkey: bytes) -> bytes:
-    return await sync_to_async(convert_publickey_cbor_to_pem)(pubkey)
+    return await run_crypto(convert_publickey_cbor_to_pem, pubkey)
@@ -28,6 +28,8 @@ from django.utils.crypto import constant_time_compare
 from django.utils.deprecation import RemovedInDjango61Warning
 from django.views.decorators.debug import sensitive_variables
 
+from backend.ahs_core.user_cache import user_cache
+
 
 User = get_user_model()
 logger = logging.getLogger(__name__)
@@ -258,8 +260,12 @@ def get_user_from_token_request(request) -> AbstractBaseUser | AnonymousUser:
     session_key = auth_payload.get("sess_id")
 
     try:
-        # Try to get the user from the database
-        user = User.objects.get(pk=user_id)
+        # Try the process-local user cache before the database
+        user = user_cache.get(user_id)
+        if user is None:
+            version = user_cache.version
+            user = User.objects.get(pk=user_id)
+            user_cache.set(user, version)
 
         # Verify if user is active
         if not user.is_active:
@@ -308,8 +314,12 @@ async def aget_user_from_token_request(request) -> AbstractBaseUser | AnonymousU
     session_key = auth_payload.get("sess_id")
 
     try:
-        # Try to get the user from the database asynchronously
-        user = await User.objects.aget(pk=user_id)
+        # Try the process-local user cache before the database
+        user = user_cache.get(user_id)
+        if user is None:
+            version = user_cache.version
+            user = await User.objects.aget(pk=user_id)
+            user_cache.set(user, version)
 
         # Verify if user is active
         if not user.is_active:
@@ -2,14 +2,61 @@
 ## Author: hishnash
 ## RawFile: https://raw.githubusercontent.com/hishnash/channelsmultiplexer/refs/heads/master/channelsmultiplexer/demultiplexer.py
 
+import logging
+import struct
 from functools import partial
+from typing import Iterator, Tuple
 
 from asgiref.compatibility import guarantee_single_callable
 from channels.consumer import get_handler_name
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
 
 import asyncio
 
+from backend.ahs_core.consumers.stream_queue import StreamQueue, StreamQueueOverflow
+
+logger = logging.getLogger(__name__)
+
+# Subprotocol a client requests to switch the connection to binary envelopes.
+BINARY_SUBPROTOCOL = 'ahs.bin.v1'
+
+# Binary envelope header: stream-id byte + big endian payload length.
+FRAME_HEADER = struct.Struct('!BI')
+
+
+def pack_frame(stream_id: int, payload: bytes) -> bytes:
+    """
+    Wrap ``payload`` into a binary envelope addressed to ``stream_id``.
+
+    The envelope consists of a single stream-id byte, a 4 byte big endian payload
+    length and the raw payload. Several envelopes may be concatenated into one
+    websocket message.
+    """
+    return FRAME_HEADER.pack(stream_id, len(payload)) + payload
+
+
+def iter_frames(data: bytes) -> Iterator[Tuple[int, bytes]]:
+    """
+    Iterate over the ``(stream_id, payload)`` pairs of one binary websocket message.
+
+    Raises:
+        ValueError: If an envelope is truncated.
+    """
+    view = memoryview(data)
+    offset = 0
+    end = len(view)
+    header_size = FRAME_HEADER.size
+    while offset < end:
+        if end - offset < header_size:
+            raise ValueError("Invalid multiplexed binary frame received (truncated header)")
+        stream_id, length = FRAME_HEADER.unpack_from(view, offset)
+        offset += header_size
+        if end - offset < length:
+            raise ValueError("Invalid multiplexed binary frame received (truncated payload)")
+        yield stream_id, view[offset:offset + length].tobytes()
+        offset += length
+
 
 class AsyncJsonWebsocketDemultiplexer(AsyncJsonWebsocketConsumer):
     """
@@ -33,6 +80,23 @@ class AsyncJsonWebsocketDemultiplexer(AsyncJsonWebsocketConsumer):
       These applications handle specific streams of WebSocket communication.
     - `application_close_timeout` (int): Timeout in seconds while waiting for upstream applications
       to close before forcefully terminating the connection.
+    - `stream_ids` (dict): Mapping of stream names to the stream-id byte used in binary envelopes.
+      Assigned in declaration order of the applications.
+    - `stream_queues` (dict): Per-stream upstream queue options (`maxsize`, `policy`,
+      `max_coalesce_bytes`), keyed by stream name with a `default` fallback. Defaults to
+      `settings.AHS_MULTIPLEXER_STREAM_QUEUES`. See :class:`StreamQueue` for the overflow policies.
+    - `lazy_streams` (bool): Start upstream applications on the first frame of their stream (or an
+      explicit `{"stream": ..., "control": "subscribe"}` frame) instead of on connect. The
+      connection is accepted on connect; an application closing before it accepted refused the
+      client, its stream can't be subscribed again and the connection is closed with its code
+      once no other stream is accepting or starting.
+    - `stream_idle_timeouts` (dict): Seconds without traffic after which a stream is torn down,
+      keyed by stream name with a `default` fallback. `None` disables the teardown.
+
+    Binary mode:
+    - Clients requesting the `ahs.bin.v1` subprotocol exchange binary envelopes
+      (stream-id byte + length-prefixed payload, see :func:`pack_frame`). Payloads are routed
+      upstream as raw `bytes` without being decoded or re-encoded by the demultiplexer.
 
     Parameters:
     - **kwargs (dict): Keyword arguments mapping stream names to application callables.
@@ -46,11 +110,16 @@ class AsyncJsonWebsocketDemultiplexer(AsyncJsonWebsocketConsumer):
     - `_create_upstream_applications`: Initializes and starts upstream applications associated
       with the stream names.
     - `send_upstream`: Sends messages upstream to the appropriate or all application streams.
+    - `close_stream`: Stops routing frames to a stream whose upstream queue overflowed.
+    - `stream_metrics`: Returns queue depth and dropped frame counters per stream.
     - `dispatch_downstream`: Routes downstream messages from upstream applications to the demultiplexer.
     - `websocket_connect`: Handles WebSocket connection establishment, broadcasting connect
       messages upstream.
     - `receive_json`: Routes received WebSocket messages to the appropriate stream or raises errors
       for invalid frames.
+    - `receive_bytes`: Routes binary envelopes to the appropriate stream (binary mode only).
+    - `receive_control`: Handles `subscribe` / `unsubscribe` control frames.
+    - `start_stream` / `subscribe` / `unsubscribe`: Start and tear down single streams.
     - `websocket_disconnect`: Handles WebSocket disconnection events, propagating them upstream.
     - `disconnect`: Waits for all upstream applications to close gracefully or times out after
       `application_close_timeout`.
@@ -63,10 +132,18 @@ class AsyncJsonWebsocketDemultiplexer(AsyncJsonWebsocketConsumer):
     """
     applications = {}
     application_close_timeout = 5
+    stream_queues = getattr(settings, 'AHS_MULTIPLEXER_STREAM_QUEUES', {})
+    stream_overflow_close_code = 1008
+    lazy_streams = getattr(settings, 'AHS_MULTIPLEXER_LAZY_STREAMS', True)
+    stream_idle_timeouts = getattr(settings, 'AHS_MULTIPLEXER_STREAM_IDLE_TIMEOUTS', {'default': None})
+    stream_idle_check_interval = 30
 
     def __init__(self, **kwargs):
         for key, app in kwargs.items():
             self.applications[key] = app
+        self.stream_ids = {name: index for index, name in enumerate(self.applications)}
+        self.stream_names = {index: name for name, index in self.stream_ids.items()}
+        self.binary_mode = False
 
         super().__init__()
 
@@ -106,34 +183,41 @@ class AsyncJsonWebsocketDemultiplexer(AsyncJsonWebsocketConsumer):
         self.application_streams = {}
         self.application_futures = {}
         self.applications_accepting_frames = set()
+        self.pending_streams = set()
+        self.refused_streams = set()
+        self.stream_activity = {}
+        self.accepted = False
         self.closing = False
+        self.message_consumer = None
 
         scope = scope.copy()
         scope['demultiplexer_cls'] = self.__class__
+        self.binary_mode = BINARY_SUBPROTOCOL in scope.get('subprotocols', ())
+        scope['demultiplexer_binary'] = self.binary_mode
         self.scope = scope
 
         loop = asyncio.get_event_loop()
-        # create the child applications
-        await loop.create_task(self._create_upstream_applications())
+        # create the child applications, lazy streams are created on their first frame
+        if not self.lazy_streams:
+            await loop.create_task(self._create_upstream_applications())
         # start observing for messages
-        message_consumer = loop.create_task(super().__call__(scope, receive, send))
+        self.message_consumer = loop.create_task(super().__call__(scope, receive, send))
+        idle_reaper = loop.create_task(self._reap_idle_streams())
         try:
-            # wait for either an upstream application to close or the message consumer loop.
-            await asyncio.wait(
-                list(self.application_futures.values()) + [message_consumer],
-                return_when=asyncio.FIRST_COMPLETED
-            )
+            # wait for the message consumer loop, a crashing upstream application cancels it.
+            await asyncio.wait([self.message_consumer])
         finally:
+            idle_reaper.cancel()
             # make sure we clean up the message consumer loop
-            message_consumer.cancel()
+            self.message_consumer.cancel()
             try:
                 # check if there were any exceptions raised
-                await message_consumer
+                await self.message_consumer
             except asyncio.CancelledError:
                 pass
             finally:
                 # Make sure we clean up upstream applications on exit
-                for future in self.application_futures.values():
+                for future in list(self.application_futures.values()):
                     future.cancel()
                     try:
                         # check for exceptions
@@ -145,34 +229,108 @@ class AsyncJsonWebsocketDemultiplexer(AsyncJsonWebsocketConsumer):
         """
         Creates and initializes upstream application streams and futures for each application.
 
-        This asynchronous function iterates through the defined applications, wraps each
-        application into a single callable if necessary, and sets up an asyncio.Queue for
-        each application stream. It also schedules invoking each application's callable
-        (using an asyncio task) by providing the scope, a `get` operation on the upstream
-        queue, and a partial function for dispatching downstream messages tied to the
-        specific application stream.
+        Used when `lazy_streams` is disabled, every application is started on connect.
+        See :meth:`start_stream` for the setup of a single stream.
 
         Raises:
             Exception: Any unexpected error that occurs during the initialization
                 or scheduling of upstream applications.
+        """
+        for steam_name in self.applications:
+            self.start_stream(steam_name)
 
-        Parameters:
-            self: The instance of the class that encapsulates the
-                '_create_upstream_applications' behavior.
+    def start_stream(self, steam_name):
+        """
+        Start the upstream application of a single stream.
 
+        Wraps the application into a single callable if necessary, sets up a bounded
+        :class:`StreamQueue` and schedules the application's callable (using an asyncio
+        task) with the scope, a `get` operation on the upstream queue, and a partial
+        function for dispatching downstream messages tied to the stream.
+
+        Raises:
+            ValueError: If the stream is not mapped to an application.
         """
-        loop = asyncio.get_event_loop()
-        for steam_name, application in self.applications.items():
-            application = guarantee_single_callable(application)
-            upstream_queue = asyncio.Queue()
-            self.application_streams[steam_name] = upstream_queue
-            self.application_futures[steam_name] = loop.create_task(
-                application(
-                    self.scope,
-                    upstream_queue.get,
-                    partial(self.dispatch_downstream, steam_name=steam_name)
-                )
+        application = self.applications.get(steam_name)
+        if application is None:
+            raise ValueError("Invalid multiplexed frame received (stream not mapped)")
+        application = guarantee_single_callable(application)
+        upstream_queue = StreamQueue(steam_name, **self.get_stream_queue_options(steam_name))
+        self.application_streams[steam_name] = upstream_queue
+        future = asyncio.get_event_loop().create_task(
+            application(
+                self.scope,
+                upstream_queue.get,
+                partial(self.dispatch_downstream, steam_name=steam_name)
             )
+        )
+        future.add_done_callback(partial(self._stream_done, steam_name))
+        self.application_futures[steam_name] = future
+        self.stream_activity[steam_name] = asyncio.get_event_loop().time()
+        return upstream_queue
+
+    async def subscribe(self, steam_name):
+        """
+        Start a stream on demand and hand it the `websocket.connect` message. Frames for
+        the stream are accepted right away and queued until the application accepted.
+
+        Raises:
+            ValueError: If the application refused the client before.
+        """
+        if steam_name in self.refused_streams:
+            raise ValueError(f"Invalid multiplexed frame received (stream '{steam_name}' refused the connection)")
+        if steam_name in self.application_streams:
+            return
+        self.start_stream(steam_name).put_control({"type": "websocket.connect"})
+        self.pending_streams.add(steam_name)
+
+    async def unsubscribe(self, steam_name, code=1000):
+        """
+        Tear down a single stream: send `websocket.disconnect` to its application and
+        cancel it if it did not finish within `application_close_timeout`.
+        """
+        self.applications_accepting_frames.discard(steam_name)
+        self.pending_streams.discard(steam_name)
+        steam_queue = self.application_streams.get(steam_name)
+        future = self.application_futures.get(steam_name)
+        if steam_queue is None or future is None:
+            return
+        steam_queue.put_control({"type": "websocket.disconnect", "code": code})
+        done, _ = await asyncio.wait([future], timeout=self.application_close_timeout)
+        if not done:
+            future.cancel()
+
+    def _stream_done(self, steam_name, future):
+        self.application_streams.pop(steam_name, None)
+        self.application_futures.pop(steam_name, None)
+        self.stream_activity.pop(steam_name, None)
+        self.applications_accepting_frames.discard(steam_name)
+        self.pending_streams.discard(steam_name)
+        if not future.cancelled() and future.exception() is not None:
+            logger.error(f"Upstream application of stream '{steam_name}' failed: {future.exception()!r}")
+            # an upstream application crashed, shut down the whole connection
+            if self.message_consumer is not None:
+                self.message_consumer.cancel()
+
+    def get_stream_idle_timeout(self, stream_name):
+        return self.stream_idle_timeouts.get(stream_name, self.stream_idle_timeouts.get('default'))
+
+    async def _reap_idle_streams(self):
+        """
+        Periodically tear down lazily created streams without upstream or downstream
+        traffic for longer than their idle timeout.
+        """
+        if not self.lazy_streams:
+            return
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.stream_idle_check_interval)
+            now = loop.time()
+            for steam_name, last_activity in list(self.stream_activity.items()):
+                timeout = self.get_stream_idle_timeout(steam_name)
+                if timeout and now - last_activity > timeout:
+                    logger.debug(f"Tearing down idle stream '{steam_name}'")
+                    await self.unsubscribe(steam_name)
 
     async def send_upstream(self, message, stream_name=None):
         """
@@ -201,12 +359,71 @@ class AsyncJsonWebsocketDemultiplexer(AsyncJsonWebsocketConsumer):
         """
         if stream_name is None:
             for steam_queue in self.application_streams.values():
-                await steam_queue.put(message)
+                await self._put_upstream(steam_queue, message)
             return
         steam_queue = self.application_streams.get(stream_name)
         if steam_queue is None:
             raise ValueError("Invalid multiplexed frame received (stream not mapped)")
-        await steam_queue.put(message)
+        self.stream_activity[stream_name] = asyncio.get_event_loop().time()
+        await self._put_upstream(steam_queue, message)
+
+    async def route_frame(self, steam_name):
+        """
+        Make sure `steam_name` can take a frame from the client, lazily starting its
+        upstream application on the first frame.
+
+        Raises:
+            ValueError: If the stream is not mapped or no longer accepts frames.
+        """
+        if steam_name in self.applications_accepting_frames or steam_name in self.pending_streams:
+            return
+        if (
+                self.lazy_streams
+                and steam_name in self.applications
+                and steam_name not in self.application_streams
+                and steam_name not in self.refused_streams
+        ):
+            await self.subscribe(steam_name)
+            return
+        raise ValueError("Invalid multiplexed frame received (stream not mapped)")
+
+    async def _put_upstream(self, steam_queue: StreamQueue, message):
+        if message.get("type") != "websocket.receive":
+            steam_queue.put_control(message)
+            return
+        try:
+            await steam_queue.put_frame(message)
+        except StreamQueueOverflow as e:
+            await self.close_stream(e.stream_name)
+
+    def get_stream_queue_options(self, stream_name) -> dict:
+        """
+        Return the upstream queue options of `stream_name`, falling back to the
+        `default` entry of `stream_queues`.
+        """
+        return dict(self.stream_queues.get(stream_name, self.stream_queues.get('default', {})))
+
+    async def close_stream(self, stream_name):
+        """
+        Close a single stream after its upstream queue overflowed.
+
+        The stream stops accepting frames and its upstream application receives a
+        `websocket.disconnect`. The connection is closed if no stream is left.
+        """
+        self.applications_accepting_frames.discard(stream_name)
+        self.pending_streams.discard(stream_name)
+        self.application_streams[stream_name].put_control({
+            "type": "websocket.disconnect",
+            "code": self.stream_overflow_close_code,
+        })
+        if not self.lazy_streams and not self.applications_accepting_frames and not self.closing:
+            await self.close(self.stream_overflow_close_code)
+
+    def stream_metrics(self) -> dict:
+        """
+        Return queue depth, dropped and coalesced frame counters for every stream.
+        """
+        return {name: steam_queue.metrics() for name, steam_queue in self.application_streams.items()}
 
     async def dispatch_downstream(self, message, steam_name):
         """
@@ -230,6 +447,8 @@ class AsyncJsonWebsocketDemultiplexer(AsyncJsonWebsocketConsumer):
         Returns:
             None
         """
+        if steam_name in self.stream_activity:
+            self.stream_activity[steam_name] = asyncio.get_event_loop().time()
         handler = getattr(self, get_handler_name(message), None)
         if handler:
             await handler(message, stream_name=steam_name)
@@ -261,8 +480,18 @@ class AsyncJsonWebsocketDemultiplexer(AsyncJsonWebsocketConsumer):
         Returns:
             None
         """
+        if self.lazy_streams:
+            # no upstream application is running yet, accept on their behalf
+            await self.accept_connection()
+            return
         await self.send_upstream(message)
 
+    async def accept_connection(self):
+        if self.accepted:
+            return
+        self.accepted = True
+        await self.accept(BINARY_SUBPROTOCOL if self.binary_mode else None)
+
     async def receive_json(self, content, **kwargs):
         """
         Handles the reception of JSON messages, validates the structure, and forwards
@@ -294,14 +523,17 @@ class AsyncJsonWebsocketDemultiplexer(AsyncJsonWebsocketConsumer):
         -------
         None
         """
+        # Stream control frames, e.g. {"stream": "terminal", "control": "subscribe"}
+        if isinstance(content, dict) and "stream" in content and "control" in content:
+            await self.receive_control(content["stream"], content["control"])
+            return
         # Check the frame looks good
         if isinstance(content, dict) and "stream" in content and "payload" in content:
             # Match it to a channel
             steam_name = content["stream"]
             payload = content["payload"]
             # block upstream frames
-            if steam_name not in self.applications_accepting_frames:
-                raise ValueError("Invalid multiplexed frame received (stream not mapped)")
+            await self.route_frame(steam_name)
             # send it on to the application that handles this stream
             await self.send_upstream(
                 message={
@@ -314,6 +546,55 @@ class AsyncJsonWebsocketDemultiplexer(AsyncJsonWebsocketConsumer):
         else:
             raise ValueError("Invalid multiplexed **frame received (no channel/payload key)")
 
+    async def receive_control(self, steam_name, control):
+        """
+        Handle `subscribe` / `unsubscribe` control frames which explicitly start or tear
+        down the upstream application of a stream.
+
+        Raises:
+            ValueError: If the stream is not mapped or the control is unknown.
+        """
+        if steam_name not in self.applications:
+            raise ValueError("Invalid multiplexed frame received (stream not mapped)")
+        if control == "subscribe":
+            await self.subscribe(steam_name)
+        elif control == "unsubscribe":
+            await self.unsubscribe(steam_name)
+        else:
+            raise ValueError(f"Invalid multiplexed control frame received ({control})")
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        """
+        Dispatch binary websocket messages to `receive_bytes` when the connection is in
+        binary mode, everything else takes the JSON path of the parent class.
+        """
+        if bytes_data is not None and self.binary_mode:
+            await self.receive_bytes(bytes_data)
+            return
+        await super().receive(text_data=text_data, bytes_data=bytes_data, **kwargs)
+
+    async def receive_bytes(self, bytes_data):
+        """
+        Fast path for binary envelopes.
+
+        Every envelope of the websocket message is handed to its upstream application as a
+        `websocket.receive` message carrying the untouched payload bytes, so neither the
+        demultiplexer nor the transport decode or re-encode the payload.
+
+        Raises:
+            ValueError: If an envelope is malformed or the stream is not mapped.
+        """
+        for stream_id, payload in iter_frames(bytes_data):
+            steam_name = self.stream_names.get(stream_id)
+            await self.route_frame(steam_name)
+            await self.send_upstream(
+                message={
+                    "type": "websocket.receive",
+                    "bytes": payload
+                },
+                stream_name=steam_name
+            )
+
     async def websocket_disconnect(self, message):
         """
         Handle the WebSocket disconnect event.
@@ -351,9 +632,12 @@ class AsyncJsonWebsocketDemultiplexer(AsyncJsonWebsocketConsumer):
         Raises:
             asyncio.TimeoutError: If the disconnection process exceeds the specified timeout period.
         """
+        logger.debug(f"Stream metrics on disconnect: {self.stream_metrics()}")
+        if not self.application_futures:
+            return
         try:
             await asyncio.wait(
-                self.application_futures.values(),
+                list(self.application_futures.values()),
                 return_when=asyncio.ALL_COMPLETED,
                 timeout=self.application_close_timeout
             )
@@ -386,6 +670,9 @@ class AsyncJsonWebsocketDemultiplexer(AsyncJsonWebsocketConsumer):
                 "payload": json
             }
             await self.send_json(data)
+        # Handle binary data in binary mode, the payload is forwarded as is
+        elif "bytes" in message and self.binary_mode:
+            await self.send(bytes_data=pack_frame(self.stream_ids[stream_name], message["bytes"]))
         # Handle binary data
         elif "bytes" in message:
             binary_data = message.get("bytes")
@@ -404,11 +691,10 @@ class AsyncJsonWebsocketDemultiplexer(AsyncJsonWebsocketConsumer):
         Intercept downstream `websocket.accept` message and thus allow this upsteam application to accept websocket
         frames.
         """
-        is_first = not self.applications_accepting_frames
         self.applications_accepting_frames.add(stream_name)
+        self.pending_streams.discard(stream_name)
         # accept the connection after the first upstream application accepts.
-        if is_first:
-            await self.accept()
+        await self.accept_connection()
 
     async def websocket_close(self, message, stream_name):
         """
@@ -418,6 +704,8 @@ class AsyncJsonWebsocketDemultiplexer(AsyncJsonWebsocketConsumer):
 
         If there are not more upstream applications accepting messages it will then call `close`.
         """
+        # closed before accepting: the application rejected the client on connect
+        refused = stream_name in self.pending_streams
         if stream_name in self.applications_accepting_frames:
             # remove from set of upsteams steams than can receive new messages
             self.applications_accepting_frames.remove(stream_name)
@@ -426,6 +714,16 @@ class AsyncJsonWebsocketDemultiplexer(AsyncJsonWebsocketConsumer):
 
         if self.closing:
             return
+        # lazily created streams can be subscribed again, keep the connection open.
+        if self.lazy_streams:
+            asyncio.get_event_loop().create_task(self.unsubscribe(stream_name, message.get("code", 1000)))
+            if refused:
+                self.refused_streams.add(stream_name)
+                self.pending_streams.discard(stream_name)
+                # as with eager streams, the connection is closed once every started stream refused
+                if not self.applications_accepting_frames and not self.pending_streams:
+                    await self.close(message.get("code"))
+            return
         # if none of the upstream applications are listing we need to close.
         if not self.applications_accepting_frames:
             await self.close(message.get("code"))
@@ -3,16 +3,19 @@ import json
 import logging
 from functools import wraps
 from typing import (
+    Any,
     Dict,
     Callable,
     Coroutine,
-    AsyncGenerator, Set, List,
+    AsyncGenerator, Set, List, Sequence, Tuple,
 )
+from uuid import UUID
 
 from django.contrib.auth import get_user_model
 
 from config import settings
 from backend.ahs_core.utils import parse_func_signature
+from backend.ahs_core.consumers.command_cache import CommandCache
 
 logging.getLogger('daphne.ws_protocol').setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
@@ -20,6 +23,87 @@ logger.setLevel(logging.DEBUG)
 User = get_user_model()
 
 
+def _coerce_bool(value) -> bool:
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str):
+        lowered = value.lower()
+        if lowered in ('true', '1', 'yes', 'on'):
+            return True
+        if lowered in ('false', '0', 'no', 'off'):
+            return False
+    elif isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    raise ValueError(f"'{value}' is not a valid boolean")
+
+
+def _coerce_uuid(value) -> UUID:
+    return value if isinstance(value, UUID) else UUID(str(value))
+
+
+COERCERS: Dict[Any, Callable[[Any], Any]] = {
+    UUID: _coerce_uuid,
+    int: int,
+    float: float,
+    bool: _coerce_bool,
+    str: str,
+}
+
+
+class ArgumentBinder:
+    """
+    Precompiled argument binder of a websocket command.
+
+    Built once at registration time from the output of `parse_func_signature`, it maps
+    the positional and keyword arguments of a command request onto the callback's
+    parameter names, applies defaults and coerces values according to the recorded
+    annotations (UUID, int, float, bool, str). Replaces `inspect.signature().bind()`
+    on every invocation.
+
+    Raises:
+        TypeError: If arguments are missing, unknown or given twice.
+        ValueError: If a value can't be coerced to its annotation.
+    """
+    __slots__ = ('func_name', 'names', 'defaults', 'coercers')
+
+    def __init__(self, func_name: str, args: List[str], kwargs: Dict[str, Any], annotations: Dict[str, Any]):
+        self.func_name = func_name
+        self.names: Tuple[str, ...] = tuple(args) + tuple(kwargs)
+        self.defaults: Dict[str, Any] = dict(kwargs)
+        self.coercers: Dict[str, Callable[[Any], Any]] = {
+            name: COERCERS[annotation]
+            for name, annotation in annotations.items()
+            if annotation in COERCERS
+        }
+
+    def __call__(self, args: Sequence | None, kwargs: Dict[str, Any] | None) -> Dict[str, Any]:
+        args = args or ()
+        if len(args) > len(self.names):
+            raise TypeError(f"{self.func_name}() takes {len(self.names)} arguments but {len(args)} were given")
+        bound = dict(zip(self.names, args))
+        if kwargs:
+            for name, value in kwargs.items():
+                if name in bound:
+                    raise TypeError(f"{self.func_name}() got multiple values for argument '{name}'")
+                if name not in self.names:
+                    raise TypeError(f"{self.func_name}() got an unexpected keyword argument '{name}'")
+                bound[name] = value
+        if len(bound) != len(self.names):
+            for name in self.names:
+                if name not in bound:
+                    if name not in self.defaults:
+                        raise TypeError(f"{self.func_name}() missing required argument: '{name}'")
+                    bound[name] = self.defaults[name]
+        for name, coerce in self.coercers.items():
+            value = bound[name]
+            if value is not None:
+                bound[name] = coerce(value)
+        return bound
+
+    def __repr__(self):
+        return f"<ArgumentBinder {self.func_name}({', '.join(self.names)})>"
+
+
 class CmdMapper:
     """
     Manages mapping of callback functions to specific applications within the project.
@@ -36,7 +120,8 @@ class CmdMapper:
         in the project's ahs_settings where each app begins with "backend".
         callbacks (Dict[str, Union[str, List, Dict, None]]): A dictionary where each
         key is the callback function name, and the value stores the parsed signature
-        (args, kwargs, annotations) and the function itself.
+        (args, kwargs, annotations), the function itself and its precompiled
+        :class:`ArgumentBinder`.
 
     Methods:
         register_callback(app: str, func_name: str, func: Callable[..., Coroutine] | AsyncGenerator):
@@ -56,11 +141,17 @@ class CmdMapper:
         if app not in self.apps:
             raise ValueError(f"App '{app}' not found in registered apps.")
         if func_name not in self.callbacks.keys():
-            self.callbacks[func_name] = {'args': [],'kwargs': {},'annotations': {},'func': None}
+            self.callbacks[func_name] = {'args': [],'kwargs': {},'annotations': {},'func': None, 'app': app}
         (self.callbacks[func_name]['args'],
              self.callbacks[func_name]['kwargs'],
              self.callbacks[func_name]['annotations']) = (parse_func_signature(func, ['user']))
         self.callbacks[func_name]['func'] = func
+        self.callbacks[func_name]['binder'] = ArgumentBinder(
+            func_name,
+            self.callbacks[func_name]['args'],
+            self.callbacks[func_name]['kwargs'],
+            self.callbacks[func_name]['annotations'],
+        )
         logger.debug(f"Registered callback '{func_name}' for app '{app}' with function {func}")
 
 
@@ -70,8 +161,19 @@ class CmdMapper:
 CommandMapper = CmdMapper()
 
 
-def websocket_cmd(func):
-    """Decorator to register a WebSocket command dynamically with CmdParser."""
+def websocket_cmd(func=None, *, cache: int | None = None, depends_on: Sequence = (), owner_field: str = 'owner_id'):
+    """
+    Decorator to register a WebSocket command dynamically with CmdParser.
+
+    Read-only commands can opt in to result caching with `cache` (timeout in seconds).
+    Cached results are invalidated when an instance of one of the `depends_on` models
+    is saved or deleted, for the user `owner_field` resolves to, see :class:`CommandCache`::
+
+        @websocket_cmd(cache=300, depends_on=(Category,), owner_field='owner__user_id')
+        async def get_bm_categories(user): ...
+    """
+    if func is None:
+        return lambda f: websocket_cmd(f, cache=cache, depends_on=depends_on, owner_field=owner_field)
 
     @wraps(func)
     async def wrapper(*args, **kwargs):
@@ -82,5 +184,14 @@ def websocket_cmd(func):
     func_name = func.__name__  # Extract function name
 
     CommandMapper.register_django_callback(app_name, func_name, func)
+    if cache:
+        CommandMapper.callbacks[func_name]['cache'] = CommandCache(
+            func_name,
+            timeout=cache,
+            depends_on=depends_on,
+            owner_field=owner_field,
+            local_timeout=getattr(settings, 'AHS_COMMAND_CACHE_LOCAL_TIMEOUT', 5),
+            local_maxsize=getattr(settings, 'AHS_COMMAND_CACHE_LOCAL_MAXSIZE', 1024),
+        )
     logger.debug(f"Registered callback '{func_name}' for app '{app_name}' with function {func}")
     return wrapper
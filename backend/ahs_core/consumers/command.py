@@ -1,24 +1,47 @@
+import asyncio
 import inspect
 import json
+import time
+from contextlib import aclosing
 from dataclasses import dataclass
 import logging
 from uuid import UUID
+from weakref import WeakValueDictionary
 from typing import (
     List,
     Dict,
     Callable, Coroutine, AsyncGenerator,
 )
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from channels.layers import get_channel_layer
 
 from backend.ahs_core.consumers.cmd_parser import CommandMapper
+from backend.ahs_core.consumers.command_cache import MISSING
 
 logger = logging.getLogger(__name__)
 
 
 User = get_user_model()
 
+# Consumers living in this worker process, keyed by channel name.
+_local_consumers = WeakValueDictionary()
+
+
+def register_local_consumer(channel_name: str, consumer):
+    """Make `consumer` reachable for in-process command response delivery."""
+    _local_consumers[channel_name] = consumer
+
+
+def unregister_local_consumer(channel_name: str):
+    _local_consumers.pop(channel_name, None)
+
+
+def get_local_consumer(channel_name: str):
+    """Return the consumer owning `channel_name` if it lives in this process, else None."""
+    return _local_consumers.get(channel_name)
+
 
 @dataclass
 class Command:
@@ -26,7 +49,7 @@ class Command:
 
     __slots__ = ('func_name', 'func_args', 'func_kwargs',
                  'owner', 'channel_name', 'page_name', 'app_name',
-                 'send_resp_coro', 'unique_id', 'callback', 'socket_url',)
+                 'send_resp_coro', 'unique_id', 'callback', 'socket_url', 'deadline',)
     func_name: str
     func_args: List[str | int | float | bool | UUID]
     func_kwargs: Dict[str, str | int | float | bool | UUID]
@@ -37,6 +60,14 @@ class Command:
     unique_id: UUID | int
     socket_url: str
     callback: Callable[..., Coroutine] | AsyncGenerator | None
+    # Event loop time at which the command is aborted, None = no deadline.
+    deadline: float | None
+
+    # Async generator output is sent in chunks of at most `chunk_size` items,
+    # a chunk is flushed early once its first item waited `chunk_interval` seconds,
+    # see `iter_chunks`.
+    chunk_size = getattr(settings, 'AHS_COMMAND_RESPONSE_CHUNK_SIZE', 50)
+    chunk_interval = getattr(settings, 'AHS_COMMAND_RESPONSE_CHUNK_INTERVAL', 0.05)
 
     def __post_init__(self):
         if not self.func_args:
@@ -48,43 +79,135 @@ class Command:
         logger.debug(f"Created command: {self}")
 
     async def execute(self):
+        """
+        Run the command. Its `deadline` is enforced by the caller, see
+        :meth:`AHSCommandConsumer.run_command`, which also covers the time waiting
+        for a slot.
+
+        Raises:
+            asyncio.CancelledError: If the running task got cancelled.
+        """
         logger.debug(f"Executing command: {self}")
         if self.validate_params():
             await self.send_response()
 
 
     async def send_response(self):
-        channel_layer = get_channel_layer()
         ch_name = self.channel_name
+        cache = CommandMapper.callbacks[self.func_name].get('cache')
+        owner_id = getattr(self.owner, 'pk', None)
+
+        if cache is not None:
+            cached, cache_key = await cache.alookup(owner_id, self.func_kwargs)
+            if cached is not MISSING:
+                logger.debug(f"Sending cached response for command: {self}")
+                await self.send_cached_response(cached)
+                return
 
         if inspect.isasyncgenfunction(self.callback):
             logger.debug(f"Sending async generator response for command: {self}, sending to {ch_name}")
-            async for data in self.callback(*self.func_args, self.owner, **self.func_kwargs):
-                await channel_layer.send(
-                    ch_name,
-                    {
-                        'type': 'command.response',
-                        'app': self.app_name,
-                        'cmd': self.func_name,
-                        'channel_name': ch_name,
-                        'data': data,
-                    }
-                )
+            results = [] if cache is not None else None
+            chunks = self.iter_chunks(self.callback(**self.func_kwargs, user=self.owner))
+            async with aclosing(chunks):
+                async for chunk, final in chunks:
+                    await self.deliver(self.build_response(chunk, chunk=True, final=final))
+                    if results is not None:
+                        results.extend(chunk)
+            if results is not None:
+                await cache.aset(owner_id, self.func_kwargs, {'chunked': True, 'data': results}, cache_key)
         else:
             logger.debug(f"Sending response for command: {self}")
-            data = await self.callback(*self.func_args, self.owner ,**self.func_kwargs)
-            await channel_layer.send(ch_name, {
-                'type': 'command.response',
-                'app': self.app_name,
-                'cmd': self.func_name,
-                'channel_name': ch_name,
-                'data': data,
-            })
+            data = await self.callback(**self.func_kwargs, user=self.owner)
+            await self.deliver(self.build_response(data))
+            if cache is not None:
+                await cache.aset(owner_id, self.func_kwargs, {'chunked': False, 'data': data}, cache_key)
+
+    async def iter_chunks(self, generator: AsyncGenerator):
+        """
+        Group the items of `generator` into ``(chunk, final)`` pairs. A chunk is
+        yielded once it holds `chunk_size` items or its first item waited
+        `chunk_interval` seconds, even while the generator is still busy producing
+        the next item. The last pair is ``(remaining items, True)``.
+        """
+        chunk = []
+        chunk_deadline = 0.0
+        next_item = None
+        try:
+            while True:
+                if next_item is None:
+                    next_item = asyncio.ensure_future(anext(generator))
+                if chunk:
+                    done, _ = await asyncio.wait({next_item}, timeout=max(chunk_deadline - time.monotonic(), 0))
+                    if not done:
+                        yield chunk, False
+                        chunk = []
+                        continue
+                try:
+                    data = await next_item
+                except StopAsyncIteration:
+                    break
+                finally:
+                    if next_item.done():
+                        next_item = None
+                if not chunk:
+                    chunk_deadline = time.monotonic() + self.chunk_interval
+                chunk.append(data)
+                if len(chunk) >= self.chunk_size or time.monotonic() >= chunk_deadline:
+                    yield chunk, False
+                    chunk = []
+            yield chunk, True
+        finally:
+            # the generator can only be closed once no __anext__ is running
+            if next_item is not None:
+                next_item.cancel()
+                await asyncio.wait({next_item})
+            # run the generator's cleanup (querysets, cursors) right away when the
+            # command got cancelled while the generator was suspended at a yield
+            await generator.aclose()
+
+    async def send_cached_response(self, cached: dict):
+        data = cached['data']
+        if not cached['chunked']:
+            await self.deliver(self.build_response(data))
+            return
+        for start in range(0, len(data), self.chunk_size):
+            chunk = data[start:start + self.chunk_size]
+            await self.deliver(self.build_response(
+                chunk, chunk=True, final=start + self.chunk_size >= len(data)))
+        if not data:
+            await self.deliver(self.build_response([], chunk=True, final=True))
+
+    def build_response(self, data, **extra) -> dict:
+        return {
+            'type': 'command.response',
+            'app': self.app_name,
+            'cmd': self.func_name,
+            'channel_name': self.channel_name,
+            'unique_id': self.unique_id,
+            'data': data,
+            **extra,
+        }
+
+    async def deliver(self, message: dict):
+        """
+        Deliver a response to the owning consumer. If the consumer lives in this worker
+        the message is handed over in-process, the channel layer is only used to reach
+        consumers of other workers.
+        """
+        consumer = get_local_consumer(self.channel_name)
+        if consumer is not None:
+            await consumer.command_response(message)
+            return
+        await get_channel_layer().send(self.channel_name, message)
 
     def validate_params(self):
-        sig = inspect.signature(self.callback)
-        bound_args = sig.bind(*self.func_args, **self.func_kwargs)
-        bound_args.apply_defaults()
+        """
+        Bind and coerce the request arguments with the command's precompiled binder.
+        Afterwards all arguments are held in `func_kwargs` by parameter name.
+        """
+        binder = CommandMapper.callbacks[self.func_name]['binder']
+        self.func_kwargs = binder(self.func_args, self.func_kwargs)
+        self.func_args = []
         return True
 
     def json_serialize(self):
@@ -117,6 +240,7 @@ class Command:
             unique_id=data['unique_id'],
             callback=CommandMapper.callbacks[data['func_name']]['func'],
             socket_url=f"{self.socket_url}?id={data['unique_id']}",
+            deadline=None,
         )
 
     def __repr__(self):
@@ -0,0 +1,159 @@
+import hashlib
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Model
+from django.db.models.signals import post_save, post_delete
+
+logger = logging.getLogger(__name__)
+
+MISSING = object()
+
+
+class CommandCache:
+    """
+    Result cache of a read-only websocket command.
+
+    Results are keyed by ``(func_name, bound arguments, owner)`` and stored in a
+    process-local LRU (`local_timeout` seconds) in front of the shared Django cache
+    (Redis, `timeout` seconds). Saving or deleting an instance of one of the
+    `depends_on` models invalidates the entries of the instance's owner, or of all
+    owners if the instance has no `owner_field`. `owner_field` is resolved like a
+    lookup (``owner__user_id``) and must give the pk of the commands' `user`.
+
+    Invalidation bumps version counters in the shared cache and clears the local LRU
+    of the process that saved the instance. Local LRUs of other workers can serve a
+    stale result for at most `local_timeout` seconds. Results are stored under the
+    versions read by :meth:`alookup` before the command ran, so a result computed
+    while an invalidation happened is never served.
+
+    Enabled through the decorator::
+
+        @websocket_cmd(cache=300, depends_on=(Category,), owner_field='owner__user_id')
+        async def get_bm_categories(user): ...
+    """
+    key_prefix = 'ahs:cmd'
+
+    def __init__(
+            self,
+            func_name: str,
+            timeout: int = 300,
+            depends_on: Iterable[type[Model]] = (),
+            owner_field: str = 'owner_id',
+            local_timeout: float = 5.0,
+            local_maxsize: int = 1024,
+            cache_alias: str = None,
+    ):
+        self.func_name = func_name
+        self.timeout = timeout
+        self.depends_on = tuple(depends_on)
+        self.owner_field = owner_field
+        self.local_timeout = local_timeout
+        self.local_maxsize = local_maxsize
+        self.cache_alias = cache_alias or getattr(settings, 'AHS_COMMAND_CACHE_ALIAS', 'default')
+        self._local: "OrderedDict[Tuple[Any, str], Tuple[float, Any]]" = OrderedDict()
+        # bumped by every invalidation in this process, see `alookup`
+        self._generation = 0
+        for model in self.depends_on:
+            post_save.connect(self.invalidate_instance, sender=model, weak=False,
+                              dispatch_uid=f'{self.key_prefix}:{func_name}:{model._meta.label}:save')
+            post_delete.connect(self.invalidate_instance, sender=model, weak=False,
+                                dispatch_uid=f'{self.key_prefix}:{func_name}:{model._meta.label}:delete')
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @staticmethod
+    def args_key(func_kwargs: Dict[str, Any]) -> str:
+        return hashlib.sha1(repr(sorted(func_kwargs.items())).encode()).hexdigest()
+
+    def _version_keys(self, owner) -> Tuple[str, str]:
+        return (f'{self.key_prefix}:{self.func_name}:version',
+                f'{self.key_prefix}:{self.func_name}:{owner}:version')
+
+    async def _shared_key(self, owner, args_key: str) -> str:
+        func_version_key, owner_version_key = self._version_keys(owner)
+        versions = await self.cache.aget_many([func_version_key, owner_version_key])
+        return (f'{self.key_prefix}:{self.func_name}:{owner}:'
+                f'{versions.get(func_version_key, 0)}.{versions.get(owner_version_key, 0)}:{args_key}')
+
+    async def alookup(self, owner, func_kwargs: Dict[str, Any]) -> Tuple[Any, Tuple[str, int] | None]:
+        """
+        Return the cached result or `MISSING`, and the key to :meth:`aset` the result
+        of a miss under. The key holds the versions read now, before the command
+        runs, so invalidations that happen until it completed win.
+        """
+        generation = self._generation
+        local_key = (owner, self.args_key(func_kwargs))
+        entry = self._local.get(local_key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                self._local.move_to_end(local_key)
+                return value, None
+            del self._local[local_key]
+        shared_key = await self._shared_key(owner, local_key[1])
+        value = await self.cache.aget(shared_key, MISSING)
+        if value is not MISSING and generation == self._generation:
+            self._set_local(local_key, value)
+        return value, (shared_key, generation)
+
+    async def aget(self, owner, func_kwargs: Dict[str, Any]):
+        """Return the cached result or `MISSING`."""
+        value, _ = await self.alookup(owner, func_kwargs)
+        return value
+
+    async def aset(self, owner, func_kwargs: Dict[str, Any], value, key: Tuple[str, int] = None):
+        """Store `value`, under the `key` returned by :meth:`alookup` if given."""
+        local_key = (owner, self.args_key(func_kwargs))
+        if key is None:
+            key = (await self._shared_key(owner, local_key[1]), self._generation)
+        shared_key, generation = key
+        if generation == self._generation:
+            self._set_local(local_key, value)
+        await self.cache.aset(shared_key, value, self.timeout)
+
+    def _set_local(self, local_key, value):
+        self._local[local_key] = (time.monotonic() + self.local_timeout, value)
+        self._local.move_to_end(local_key)
+        while len(self._local) > self.local_maxsize:
+            self._local.popitem(last=False)
+
+    def _bump(self, version_key: str):
+        self.cache.add(version_key, 0, None)
+        self.cache.incr(version_key)
+
+    def invalidate(self, owner=None):
+        """Invalidate the results of `owner`, or of all owners if `owner` is None."""
+        func_version_key, owner_version_key = self._version_keys(owner)
+        self._generation += 1
+        if owner is None:
+            self._local.clear()
+            self._bump(func_version_key)
+        else:
+            for local_key in [key for key in self._local if key[0] == owner]:
+                del self._local[local_key]
+            self._bump(owner_version_key)
+        logger.debug(f"Invalidated command cache of '{self.func_name}' for owner {owner}")
+
+    def invalidate_instance(self, sender, instance, **kwargs):
+        """`post_save` / `post_delete` receiver of the `depends_on` models."""
+        owner = instance
+        try:
+            for attname in self.owner_field.split('__'):
+                owner = getattr(owner, attname, None)
+                if owner is None:
+                    break
+        except ObjectDoesNotExist:
+            # e.g. deleted along with its owner
+            owner = None
+        self.invalidate(owner)
+
+    def __repr__(self):
+        return f"<CommandCache {self.func_name} timeout={self.timeout} depends_on={self.depends_on}>"
@@ -1,10 +1,16 @@
+import asyncio
 import json
 import logging
+
+import cbor2
 from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
 
-from backend.ahs_core.consumers.command import Command
+from backend.ahs_core.consumers.cmd_parser import CommandMapper
+from backend.ahs_core.consumers.command import Command, register_local_consumer, unregister_local_consumer
+from backend.ahs_core.consumers.scheduler import command_scheduler
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -24,15 +30,33 @@ class AHSCommandConsumer(AsyncJsonWebsocketConsumer):
     It manages group messaging, handles permissions, processes client commands, and defines
     responses for various WebSocket interactions.
 
+    Commands run concurrently in their own tasks, at most `command_concurrency` per
+    connection, and pass the process-wide :data:`command_scheduler` which shares the
+    worker fairly between users. Responses carry the request's `unique_id`, so they
+    may complete out of order. Requests beyond `command_max_pending` running or waiting
+    commands of the connection are refused with an error.
+
+    Every command gets a deadline (`timeout` of the request in seconds, capped at
+    `command_max_timeout`). A running command is cancelled by a
+    `{"type": "command.cancel", "unique_id": ...}` message, by a new request with the
+    same `unique_id`, or when the connection closes.
+
     Attributes:
         groups (set): A set of WebSocket group names the current connection belongs to.
         channel_layer: A Django Channels construct to facilitate communication through layers.
+        command_tasks (dict): Running command tasks keyed by `unique_id`.
     """
+    command_concurrency = getattr(settings, 'AHS_COMMAND_CONNECTION_CONCURRENCY', 4)
+    command_max_pending = getattr(settings, 'AHS_COMMAND_CONNECTION_MAX_PENDING', 32)
+    command_timeout = getattr(settings, 'AHS_COMMAND_TIMEOUT', 30)
+    command_max_timeout = getattr(settings, 'AHS_COMMAND_MAX_TIMEOUT', 300)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.groups = set()
         self.channel_layer = None
+        self.command_tasks = {}
+        self.command_semaphore = asyncio.Semaphore(self.command_concurrency)
 
     async def connect(self):
         """
@@ -60,6 +84,7 @@ class AHSCommandConsumer(AsyncJsonWebsocketConsumer):
             ch_name = self.channel_name
 
             await self.accept()
+            register_local_consumer(ch_name, self)
 
         except ValidationError as e:
             logger.error(f"Validation error: {e}")
@@ -85,6 +110,8 @@ class AHSCommandConsumer(AsyncJsonWebsocketConsumer):
         """
 
         logger.info(f"DISCONNECT: {self.scope['client']} with code {close_code}")
+        unregister_local_consumer(self.channel_name)
+        await self.cancel_commands()
 
         if hasattr(self, "groups"):
             for group in list(self.groups):
@@ -109,7 +136,44 @@ class AHSCommandConsumer(AsyncJsonWebsocketConsumer):
         if text_data:
             await self.process_text_message(text_data)
         elif bytes_data:
-            await self.process_message(bytes_data)
+            await self.process_binary_message(bytes_data)
+
+    async def process_binary_message(self, bytes_data):
+        """
+        Processes an incoming binary WebSocket message containing a CBOR payload.
+
+        Binary messages are delivered by the demultiplexer's binary fast path, which
+        forwards the payload without decoding it.
+
+        Args:
+            bytes_data (bytes): Incoming CBOR-encoded WebSocket message.
+        """
+        try:
+            data = await self.decode_cbor(bytes_data)
+        except cbor2.CBORDecodeError:
+            logger.error(f"Invalid CBOR received: {bytes_data}")
+            await self.send_json({"error": "Invalid CBOR format"})
+            return
+        logger.debug(f"process_binary_message: {data}")
+        await self.process_message(data)
+
+    async def send_json(self, content, close=False):
+        """
+        Encode the given content as CBOR when the client negotiated the binary
+        multiplexer subprotocol, as JSON otherwise.
+        """
+        if self.scope.get('demultiplexer_binary', False):
+            await super().send(bytes_data=await self.encode_cbor(content), close=close)
+            return
+        await super().send_json(content, close=close)
+
+    @classmethod
+    async def decode_cbor(cls, bytes_data):
+        return cbor2.loads(bytes_data)
+
+    @classmethod
+    async def encode_cbor(cls, content):
+        return cbor2.dumps(content)
 
     async def process_text_message(self, text_data):
         """
@@ -170,8 +234,7 @@ class AHSCommandConsumer(AsyncJsonWebsocketConsumer):
         logger.debug(f"SEND_TO_CHANNEL_LAYER: {message}")
         args = self.scope['url_route']['args']
         kwargs = self.scope['url_route']['kwargs']
-        if not message.get('channel_name', None):
-            message['channel_name'] = self.channel_name
+        message['channel_name'] = self.channel_name
 
 
 
@@ -204,7 +267,8 @@ class AHSCommandConsumer(AsyncJsonWebsocketConsumer):
 
         Processes the `request` dictionary containing the client's command parameters,
         such as user information, page context, or channel-specific metadata. Once validated,
-        a :class:`backend.ahs_core.consumers.command.Command` object is created and executed.
+        a :class:`backend.ahs_core.consumers.command.Command` object is created and executed
+        in a separate task, so a slow command doesn't block later ones.
 
         Args:
             request (dict): A dictionary holding WebSocket command metadata.
@@ -212,11 +276,108 @@ class AHSCommandConsumer(AsyncJsonWebsocketConsumer):
         logger.debug(f"COMMAND_REQUEST: {request}")
 
         try:
-            logger.debug(f"datad: {datad}")
-            cmd = Command(**datad)
-            await cmd.execute()
+            func_name = request['func_name']
+            timeout = min(float(request.get('timeout') or self.command_timeout), self.command_max_timeout)
+            cmd = Command(
+                func_name=func_name,
+                func_args=request.get('func_args'),
+                func_kwargs=request.get('func_kwargs'),
+                owner=self.scope['user'],
+                # never the client's value, responses are delivered to this channel's socket
+                channel_name=self.channel_name,
+                page_name=request.get('page_name', ''),
+                app_name=CommandMapper.callbacks[func_name]['app'],
+                unique_id=request.get('unique_id'),
+                socket_url=self.scope['url_route']['kwargs']['socket_url'],
+                callback=None,
+                deadline=asyncio.get_running_loop().time() + timeout,
+            )
+        except Exception as e:
+            logger.exception(f"Error creating command: {e}")
+            await self.send_json({"error": "Invalid command request", "unique_id": request.get('unique_id')})
+            return
+
+        superseded = self.command_tasks.get(cmd.unique_id) if cmd.unique_id is not None else None
+        if len(self.command_tasks) - (superseded is not None) >= self.command_max_pending:
+            logger.warning(f"Refusing command, {len(self.command_tasks)} commands pending: {cmd}")
+            await self.send_json({
+                "app": cmd.app_name,
+                "cmd": cmd.func_name,
+                "unique_id": cmd.unique_id,
+                "error": "Too many pending commands",
+            })
+            return
+        if superseded is not None:
+            logger.debug(f"Command {cmd.unique_id} superseded by a new request")
+            superseded.cancel()
+
+        task = asyncio.get_running_loop().create_task(self.run_command(cmd))
+        task_key = cmd.unique_id if cmd.unique_id is not None else id(task)
+        self.command_tasks[task_key] = task
+        task.add_done_callback(lambda done: self._command_done(task_key, done))
+
+    def _command_done(self, task_key, task: asyncio.Task):
+        if self.command_tasks.get(task_key) is task:
+            del self.command_tasks[task_key]
+
+    async def run_command(self, cmd: Command):
+        """
+        Executes a command once a connection slot and a worker slot are free.
+
+        The command's deadline covers the time spent waiting for the slots.
+
+        Args:
+            cmd (Command): The command to execute.
+        """
+        try:
+            async with asyncio.timeout_at(cmd.deadline):
+                async with self.command_semaphore:
+                    async with command_scheduler.slot(getattr(cmd.owner, 'pk', None)):
+                        await cmd.execute()
+        except TimeoutError:
+            logger.warning(f"Command deadline exceeded: {cmd}")
+            await self.send_json({
+                "app": cmd.app_name,
+                "cmd": cmd.func_name,
+                "unique_id": cmd.unique_id,
+                "error": "Command deadline exceeded",
+            })
         except Exception as e:
             logger.exception(f"Error executing command: {e}")
+            await self.send_json({
+                "app": cmd.app_name,
+                "cmd": cmd.func_name,
+                "unique_id": cmd.unique_id,
+                "error": "Error executing command",
+            })
+
+    async def command_cancel(self, request):
+        """
+        Cancels the running command with the request's `unique_id`.
+
+        The client gets `{"unique_id": ..., "cancelled": true}` if a command was
+        cancelled. Async generator commands are closed with `aclose()`, so their
+        cleanup runs immediately.
+
+        Args:
+            request (dict): The `command.cancel` message.
+        """
+        logger.debug(f"COMMAND_CANCEL: {request}")
+        unique_id = request.get('unique_id')
+        task = self.command_tasks.get(unique_id)
+        if task is None:
+            return
+        task.cancel()
+        await self.send_json({"unique_id": unique_id, "cancelled": True})
+
+    async def cancel_commands(self):
+        """Cancels all running commands of the connection and waits for their cleanup."""
+        tasks = list(self.command_tasks.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+            logger.debug(f"Cancelled {len(tasks)} commands of {self.channel_name}")
 
     async def command_register(self, data):
         """
@@ -233,14 +394,19 @@ class AHSCommandConsumer(AsyncJsonWebsocketConsumer):
 
     async def command_response(self, data):
         """
-        Registers a command based on the provided data. This function processes the command
-        registration asynchronously, handling any necessary internal logic.
+        Sends a command response to the WebSocket client.
+
+        Called in-process by :meth:`Command.deliver` when the command ran in this worker,
+        or through the channel layer otherwise. Responses of async generator commands
+        carry a list of items in `data` and the `chunk` / `final` flags.
 
         Args:
-            data (dict): A dictionary containing the details of the command to register.
+            data (dict): The `command.response` message.
 
         Returns:
             None
         """
         logger.debug(f"COMMAND_RESPONSE: {data}")
-        self.channel_layer.send()
+        await self.send_json({
+            key: value for key, value in data.items() if key not in ('type', 'channel_name')
+        })
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+from collections import OrderedDict, defaultdict, deque
+from contextlib import asynccontextmanager
+from typing import Any, Deque, Dict, Hashable
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class FairCommandScheduler:
+    """
+    Process-wide scheduler for websocket command execution.
+
+    At most `max_concurrency` commands run at the same time in a worker, and at most
+    `max_per_user` of them belong to the same user. Waiting commands are granted slots
+    round-robin across users, so a single user flooding the worker with commands can't
+    starve the commands of other users.
+
+    Usage::
+
+        async with command_scheduler.slot(user.pk):
+            await cmd.execute()
+    """
+
+    def __init__(self, max_concurrency: int, max_per_user: int):
+        self.max_concurrency = max_concurrency
+        self.max_per_user = max_per_user
+        self._running = 0
+        self._running_per_user: Dict[Hashable, int] = defaultdict(int)
+        self._waiting: "OrderedDict[Hashable, Deque[asyncio.Future]]" = OrderedDict()
+
+    def _can_run(self, user_key) -> bool:
+        return self._running < self.max_concurrency and self._running_per_user.get(user_key, 0) < self.max_per_user
+
+    def _grant(self, user_key, waiter: asyncio.Future | None = None):
+        self._running += 1
+        self._running_per_user[user_key] += 1
+        if waiter is not None:
+            waiter.set_result(None)
+
+    async def acquire(self, user_key: Hashable):
+        # users waiting for a slot are at their `max_per_user` while global slots are
+        # free, they must not hold up the first commands of other users
+        if user_key not in self._waiting and self._can_run(user_key):
+            self._grant(user_key)
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user_key, deque()).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was granted while we got cancelled, hand it on
+                self.release(user_key)
+            else:
+                self._discard_waiter(user_key, waiter)
+            raise
+
+    def release(self, user_key: Hashable):
+        self._running -= 1
+        self._running_per_user[user_key] -= 1
+        if not self._running_per_user[user_key]:
+            del self._running_per_user[user_key]
+        self._wake_next()
+
+    def _discard_waiter(self, user_key, waiter):
+        waiters = self._waiting.get(user_key)
+        if waiters is None:
+            return
+        try:
+            waiters.remove(waiter)
+        except ValueError:
+            pass
+        if not waiters:
+            del self._waiting[user_key]
+
+    def _wake_next(self):
+        granted = True
+        while granted and self._waiting and self._running < self.max_concurrency:
+            granted = False
+            # one pass over all waiting users, one slot per user and pass
+            for user_key in list(self._waiting):
+                if self._running >= self.max_concurrency:
+                    return
+                self._waiting.move_to_end(user_key)
+                if self._running_per_user.get(user_key, 0) >= self.max_per_user:
+                    continue
+                waiters = self._waiting[user_key]
+                waiter = waiters.popleft()
+                if not waiters:
+                    del self._waiting[user_key]
+                if waiter.done():
+                    # cancelled while waiting
+                    granted = True
+                    continue
+                self._grant(user_key, waiter)
+                granted = True
+
+    @asynccontextmanager
+    async def slot(self, user_key: Hashable):
+        await self.acquire(user_key)
+        try:
+            yield
+        finally:
+            self.release(user_key)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'running': self._running,
+            'running_per_user': dict(self._running_per_user),
+            'waiting_per_user': {user_key: len(waiters) for user_key, waiters in self._waiting.items()},
+        }
+
+    def __repr__(self):
+        return f"<FairCommandScheduler running={self._running}/{self.max_concurrency} waiting={len(self._waiting)}>"
+
+
+command_scheduler = FairCommandScheduler(
+    max_concurrency=getattr(settings, 'AHS_COMMAND_WORKER_CONCURRENCY', 32),
+    max_per_user=getattr(settings, 'AHS_COMMAND_USER_CONCURRENCY', 8),
+)
@@ -0,0 +1,161 @@
+import asyncio
+import logging
+from collections import deque
+from dataclasses import dataclass, asdict
+from enum import Enum
+from typing import Deque, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class OverflowPolicy(str, Enum):
+    """What a :class:`StreamQueue` does with a frame when it is full."""
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    COALESCE = 'coalesce'
+    CLOSE = 'close'
+
+
+@dataclass
+class StreamQueueMetrics:
+    """Per-stream counters exposed by :meth:`StreamQueue.metrics`."""
+    depth: int = 0
+    max_depth: int = 0
+    received: int = 0
+    dropped: int = 0
+    coalesced: int = 0
+    blocked: int = 0
+    overflowed: bool = False
+
+
+class StreamQueueOverflow(Exception):
+    """Raised by :meth:`StreamQueue.put_frame` when a queue with the `close` policy overflows."""
+
+    def __init__(self, stream_name):
+        super().__init__(f"Upstream queue of stream '{stream_name}' overflowed")
+        self.stream_name = stream_name
+
+
+class StreamQueue:
+    """
+    Bounded upstream queue of one multiplexed websocket stream.
+
+    Data frames (`websocket.receive`) are subject to `maxsize` and the configured
+    overflow policy:
+
+    - `block`: wait until the upstream application consumed a frame.
+    - `drop_oldest`: discard the oldest queued data frame to make room.
+    - `coalesce`: append binary payloads to the last queued frame (up to
+      `max_coalesce_bytes`), otherwise block. Nothing is lost.
+    - `close`: raise :class:`StreamQueueOverflow`, the demultiplexer closes the stream.
+
+    Control messages (`websocket.connect`, `websocket.disconnect`) are never dropped and
+    never block, so a stuck upstream application can always be told to shut down. They
+    are queued in order with the data frames but don't count against `maxsize`.
+    """
+
+    def __init__(
+            self,
+            stream_name: str,
+            maxsize: int = 0,
+            policy: OverflowPolicy | str = OverflowPolicy.BLOCK,
+            max_coalesce_bytes: int = 64 * 1024,
+    ):
+        self.stream_name = stream_name
+        self.maxsize = maxsize
+        self.policy = OverflowPolicy(policy)
+        self.max_coalesce_bytes = max_coalesce_bytes
+        # (message, is data frame) in arrival order
+        self._queue: Deque[Tuple[dict, bool]] = deque()
+        self._frames = 0
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self._metrics = StreamQueueMetrics()
+
+    def qsize(self) -> int:
+        return len(self._queue)
+
+    def empty(self) -> bool:
+        return not self._queue
+
+    def full(self) -> bool:
+        """True if `maxsize` data frames are queued."""
+        return 0 < self.maxsize <= self._frames
+
+    async def get(self) -> dict:
+        """Remove and return the next message, waiting for one if the queue is empty."""
+        while not self._queue:
+            self._readable.clear()
+            await self._readable.wait()
+        message, is_frame = self._queue.popleft()
+        if is_frame:
+            self._frames -= 1
+            self._writable.set()
+        return message
+
+    def _append(self, message: dict, is_frame: bool):
+        self._queue.append((message, is_frame))
+        if is_frame:
+            self._frames += 1
+        self._readable.set()
+        self._track_depth()
+
+    async def put_frame(self, message: dict):
+        """Queue a data frame according to the overflow policy."""
+        self._metrics.received += 1
+        if self.full():
+            self._metrics.overflowed = True
+            if self.policy is OverflowPolicy.DROP_OLDEST:
+                self._drop_oldest()
+            elif self.policy is OverflowPolicy.COALESCE and self._coalesce(message):
+                return
+            elif self.policy is OverflowPolicy.CLOSE:
+                self._metrics.dropped += 1
+                logger.warning(f"Upstream queue overflow, closing stream: {self!r}")
+                raise StreamQueueOverflow(self.stream_name)
+            else:
+                self._metrics.blocked += 1
+                logger.debug(f"Upstream queue full, blocking: {self!r}")
+        while self.full():
+            self._writable.clear()
+            await self._writable.wait()
+        self._append(message, True)
+
+    def put_control(self, message: dict):
+        """Queue a control message regardless of `maxsize`."""
+        self._append(message, False)
+
+    def _drop_oldest(self):
+        for index, (_, is_frame) in enumerate(self._queue):
+            if is_frame:
+                del self._queue[index]
+                self._frames -= 1
+                self._metrics.dropped += 1
+                return
+        self._metrics.blocked += 1
+
+    def _coalesce(self, message: dict) -> bool:
+        if not self._queue or message.get('bytes') is None:
+            return False
+        last, is_frame = self._queue[-1]
+        if not is_frame or last.get('bytes') is None:
+            return False
+        if len(last['bytes']) + len(message['bytes']) > self.max_coalesce_bytes:
+            return False
+        self._queue[-1] = ({**last, 'bytes': last['bytes'] + message['bytes']}, True)
+        self._metrics.coalesced += 1
+        return True
+
+    def _track_depth(self):
+        depth = self.qsize()
+        if depth > self._metrics.max_depth:
+            self._metrics.max_depth = depth
+
+    def metrics(self) -> dict:
+        self._metrics.depth = self.qsize()
+        return asdict(self._metrics)
+
+    def __repr__(self):
+        return (f"<StreamQueue stream={self.stream_name} policy={self.policy.value} "
+                f"depth={self.qsize()}/{self.maxsize}>")
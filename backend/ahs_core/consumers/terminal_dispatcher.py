@@ -1,16 +1,19 @@
-import asyncio
+import hashlib
 import json
 import os
-import pty
 import signal
 import struct
 import fcntl
 import termios
 
 import logging
-from typing import TypeVar, Mapping
+from typing import TypeVar, Mapping, Iterator, Tuple
+from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels_redis.core import RedisChannelLayer
+from django.conf import settings
+
+from backend.ahs_core.consumers.terminal_session import ScrollbackBuffer, TerminalSession, get_or_start_session
 
 logger = logging.getLogger(__name__)
 
@@ -21,121 +24,199 @@ MsgVar = Mapping
 LIMIT = 2**8
 
 
+# Binary input record header: opcode byte + big endian payload length.
+INPUT_HEADER = struct.Struct('!BH')
+# Payload of a resize record: columns and rows.
+INPUT_RESIZE = struct.Struct('!HH')
+
+OP_DATA = 0
+OP_RESIZE = 1
+OP_SIGNAL = 2
+
+
 def set_winsize(fd, col, row):
     s = struct.pack("HHHH", row, col, 0, 0)
     fcntl.ioctl(fd, termios.TIOCSWINSZ, s)  #
 
 
+def pack_input(opcode: int, payload: bytes = b'') -> bytes:
+    """Wrap ``payload`` into a binary input record of type ``opcode``."""
+    return INPUT_HEADER.pack(opcode, len(payload)) + payload
+
+
+def iter_input(data: bytes) -> Iterator[Tuple[int, memoryview]]:
+    """
+    Iterate over the ``(opcode, payload)`` records of one binary terminal message.
+
+    Records are self-delimiting, so several of them may be sent in one message,
+    e.g. when the demultiplexer coalesced frames.
+
+    Raises:
+        ValueError: If a record is truncated.
+    """
+    view = memoryview(data)
+    offset = 0
+    end = len(view)
+    header_size = INPUT_HEADER.size
+    while offset < end:
+        if end - offset < header_size:
+            raise ValueError("Invalid terminal input record received (truncated header)")
+        opcode, length = INPUT_HEADER.unpack_from(view, offset)
+        offset += header_size
+        if end - offset < length:
+            raise ValueError("Invalid terminal input record received (truncated payload)")
+        yield opcode, view[offset:offset + length]
+        offset += length
+
 
 class AsyncWebsocketTerminal(AsyncWebsocketConsumer):
+    """
+    Websocket consumer attached to a persistent :class:`TerminalSession`.
+
+    Sessions are keyed by the user and the socket url, so a reconnecting client
+    reattaches to its shell and gets the scrollback (`scrollback_size` bytes, mmap
+    backed in `scrollback_dir` if set) replayed. Connecting with `?readonly=1`
+    attaches a viewer which gets the output but can't write to the shell. The shell
+    is hung up `detached_timeout` seconds after the last consumer detached.
+
+    The shell runs behind an :class:`AHSPTYTransport`. The session's single output
+    pump coalesces output arriving within `output_coalesce_interval` seconds into
+    frames of at most `output_buffer_size` bytes and awaits every send. While the
+    websockets are slower than the shell, reading the PTY is paused once
+    `output_high_water` bytes are buffered, so the shell blocks on its writes. Input
+    is written without blocking; while the shell's input buffer is full, receiving
+    waits, which pushes back on the demultiplexer's upstream queue.
+
+    With `AHS_TERMINAL_SHELL_POOL_SOCKET` set, shells are leased from the pre-forked
+    shell pool instead of being forked by the worker.
+
+    Clients connecting with `?input=binary` send binary messages of typed input
+    records (see :func:`pack_input`): data, resize (columns, rows) and signal (one
+    byte, only `allowed_signals`, sent to the shell's foreground process group).
+    Otherwise text messages are input, except for JSON resize messages.
+    """
+    shell = getattr(settings, 'AHS_TERMINAL_SHELL', ['/bin/zsh'])
+    shell_pool = getattr(settings, 'AHS_TERMINAL_SHELL_POOL_SOCKET', None)
+    output_buffer_size = getattr(settings, 'AHS_TERMINAL_OUTPUT_BUFFER_SIZE', 64 * 1024)
+    output_coalesce_interval = getattr(settings, 'AHS_TERMINAL_OUTPUT_COALESCE_INTERVAL', 0.005)
+    output_high_water = getattr(settings, 'AHS_TERMINAL_OUTPUT_HIGH_WATER', 256 * 1024)
+    input_high_water = getattr(settings, 'AHS_TERMINAL_INPUT_HIGH_WATER', 64 * 1024)
+    scrollback_size = getattr(settings, 'AHS_TERMINAL_SCROLLBACK_SIZE', 1024 * 1024)
+    scrollback_dir = getattr(settings, 'AHS_TERMINAL_SCROLLBACK_DIR', None)
+    detached_timeout = getattr(settings, 'AHS_TERMINAL_SESSION_DETACHED_TIMEOUT', 3600)
+    terminate_timeout = getattr(settings, 'AHS_TERMINAL_TERMINATE_TIMEOUT', 5)
+    allowed_signals = frozenset((
+        signal.SIGINT, signal.SIGQUIT, signal.SIGTSTP, signal.SIGCONT, signal.SIGTERM,
+    ))
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.pty_master = None
-        self.pty_slave = None
-        self.process_pid = None
+        self.session: TerminalSession | None = None
+        self.read_only = False
+        self.binary_input = False
+
+    def get_session_key(self) -> str:
+        user_id = getattr(self.scope.get('user'), 'pk', None)
+        socket_url = self.scope.get('url_route', {}).get('kwargs', {}).get('socket_url') or self.channel_name
+        return f"{user_id}:{socket_url}"
+
+    def create_session(self, key: str) -> TerminalSession:
+        scrollback_path = None
+        if self.scrollback_dir:
+            scrollback_path = os.path.join(self.scrollback_dir, f"{hashlib.sha1(key.encode()).hexdigest()}.scrollback")
+        return TerminalSession(
+            key,
+            ScrollbackBuffer(self.scrollback_size, scrollback_path),
+            output_buffer_size=self.output_buffer_size,
+            output_coalesce_interval=self.output_coalesce_interval,
+            detached_timeout=self.detached_timeout,
+            terminate_timeout=self.terminate_timeout,
+        )
 
     async def connect(self):
         """
         Called when the WebSocket connection is established.
-        Set up the PTY and start the subprocess (command/shell).
+        Attach to the user's terminal session, start it (the shell) if necessary.
+        Connections without an authenticated user are refused, their sessions would
+        be shared by every anonymous client of the same `socket_url`.
         """
+        user = self.scope.get('user')
+        if user is None or not user.is_authenticated:
+            logger.warning(f"Refusing terminal of unauthenticated client: {self.scope.get('client')}")
+            await self.close()
+            return
         await self.accept()
         logger.info(f"WebSocket connection accepted: {self.scope['client']}")
-        # Create a pseudo-Terminal
-        self.pty_master, self.pty_slave = pty.openpty()
-
-        # Fork a new process
-        self.process_pid = os.fork()
-        if self.process_pid == 0:  # In child process
-            os.setsid()  # Create a new session ID for the new process
-            os.dup2(self.pty_slave, 0)  # Redirect stdin
-            os.dup2(self.pty_slave, 1)  # Redirect stdout
-            os.dup2(self.pty_slave, 2)  # Redirect stderr
-            os.close(self.pty_slave)
-            os.close(self.pty_master)
-            os.execvp("/bin/zsh", ["/bin/zsh"])  # noqa Replace child process with shell
-
-        else:  # In parent process
-            # Close the slave side in the parent process
-            os.close(self.pty_slave)
-
-            # Add a reader to monitor PTY's master for output
-            loop = asyncio.get_event_loop()
-            loop.add_reader(self.pty_master, self.pty_output_reader)
-
+        query = parse_qs(self.scope.get('query_string', b'').decode())
+        self.read_only = query.get('readonly') == ['1']
+        self.binary_input = query.get('input') == ['binary']
+        key = self.get_session_key()
+        session = await get_or_start_session(
+            key,
+            lambda: self.create_session(key),
+            shell=self.shell,
+            pool=self.shell_pool,
+            output_high_water=self.output_high_water,
+            input_high_water=self.input_high_water,
+        )
+        await session.attach(self, read_only=self.read_only)
+        self.session = session
 
     async def disconnect(self, close_code):
         """
         Called when the WebSocket is disconnected.
-        Cleans up resources like PTY and subprocess.
+        Detaches from the terminal session, the shell keeps running.
         """
-        if self.process_pid:
-            try:
-                # Send SIGTERM for graceful shutdown
-                os.killpg(os.getpgid(self.process_pid), signal.SIGTERM)
-                for _ in range(5):  # Wait up to 5 seconds for termination
-                    _, status = os.waitpid(self.process_pid, os.WNOHANG)
-                    if status != 0:  # Process terminated
-                        logger.info(f"Process group {os.getpgid(self.process_pid)} terminated gracefully.")
-                        break
-                    await asyncio.sleep(1)
-                else:
-                    # Force kill on timeout
-                    os.killpg(os.getpgid(self.process_pid), signal.SIGKILL)
-                    _, status = os.waitpid(self.process_pid, 0)
-                    logger.info(f"Process group {os.getpgid(self.process_pid)} killed forcefully.")
-            except ProcessLookupError:
-                logger.warning("Process group already terminated.")
-
-        # Remove reader and clean up PTY master
-        loop = asyncio.get_event_loop()
-        if self.pty_master:
-            loop.remove_reader(self.pty_master)
-
-            try:
-                # Close the master file descriptor (release resources)
-                os.close(self.pty_master)
-                self.pty_master = None
-                logger.info("PTY master file descriptor closed successfully.")
-            except OSError as e:
-                logger.error(f"Error closing PTY master descriptor: {e}")
+        if self.session is not None:
+            self.session.detach(self)
+            self.session = None
 
     async def websocket_receive(self, data, **kwargs):
         """
         Called when WebSocket receives data.
-        Write data to the PTY (subprocess's stdin).
+        Write data to the PTY (subprocess's stdin), resize or signal it.
         """
-        # if resize
-        logger.debug(f"websocket_receive: {data}")
-        if isinstance(data, dict) and 'bytes' in data:
-            data = data['bytes']
-            os.write(self.pty_master, data)
-
-        else:
-            data = data.get('text', '')
-            if len(data) < 1:
-                return
-            elif len(data) == 1:
-                os.write(self.pty_master, data.encode('utf-8'))
-            elif data.startswith('{') and data.endswith('}'):
-                logger.debug(f"resize: {json.loads(data)}")
-                data = json.loads(data)
-                set_winsize(
-                    self.pty_master,
-                    data['cols'],
-                    data['rows']
-                )
+        session = self.session
+        if session is None or not session.can_write(self):
+            return
+        if data.get('bytes') is not None:
+            if self.binary_input:
+                await self.receive_input(session, data['bytes'])
             else:
-                os.write(self.pty_master, data.encode('utf-8'))
+                await session.write(data['bytes'])
+            return
 
-    def pty_output_reader(self):
-        """
-        Called when the PTY master has data to read.
-        Reads stdout/stderr output and sends it to WebSocket.
-        """
+        data = data.get('text') or ''
+        if data.startswith('{') and data.endswith('}'):
+            try:
+                message = json.loads(data)
+            except ValueError:
+                message = None
+            if isinstance(message, dict) and message.get('type', 'resize') == 'resize':
+                self.resize(session, message.get('cols'), message.get('rows'))
+                return
+        if data:
+            await session.write(data.encode('utf-8'))
+
+    async def receive_input(self, session: TerminalSession, data: bytes):
+        """Handle the typed input records of one binary message."""
         try:
-            output = os.read(self.pty_master, 1024)
-            asyncio.create_task(self.send(bytes_data=output))  # Send data to WebSocket
-        except OSError:
-            # Handle case where the process exits, and PTY is closed
-            pass
+            for opcode, payload in iter_input(data):
+                if opcode == OP_DATA:
+                    await session.write(payload)
+                elif opcode == OP_RESIZE and len(payload) == INPUT_RESIZE.size:
+                    self.resize(session, *INPUT_RESIZE.unpack(payload))
+                elif opcode == OP_SIGNAL and len(payload) == 1 and payload[0] in self.allowed_signals:
+                    session.send_signal(payload[0])
+                else:
+                    logger.warning(f"Ignored terminal input record {opcode} ({len(payload)} bytes)")
+        except ValueError as exc:
+            logger.warning(exc)
+
+    @staticmethod
+    def resize(session: TerminalSession, cols, rows):
+        if not (isinstance(cols, int) and isinstance(rows, int) and 0 < cols < 2**16 and 0 < rows < 2**16):
+            logger.warning(f"Ignored invalid terminal size {cols}x{rows}")
+            return
+        logger.debug(f"resize: {cols}x{rows}")
+        set_winsize(session.transport.get_extra_info('master_fd'), cols, rows)
@@ -0,0 +1,302 @@
+import asyncio
+import logging
+import mmap
+import os
+
+from backend.ahs_core.shell import AHSPTYTransport, create_pty_shell
+
+logger = logging.getLogger(__name__)
+
+
+class ScrollbackBuffer:
+    """
+    Fixed-size ring buffer of a terminal's most recent output.
+
+    Backed by memory, or by an mmap of the file `path` (created and removed by the
+    buffer) to keep large scrollbacks out of the worker's heap.
+    """
+
+    def __init__(self, size: int, path: str | None = None):
+        self.size = size
+        self.path = path
+        self.written = 0
+        if path:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                os.ftruncate(fd, size)
+                self._buffer = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        else:
+            self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+
+    def __len__(self):
+        return min(self.written, self.size)
+
+    def write(self, data: bytes):
+        length = len(data)
+        if length > self.size:
+            # only the tail survives
+            self.written += length - self.size
+            data = memoryview(data)[-self.size:]
+            length = self.size
+        position = self.written % self.size
+        first = min(length, self.size - position)
+        self._view[position:position + first] = data[:first]
+        self._view[:length - first] = data[first:]
+        self.written += length
+
+    def snapshot(self) -> bytes:
+        """Return the buffered output, oldest first."""
+        if self.written <= self.size:
+            return bytes(self._view[:self.written])
+        position = self.written % self.size
+        return bytes(self._view[position:]) + bytes(self._view[:position])
+
+    def close(self):
+        self._view.release()
+        if self.path:
+            self._buffer.close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class TerminalShellProtocol(asyncio.SubprocessProtocol):
+    """
+    Protocol of a terminal's :class:`AHSPTYTransport`.
+
+    Shell output is collected in `output` until the session's pump takes it. Reading
+    the PTY is paused while more than `high_water` bytes wait for the websocket, and
+    resumed once the pump drained the buffer below a quarter of it. `input_ready` is
+    cleared while the shell's input buffer is above its high water mark.
+    """
+
+    def __init__(self, high_water: int):
+        self.transport = None
+        self.high_water = high_water
+        self.output = bytearray()
+        self.output_ready = asyncio.Event()
+        self.input_ready = asyncio.Event()
+        self.input_ready.set()
+        self.reading_paused = False
+        self.eof = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def pipe_data_received(self, fd, data):
+        self.output += data
+        self.output_ready.set()
+        if not self.reading_paused and len(self.output) > self.high_water:
+            self.reading_paused = True
+            self.transport.pause_reading()
+
+    def take_output(self, size: int) -> bytes:
+        """Remove and return up to `size` bytes of output."""
+        data = bytes(self.output[:size])
+        del self.output[:size]
+        if not self.output and not self.eof:
+            self.output_ready.clear()
+        if self.reading_paused and len(self.output) <= self.high_water // 4:
+            self.reading_paused = False
+            self.transport.resume_reading()
+        return data
+
+    def pipe_connection_lost(self, fd, exc):
+        if fd == 1:
+            self.eof = True
+            self.output_ready.set()
+
+    def pause_writing(self):
+        self.input_ready.clear()
+
+    def resume_writing(self):
+        self.input_ready.set()
+
+    def connection_lost(self, exc):
+        self.eof = True
+        self.output_ready.set()
+        self.input_ready.set()
+
+
+class TerminalSession:
+    """
+    A shell which outlives the websocket connections attached to it, like a tmux session.
+
+    A single pump reads the shell's output, appends it to the scrollback and forwards
+    it to every attached consumer. Attaching replays the scrollback first. Read-only
+    viewers get the output but can't write to the shell. Once the last consumer
+    detached, the shell is kept for `detached_timeout` seconds (0 = closed right away).
+
+    Sessions live in the worker process which started the shell.
+    """
+
+    def __init__(
+            self,
+            key: str,
+            scrollback: ScrollbackBuffer,
+            output_buffer_size: int,
+            output_coalesce_interval: float,
+            detached_timeout: float,
+            terminate_timeout: float,
+    ):
+        self.key = key
+        self.scrollback = scrollback
+        self.output_buffer_size = output_buffer_size
+        self.output_coalesce_interval = output_coalesce_interval
+        self.detached_timeout = detached_timeout
+        self.terminate_timeout = terminate_timeout
+        self.transport: AHSPTYTransport | None = None
+        self.protocol: TerminalShellProtocol | None = None
+        self.clients = {}
+        self.closed = False
+        self._lock = asyncio.Lock()
+        self._pump = None
+        self._detached_handle = None
+        self._input = bytearray()
+        self._input_handle = None
+
+    def __repr__(self):
+        return f"<TerminalSession {self.key} clients={len(self.clients)} scrollback={len(self.scrollback)}>"
+
+    async def start(self, shell: list[str], pool: str | None, output_high_water: int, input_high_water: int):
+        self.transport, self.protocol = await create_pty_shell(
+            lambda: TerminalShellProtocol(output_high_water),
+            shell,
+            pool=pool,
+            write_high_water=input_high_water,
+        )
+        self._pump = asyncio.get_running_loop().create_task(self.pump_output())
+
+    async def attach(self, consumer, read_only: bool = False):
+        """Replay the scrollback to `consumer` and forward the shell's output to it."""
+        if self._detached_handle is not None:
+            self._detached_handle.cancel()
+            self._detached_handle = None
+        async with self._lock:
+            snapshot = self.scrollback.snapshot()
+            if snapshot:
+                await consumer.send(bytes_data=snapshot)
+            self.clients[consumer] = read_only
+        logger.debug(f"Attached {'viewer' if read_only else 'client'} to {self!r}")
+
+    def detach(self, consumer):
+        self.clients.pop(consumer, None)
+        if self.clients or self.closed:
+            return
+        loop = asyncio.get_running_loop()
+        if self.detached_timeout:
+            self._detached_handle = loop.call_later(
+                self.detached_timeout, lambda: loop.create_task(self.close()))
+        else:
+            loop.create_task(self.close())
+
+    def can_write(self, consumer) -> bool:
+        return self.clients.get(consumer) is False
+
+    async def write(self, data: bytes):
+        """
+        Queues `data` for the shell's input, waits while the shell's input buffer is full.
+
+        Input received within one loop iteration is handed to the transport as a
+        single write, which writes what the PTY accepts and buffers the rest.
+        """
+        await self.protocol.input_ready.wait()
+        if self.transport.is_closing():
+            return
+        self._input += data
+        if self._input_handle is None:
+            self._input_handle = asyncio.get_running_loop().call_soon(self._flush_input)
+
+    def _flush_input(self):
+        self._input_handle = None
+        data, self._input = self._input, bytearray()
+        if data and not self.transport.is_closing():
+            self.transport.write(data)
+
+    def send_signal(self, sig: int):
+        """Signal the shell's foreground process group, like the terminal driver would."""
+        master_fd = self.transport.get_extra_info('master_fd')
+        try:
+            os.killpg(os.tcgetpgrp(master_fd), sig)
+        except OSError as exc:
+            logger.debug(f"Signal {sig} not delivered to {self!r}: {exc}")
+
+    async def pump_output(self):
+        """
+        Forwards the shell's output to the scrollback and the attached consumers until
+        the shell closes the PTY.
+        """
+        protocol = self.protocol
+        while True:
+            await protocol.output_ready.wait()
+            if len(protocol.output) < self.output_buffer_size and not protocol.eof:
+                # give the shell a moment to produce more output for the same frame
+                await asyncio.sleep(self.output_coalesce_interval)
+            data = protocol.take_output(self.output_buffer_size)
+            if data:
+                async with self._lock:
+                    self.scrollback.write(data)
+                    await asyncio.gather(
+                        *(client.send(bytes_data=data) for client in self.clients),
+                        return_exceptions=True,
+                    )
+            elif protocol.eof:
+                break
+        logger.info(f"PTY of process {self.transport.get_pid()} closed")
+        clients, self.clients = list(self.clients), {}
+        for client in clients:
+            await client.close()
+        asyncio.get_running_loop().create_task(self.close())
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._input_handle is not None:
+            self._input_handle.cancel()
+            self._input_handle = None
+        if _sessions.get(self.key) is self:
+            del _sessions[self.key]
+        if self._pump is not None and self._pump is not asyncio.current_task():
+            self._pump.cancel()
+            await asyncio.gather(self._pump, return_exceptions=True)
+        if self.transport is not None:
+            returncode = await self.transport.aclose(self.terminate_timeout)
+            logger.info(f"Shell process {self.transport.get_pid()} exited with {returncode}")
+        self.scrollback.close()
+
+
+# Terminal sessions of this worker process, keyed by owner and socket url.
+_sessions: dict[str, TerminalSession] = {}
+_starting: dict[str, asyncio.Task] = {}
+
+
+async def get_or_start_session(key: str, session_factory, **start_kwargs) -> TerminalSession:
+    """
+    Return the running session `key`, or start a new one with `session_factory()`.
+    Concurrent calls for the same key share one session.
+    """
+    session = _sessions.get(key)
+    if session is not None and not session.closed:
+        return session
+    starting = _starting.get(key)
+    if starting is None:
+        session = session_factory()
+
+        async def start():
+            try:
+                await session.start(**start_kwargs)
+            except BaseException:
+                session.scrollback.close()
+                raise
+            finally:
+                del _starting[key]
+            _sessions[key] = session
+            return session
+
+        starting = _starting[key] = asyncio.get_running_loop().create_task(start())
+    return await asyncio.shield(starting)
@@ -0,0 +1,138 @@
+"""
+Dedicated executors for the blocking crypto behind the async helpers of
+:mod:`backend.ahs_core.ecc` and :mod:`backend.ahs_auth.webauthn`.
+
+`sync_to_async` runs on the worker's single thread-sensitive executor, so one
+500,000 iteration PBKDF2 held up every other sync call of the worker. Crypto runs
+on two pools of its own instead, configured by `AHS_CRYPTO_EXECUTOR`:
+
+- ``kdf``: password based key derivations, a process pool by default. Functions
+  and arguments cross a process boundary, so they take and return ints and bytes,
+  never key objects.
+- ``crypto``: short signs, verifies, ECDH and key conversions, a thread pool.
+
+Each pool counts its calls in flight, :func:`stats` reports them with the queue
+depth (calls waiting for a worker) and its peak.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Literal
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class CryptoPool:
+    def __init__(
+            self,
+            name: str,
+            kind: Literal['process', 'thread'] = 'thread',
+            max_workers: int = None,
+            start_method: str = 'forkserver',
+    ):
+        if kind not in ('process', 'thread'):
+            raise ValueError(f"Unsupported executor kind '{kind}' of crypto pool '{name}'")
+        self.name = name
+        self.kind = kind
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.start_method = start_method
+        self.submitted = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.total_time = 0.0
+        self._executor: Executor | None = None
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == 'process':
+                self._executor = ProcessPoolExecutor(
+                    self.max_workers,
+                    mp_context=multiprocessing.get_context(self.start_method),
+                )
+            else:
+                self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix=f'ahs-{self.name}')
+        return self._executor
+
+    @property
+    def queue_depth(self) -> int:
+        return max(self.in_flight - self.max_workers, 0)
+
+    async def run(self, func: Callable, *args):
+        """Run `func(*args)` on the pool."""
+        self.submitted += 1
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        start = time.monotonic()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        except BaseException as exc:
+            self.failed += 1
+            if isinstance(exc, BrokenProcessPool):
+                # a worker died, the next call starts a new pool
+                logger.error(f"Crypto pool '{self.name}' broke, restarting it")
+                self.shutdown(wait=False)
+            raise
+        finally:
+            self.in_flight -= 1
+            self.total_time += time.monotonic() - start
+
+    def stats(self) -> dict:
+        completed = self.submitted - self.in_flight
+        return {
+            'name': self.name,
+            'kind': self.kind,
+            'workers': self.max_workers,
+            'in_flight': self.in_flight,
+            'queue_depth': self.queue_depth,
+            'peak_in_flight': self.peak_in_flight,
+            'submitted': self.submitted,
+            'failed': self.failed,
+            'avg_time': self.total_time / completed if completed else 0.0,
+        }
+
+    def shutdown(self, wait: bool = True):
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+_config = getattr(settings, 'AHS_CRYPTO_EXECUTOR', {})
+
+kdf_pool = CryptoPool(
+    'kdf',
+    kind=_config.get('kdf', 'process'),
+    max_workers=_config.get('kdf_workers'),
+    start_method=_config.get('start_method', 'forkserver'),
+)
+crypto_pool = CryptoPool(
+    'crypto',
+    kind=_config.get('crypto', 'thread'),
+    max_workers=_config.get('crypto_workers'),
+)
+
+
+async def run_kdf(func: Callable, *args):
+    """Run a key derivation on the ``kdf`` pool, `func` and `args` must be picklable."""
+    return await kdf_pool.run(func, *args)
+
+
+async def run_crypto(func: Callable, *args):
+    """Run a short crypto operation on the ``crypto`` pool."""
+    return await crypto_pool.run(func, *args)
+
+
+def stats() -> list[dict]:
+    return [kdf_pool.stats(), crypto_pool.stats()]
+
+
+def shutdown(wait: bool = True):
+    kdf_pool.shutdown(wait)
+    crypto_pool.shutdown(wait)
@@ -1,14 +1,19 @@
+import asyncio
 import base64
+import hashlib
+import logging
 import os
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
-from typing import Literal
+from typing import Iterable, Literal
 
 import magic
 
-from concurrent.futures import ThreadPoolExecutor
 from os import urandom
 
-from asgiref.sync import sync_to_async
+from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric.dh import DHPublicKey
 from cryptography.hazmat.primitives.asymmetric.dsa import DSAPublicKey
@@ -19,9 +24,7 @@ from cryptography.hazmat.primitives.asymmetric.ed448 import Ed448PublicKey
 from cryptography.hazmat.primitives.asymmetric.rsa import RSAPublicKey
 from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PublicKey
 from cryptography.hazmat.primitives.asymmetric.x448 import X448PublicKey
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-from cryptography.hazmat.primitives.ciphers.algorithms import AES
-from cryptography.hazmat.primitives.ciphers.modes import GCM
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.serialization import Encoding
 from cryptography.hazmat.primitives.asymmetric import ec
@@ -30,15 +33,25 @@ from cryptography.hazmat.primitives.hashes import SHA256, SHA512
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives import hashes
 
+from django.dispatch import Signal
 from django.utils.encoding import force_bytes
-from django.utils.functional import classproperty, SimpleLazyObject
+from django.utils.functional import classproperty
 from django.conf import settings
 
+from backend.ahs_core.crypto_executor import run_crypto, run_kdf
+from backend.ahs_core.keystore import load_or_create_private_key, rotate_private_key
+
+logger = logging.getLogger(__name__)
+
 mime = magic.Magic(mime=True)
-executor = ThreadPoolExecutor()
 
 ROOT_PRIVKEY_PATH = os.getenv("ROOT_PRIVKEY_PATH", 'root.private.key')
 
+# Sent with the new `private_key` after ECC.rotate_root_key() replaced the root key.
+root_key_rotated = Signal()
+
+GCM_NONCE_SIZE = 12
+
 
 
 def get_curve_order(curve):
@@ -182,47 +195,109 @@ def deserialize_private_key_from_der(private_key_der, password: str | bytes = No
     return serialization.load_der_private_key(private_key_der, password=password)
 
 
-def encrypt(data,private_key, public_key):
+class SessionKeyCache:
+    """
+    Bounded TTL cache of the AES-GCM keys derived (ECDH + HKDF) for a pair of keys.
+
+    Keyed by the pair's public points, so encrypting many messages for the same peer
+    pays the elliptic-curve math once per `ttl` seconds. Used from the crypto pool's
+    threads, hence the lock. Cleared when the root key is rotated.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._keys: "OrderedDict[tuple[bytes, bytes], tuple[float, AESGCM]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    @staticmethod
+    def _point(public_key: ec.EllipticCurvePublicKey) -> bytes:
+        return public_key.public_bytes(Encoding.X962, serialization.PublicFormat.CompressedPoint)
+
+    def get(self, private_key: ec.EllipticCurvePrivateKey, public_key: ec.EllipticCurvePublicKey) -> AESGCM:
+        cache_key = (self._point(private_key.public_key()), self._point(public_key))
+        now = time.monotonic()
+        with self._lock:
+            entry = self._keys.get(cache_key)
+            if entry is not None and entry[0] > now:
+                self._keys.move_to_end(cache_key)
+                return entry[1]
+        aesgcm = AESGCM(derive_session_key(private_key, public_key))
+        if self.maxsize:
+            with self._lock:
+                self._keys[cache_key] = (now + self.ttl, aesgcm)
+                self._keys.move_to_end(cache_key)
+                while len(self._keys) > self.maxsize:
+                    self._keys.popitem(last=False)
+        return aesgcm
+
+    def clear(self, **kwargs):
+        with self._lock:
+            self._keys.clear()
+
+
+def derive_session_key(private_key: ec.EllipticCurvePrivateKey, public_key: ec.EllipticCurvePublicKey) -> bytes:
     # Generate shared key using private and public keys
     shared_key = private_key.exchange(ec.ECDH(), public_key)
 
     # Derive symmetric key (AES key with HKDF)
-    aes_key = HKDF(
+    return HKDF(
             algorithm=hashes.SHA256(),
             length=32,
             salt=None,
             info=b"session_key",
     ).derive(shared_key)
 
-    # Encrypt the session data using AES
-    iv = urandom(16)
-    cipher = Cipher(algorithms.AES(aes_key), modes.GCM(iv))
-    encryptor = cipher.encryptor()
-    ciphertext = encryptor.update(data.encode()) + encryptor.finalize()
-    return base64.b64encode(iv + ciphertext).decode("ascii")
 
+_session_key_config = getattr(settings, 'AHS_ECDH_KEY_CACHE', {})
+session_keys = SessionKeyCache(
+    maxsize=_session_key_config.get('maxsize', 1024),
+    ttl=_session_key_config.get('ttl', 300),
+)
+root_key_rotated.connect(session_keys.clear, weak=False)
 
-def decrypt(encrypted_data, private_key, public_key):
-    # Decode the data
+
+def _encrypt(aesgcm: AESGCM, data) -> str:
+    nonce = urandom(GCM_NONCE_SIZE)
+    return base64.b64encode(nonce + aesgcm.encrypt(nonce, force_bytes(data), None)).decode("ascii")
+
+
+def _decrypt(aesgcm: AESGCM, encrypted_data) -> str:
     encrypted_data = base64.b64decode(encrypted_data)
-    iv = encrypted_data[:16]
-    ciphertext = encrypted_data[16:]
+    return aesgcm.decrypt(encrypted_data[:GCM_NONCE_SIZE], encrypted_data[GCM_NONCE_SIZE:], None).decode("utf-8")
 
-    # Generate shared key using both keys
-    shared_key = private_key.exchange(ec.ECDH(), public_key)
 
-    # Derive AES key from shared key using HKDF
-    aes_key = HKDF(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=None,
-            info=b"session_key",
-    ).derive(shared_key)
+def encrypt(data, private_key, public_key):
+    """
+    Encrypt `data` with AES-GCM under the ECDH key of `private_key` and the peer's
+    `public_key`. Returns base64(nonce | ciphertext | tag).
+    """
+    return _encrypt(session_keys.get(private_key, public_key), data)
 
-    # Decrypt using AES
-    cipher = Cipher(AES(aes_key), GCM(iv))
-    decryptor = cipher.decryptor()
-    return decryptor.update(ciphertext).decode('ascii') + decryptor.finalize().decode("utf-8")
+
+def decrypt(encrypted_data, private_key, public_key):
+    """
+    Decrypt the output of :func:`encrypt`.
+
+    Raises:
+        cryptography.exceptions.InvalidTag: If the data was tampered with or the keys don't match.
+    """
+    return _decrypt(session_keys.get(private_key, public_key), encrypted_data)
+
+
+def encrypt_many(items, private_key, public_key) -> list[str]:
+    """:func:`encrypt` several messages for the same peer, deriving the key once."""
+    aesgcm = session_keys.get(private_key, public_key)
+    return [_encrypt(aesgcm, data) for data in items]
+
+
+def decrypt_many(items, private_key, public_key) -> list[str]:
+    """:func:`decrypt` several messages of the same peer, deriving the key once."""
+    aesgcm = session_keys.get(private_key, public_key)
+    return [_decrypt(aesgcm, encrypted_data) for encrypted_data in items]
 
 
 def derive_subkey(private_key: EllipticCurvePrivateNumbers, index: int, curve=ec.SECP521R1()) -> ec.EllipticCurvePrivateKey | None:
@@ -263,6 +338,112 @@ def derive_subkey(private_key: EllipticCurvePrivateNumbers, index: int, curve=ec
     return ec.derive_private_key(derived_key_int, ec.SECP521R1())
 
 
+class SubkeyRegistry:
+    """
+    Memoized :func:`derive_subkey`, keyed by the parent key's fingerprint (SHA-256
+    of its compressed public point) and the subkey index.
+
+    The first `precompute` subkeys of the root key are derived in the background
+    when the worker starts (ASGI lifespan, see :mod:`backend.ahs_core.lifespan`).
+    Rotating the root key clears the registry.
+    """
+
+    def __init__(self, maxsize: int = 1024, precompute: int = 0):
+        self.maxsize = maxsize
+        self.precompute = precompute
+        self._subkeys: "OrderedDict[tuple[bytes, int], ec.EllipticCurvePrivateKey]" = OrderedDict()
+        # fingerprints of recent parents by id(), holding the parent so the id isn't reused
+        self._parents: "OrderedDict[int, tuple[ec.EllipticCurvePrivateKey, bytes]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._task = None
+
+    def __len__(self):
+        return len(self._subkeys)
+
+    def fingerprint(self, private_key: ec.EllipticCurvePrivateKey) -> bytes:
+        parent = self._parents.get(id(private_key))
+        if parent is not None and parent[0] is private_key:
+            return parent[1]
+        fingerprint = hashlib.sha256(private_key.public_key().public_bytes(
+            Encoding.X962, serialization.PublicFormat.CompressedPoint)).digest()
+        with self._lock:
+            self._parents[id(private_key)] = (private_key, fingerprint)
+            while len(self._parents) > 16:
+                self._parents.popitem(last=False)
+        return fingerprint
+
+    def get_cached(self, private_key: ec.EllipticCurvePrivateKey, index: int) -> ec.EllipticCurvePrivateKey | None:
+        cache_key = (self.fingerprint(private_key), index)
+        with self._lock:
+            subkey = self._subkeys.get(cache_key)
+            if subkey is not None:
+                self._subkeys.move_to_end(cache_key)
+            return subkey
+
+    def get(self, private_key: ec.EllipticCurvePrivateKey, index: int) -> ec.EllipticCurvePrivateKey:
+        subkey = self.get_cached(private_key, index)
+        if subkey is not None:
+            return subkey
+        subkey = derive_subkey(private_key.private_numbers(), index)
+        if self.maxsize:
+            cache_key = (self.fingerprint(private_key), index)
+            with self._lock:
+                self._subkeys[cache_key] = subkey
+                self._subkeys.move_to_end(cache_key)
+                while len(self._subkeys) > self.maxsize:
+                    self._subkeys.popitem(last=False)
+        return subkey
+
+    async def aget(self, private_key: ec.EllipticCurvePrivateKey, index: int) -> ec.EllipticCurvePrivateKey:
+        subkey = self.get_cached(private_key, index)
+        if subkey is not None:
+            return subkey
+        return await run_crypto(self.get, private_key, index)
+
+    def precompute_root(self, count: int):
+        """Derive the first `count` subkeys of the root key (loading it if needed)."""
+        root_private_key = ECC.root_private_key
+        for index in range(min(count, self.maxsize)):
+            self.get(root_private_key, index)
+
+    async def aprecompute_root(self, count: int):
+        try:
+            await run_crypto(self.precompute_root, count)
+        except Exception as exc:
+            logger.exception(f"Precomputing {count} root subkeys failed: {exc}")
+
+    def ensure_precomputed(self):
+        """
+        Start :meth:`aprecompute_root` on the running loop, once per root key. Runs
+        again if the previous task got cancelled or its loop went away unfinished.
+        """
+        if not self.precompute:
+            return
+        loop = asyncio.get_running_loop()
+        task = self._task
+        if task is None or task.cancelled() or (not task.done() and task.get_loop() is not loop):
+            self._task = loop.create_task(self.aprecompute_root(self.precompute))
+
+    def stop(self):
+        task, self._task = self._task, None
+        if task is not None and not task.done():
+            task.cancel()
+
+    def clear(self, **kwargs):
+        with self._lock:
+            self._subkeys.clear()
+            self._parents.clear()
+        self._task = None
+
+
+_subkey_config = getattr(settings, 'AHS_ECC_SUBKEYS', {})
+subkeys = SubkeyRegistry(
+    maxsize=_subkey_config.get('maxsize', 1024),
+    precompute=_subkey_config.get('precompute', 0),
+)
+root_key_rotated.connect(subkeys.clear, weak=False)
+
+
 def get_root_private_key(password: str) -> ec.EllipticCurvePrivateKey | None:
     if password is None:
         raise ValueError("Password is required.")
@@ -272,58 +453,61 @@ def get_root_private_key(password: str) -> ec.EllipticCurvePrivateKey | None:
 
 
 async def agenerate_private_key() -> ec.EllipticCurvePrivateKey:
-    async_func = sync_to_async(generate_private_key)
-    return await async_func()
+    return await run_crypto(generate_private_key)
 
 
 async def agenerate_public_key(private_key: ec.EllipticCurvePrivateKey) -> ec.EllipticCurvePublicKey:
-    return await sync_to_async(generate_public_key)(private_key)
+    return await run_crypto(generate_public_key, private_key)
 
 
 async def aload_public_key_from_file(file_path: os.PathLike):
-    return await sync_to_async(load_public_key_from_file)(file_path)
+    return await run_crypto(load_public_key_from_file, file_path)
 
 
 async def aload_private_key_from_file(path: os.PathLike, password: str | bytes) -> ec.EllipticCurvePrivateKey:
-    return await sync_to_async(load_private_key_from_file)(path, password)
+    return await run_crypto(load_private_key_from_file, path, password)
 
 
 async def asave_private_key_to_file(private_key: ec.EllipticCurvePrivateKey, path: os.PathLike, password: bytes = None):
-    return await sync_to_async(save_private_key_to_file)(private_key, path, password)
+    return await run_crypto(save_private_key_to_file, private_key, path, password)
 
 
 async def asave_public_key_to_file(public_key: ec.EllipticCurvePublicKey, path: os.PathLike):
-    return await sync_to_async(save_public_key_to_file)(public_key, path)
+    return await run_crypto(save_public_key_to_file, public_key, path)
 
 
 async def acreate_ecc_keypair():
-    return await sync_to_async(create_ecc_keypair)()
+    return await run_crypto(create_ecc_keypair)
 
 
 async def aserialize_public_key_to_pem(public_key):
-    return await sync_to_async(serialize_public_key_to_pem)(public_key)
+    return await run_crypto(serialize_public_key_to_pem, public_key)
 
 
 async def aencrypt(data, private_key, public_key):
-    return await sync_to_async(encrypt)(data, private_key, public_key)
+    return await run_crypto(encrypt, data, private_key, public_key)
 
 
 async def adecrypt(encrypted_data, private_key, public_key):
-    return await sync_to_async(decrypt)(encrypted_data,private_key, public_key)
+    return await run_crypto(decrypt, encrypted_data,private_key, public_key)
+
+
+async def aencrypt_many(items, private_key, public_key) -> list[str]:
+    return await run_crypto(encrypt_many, items, private_key, public_key)
+
+
+async def adecrypt_many(items, private_key, public_key) -> list[str]:
+    return await run_crypto(decrypt_many, items, private_key, public_key)
 
 
 async def aderive_subkey(master_private_key: ec.EllipticCurvePrivateKey, index: int):
-    return await sync_to_async(derive_subkey)(master_private_key.private_numbers(), index, ec.SECP521R1())
+    return await subkeys.aget(master_private_key, index)
 
 
-def derive_key_from_string(input_string, salt, iterations: int = 500000) -> ec.EllipticCurvePrivateKey:
+def derive_private_value_from_string(input_string, salt, iterations: int = 500000) -> int:
     """
-    Derive an EllipticCurvePrivateKey from a passphrase and salt.
-
-    :param input_string: The passphrase to generate the key deterministically.
-    :param salt: A unique cryptographically secure salt (16 bytes minimum recommended).
-    :param iterations: The number of iterations for the key derivation function.
-    :return: An EllipticCurvePrivateKey instance derived from the string.
+    The private value of :func:`derive_key_from_string`. Takes and returns plain
+    values, so it can run on the process pool of :func:`aderive_key_from_string`.
     """
     if len(salt) < 16:
         raise ValueError("Salt must be at least 16 bytes.")
@@ -345,17 +529,29 @@ def derive_key_from_string(input_string, salt, iterations: int = 500000) -> ec.E
     # Convert the derived bytes into an integer to match EC private key requirements
     private_key_int = int.from_bytes(private_key_bytes, byteorder="big")
 
-    # Generate an EllipticCurvePrivateKey from the derived bytes, ensuring its valid
-    private_key = ec.derive_private_key(
-        private_key_int % ec.SECP521R1().key_size,  # Ensure the private key is within the curve's range
+    # Ensure the private key is within the curve's range
+    return private_key_int % (get_curve_order(ec.SECP521R1()) - 1) + 1
+
+
+def derive_key_from_string(input_string, salt, iterations: int = 500000) -> ec.EllipticCurvePrivateKey:
+    """
+    Derive an EllipticCurvePrivateKey from a passphrase and salt.
+
+    :param input_string: The passphrase to generate the key deterministically.
+    :param salt: A unique cryptographically secure salt (16 bytes minimum recommended).
+    :param iterations: The number of iterations for the key derivation function.
+    :return: An EllipticCurvePrivateKey instance derived from the string.
+    """
+    return ec.derive_private_key(
+        derive_private_value_from_string(input_string, salt, iterations),
         curve=ec.SECP521R1(),
         backend=default_backend()
     )
 
-    return private_key
-
 async def aderive_key_from_string(input_string: str, salt: bytes, iterations: int = 100000) -> ec.EllipticCurvePrivateKey:
-    return await sync_to_async(derive_key_from_string)(input_string, salt, iterations)
+    private_value = await run_kdf(
+        derive_private_value_from_string, force_bytes(input_string), force_bytes(salt), iterations)
+    return await run_crypto(ec.derive_private_key, private_value, ec.SECP521R1())
 
 
 def convert(
@@ -417,8 +613,53 @@ async def aconvert(
         key: ec.EllipticCurvePrivateKey | ec.EllipticCurvePublicKey | str | bytes | int | os.PathLike,
         convert_to: Literal['pem', 'der', 'x962', 'int'] = "bytes"
 ):
-    return await sync_to_async(convert)(key, convert_to)
+    return await run_crypto(convert, key, convert_to)
+
+
+
+class VerifiedSignatureCache:
+    """
+    Bounded LRU of (data hash, signature) pairs that verified against the root key.
+
+    Filled and read from the crypto pool's threads, hence the lock. Cleared when the
+    root key is rotated.
+    """
 
+    def __init__(self, maxsize: int = 4096):
+        self.maxsize = maxsize
+        self._signatures: "OrderedDict[bytes, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._signatures)
+
+    @staticmethod
+    def key(data: bytes, signature: bytes) -> bytes:
+        return hashlib.sha256(data).digest() + signature
+
+    def __contains__(self, key: bytes) -> bool:
+        with self._lock:
+            if key not in self._signatures:
+                return False
+            self._signatures.move_to_end(key)
+            return True
+
+    def add(self, key: bytes):
+        if not self.maxsize:
+            return
+        with self._lock:
+            self._signatures[key] = None
+            self._signatures.move_to_end(key)
+            while len(self._signatures) > self.maxsize:
+                self._signatures.popitem(last=False)
+
+    def clear(self, **kwargs):
+        with self._lock:
+            self._signatures.clear()
+
+
+verified_signatures = VerifiedSignatureCache(getattr(settings, 'AHS_ECC_SIGNATURE_CACHE_SIZE', 4096))
+root_key_rotated.connect(verified_signatures.clear, weak=False)
 
 
 class ECC:
@@ -442,27 +683,86 @@ class ECC:
             cls._load_keys()
         return cls._root_public_key
 
+    @staticmethod
+    def derive_root_key() -> ec.EllipticCurvePrivateKey:
+        return derive_key_from_string(settings.RUNTIME_SECRET_KEY, settings.SECRET_KEY.encode())
+
     @classmethod
     def _load_keys(cls):
-        cls._root_private_key = SimpleLazyObject(lambda: derive_key_from_string(settings.RUNTIME_SECRET_KEY, settings.SECRET_KEY.encode()))  # noqa
+        # derived once and sealed to the keystore, later loads take microseconds
+        cls._root_private_key = load_or_create_private_key(cls.derive_root_key)
         cls._root_public_key = cls._root_private_key.public_key()
 
+    @classmethod
+    def rotate_root_key(cls) -> ec.EllipticCurvePrivateKey:
+        """
+        Derive a new root key and seal it to the keystore. Other workers pick it up
+        when they are restarted.
+        """
+        cls._root_private_key = rotate_private_key(cls.derive_root_key)
+        cls._root_public_key = cls._root_private_key.public_key()
+        root_key_rotated.send(sender=cls, private_key=cls._root_private_key)
+        return cls._root_private_key
+
     @classmethod
     def sign(cls, data):
-        return cls._root_private_key.sign(data, cls.default_sign_algorithm)
+        return cls.root_private_key.sign(data, cls.default_sign_algorithm)
 
     @classmethod
     async def asign(cls, data):
-        return await sync_to_async(cls.sign)(data)
+        return await run_crypto(cls.sign, data)
 
     @classmethod
     def verify(cls, data, signature):
-        return cls._root_public_key.verify(signature, data, cls.default_sign_algorithm)
+        return cls.root_public_key.verify(signature, data, cls.default_sign_algorithm)
 
     @classmethod
     async def averify(cls, data, signature):
-        return await sync_to_async(cls.verify)(signature, data)
+        return await run_crypto(cls.verify, data, signature)
+
+    @classmethod
+    def verify_many(cls, items: Iterable[tuple[bytes, bytes]]) -> list[bool]:
+        """
+        Verify (data, signature) pairs against the root key. Unlike :meth:`verify`,
+        invalid signatures don't raise, the result holds one bool per pair.
+        Pairs verified before are answered from :data:`verified_signatures`.
+        """
+        public_key = cls.root_public_key
+        results = []
+        for data, signature in items:
+            key = verified_signatures.key(data, signature)
+            if key in verified_signatures:
+                results.append(True)
+                continue
+            try:
+                public_key.verify(signature, data, cls.default_sign_algorithm)
+            except InvalidSignature:
+                results.append(False)
+                continue
+            verified_signatures.add(key)
+            results.append(True)
+        return results
+
+    @classmethod
+    async def averify_many(cls, items: Iterable[tuple[bytes, bytes]]) -> list[bool]:
+        """:meth:`verify_many` in one hop to the crypto pool, none if all pairs are cached."""
+        items = list(items)
+        if all(verified_signatures.key(data, signature) in verified_signatures for data, signature in items):
+            return [True] * len(items)
+        return await run_crypto(cls.verify_many, items)
+
+    @classmethod
+    def get_subkey(cls, index: int) -> ec.EllipticCurvePrivateKey:
+        """The `index`-th subkey of the root key, see :class:`SubkeyRegistry`."""
+        return subkeys.get(cls.root_private_key, index)
+
+    @classmethod
+    async def aget_subkey(cls, index: int) -> ec.EllipticCurvePrivateKey:
+        if cls._root_private_key is None:
+            # loading the root key may derive it
+            return await run_crypto(cls.get_subkey, index)
+        return await subkeys.aget(cls._root_private_key, index)
 
     @classmethod
     def get_shared_secret(cls, client_public_key: EllipticCurvePublicKey):
-        return cls._root_private_key.exchange(ec.ECDH(), client_public_key).decode('ascii')
+        return cls.root_private_key.exchange(ec.ECDH(), client_public_key).decode('ascii')
@@ -1,8 +1,8 @@
+import math
 
 from asgiref.sync import sync_to_async
 from django.contrib.sessions.backends.base import UpdateError, CreateError
 from django.db import DatabaseError, IntegrityError, transaction, router
-from django.utils import timezone
 
 from django.utils.functional import cached_property
 
@@ -122,12 +122,12 @@ class SessionStore(DBSessionStore):
 
     @classmethod
     def clear_expired(cls):
-        cls.get_model_class().objects.filter(expire_date__lt=timezone.now()).delete()
+        from backend.ahs_core.session_sweeper import session_sweeper
+        session_sweeper.tick(time_budget=math.inf)
 
     @classmethod
     async def aclear_expired(cls):
-        await cls.get_model_class().objects.filter(
-            expire_date__lt=timezone.now()
-        ).adelete()
+        from backend.ahs_core.session_sweeper import session_sweeper
+        await session_sweeper.atick(time_budget=math.inf)
 
 
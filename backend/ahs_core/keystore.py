@@ -0,0 +1,128 @@
+"""
+Sealed local keystore of the ECC root key.
+
+Deriving the root key (:func:`backend.ahs_core.ecc.derive_key_from_string`, 500,000
+PBKDF2 iterations) takes seconds, so it only happens on rotation. The derived key is
+sealed into `AHS_ROOT_KEYSTORE_PATH` (mode 0600) and every worker start just loads it:
+
+    MAGIC | nonce (12 bytes) | AES-256-GCM(PKCS8 DER of the private key)
+
+The sealing key is derived from `SECRET_KEY` with HKDF, so the keystore is useless
+without the settings. Its directory is created (mode 0700) if needed, by default
+``$XDG_STATE_HOME/ahs`` outside the source tree. Workers starting at the same time with no keystore serialize
+on a lock file, the first one derives, the others load its result.
+"""
+import fcntl
+import os
+from contextlib import contextmanager
+from typing import Callable
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.hashes import SHA256
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from django.conf import settings
+from django.utils.encoding import force_bytes
+
+MAGIC = b'AHSK\x01'
+NONCE_SIZE = 12
+
+
+class KeystoreError(ValueError):
+    pass
+
+
+def default_keystore_path() -> str:
+    state_home = os.environ.get('XDG_STATE_HOME') or os.path.join(os.path.expanduser('~'), '.local', 'state')
+    return os.path.join(state_home, 'ahs', 'root.keystore')
+
+
+def get_keystore_path() -> str:
+    return os.fspath(getattr(settings, 'AHS_ROOT_KEYSTORE_PATH', None) or default_keystore_path())
+
+
+def _sealing_key() -> AESGCM:
+    return AESGCM(HKDF(
+        algorithm=SHA256(),
+        length=32,
+        salt=None,
+        info=b"AHS root keystore",
+    ).derive(force_bytes(settings.SECRET_KEY)))
+
+
+def seal_private_key(path: str, private_key: ec.EllipticCurvePrivateKey):
+    """Atomically replace the keystore at `path` by `private_key`."""
+    der = private_key.private_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PrivateFormat.PKCS8,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+    nonce = os.urandom(NONCE_SIZE)
+    sealed = MAGIC + nonce + _sealing_key().encrypt(nonce, der, MAGIC)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(sealed)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def load_sealed_private_key(path: str) -> ec.EllipticCurvePrivateKey:
+    """
+    Raises:
+        FileNotFoundError: If there is no keystore at `path`.
+        KeystoreError: If the keystore is corrupt or was sealed with another `SECRET_KEY`.
+    """
+    with open(path, 'rb') as file:
+        sealed = file.read()
+    if not sealed.startswith(MAGIC) or len(sealed) <= len(MAGIC) + NONCE_SIZE:
+        raise KeystoreError(f"{path} is not an AHS keystore")
+    nonce = sealed[len(MAGIC):len(MAGIC) + NONCE_SIZE]
+    try:
+        der = _sealing_key().decrypt(nonce, sealed[len(MAGIC) + NONCE_SIZE:], MAGIC)
+    except Exception:
+        raise KeystoreError(f"Unsealing {path} failed, was it sealed with another SECRET_KEY?")
+    return serialization.load_der_private_key(der, password=None)
+
+
+@contextmanager
+def _locked(path: str):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+    with open(f"{path}.lock", 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def load_or_create_private_key(derive: Callable[[], ec.EllipticCurvePrivateKey], path: str = None):
+    """Load the sealed root key, deriving and sealing it with `derive()` if there is none yet."""
+    path = path or get_keystore_path()
+    try:
+        return load_sealed_private_key(path)
+    except FileNotFoundError:
+        pass
+    with _locked(path):
+        try:
+            return load_sealed_private_key(path)
+        except FileNotFoundError:
+            private_key = derive()
+            seal_private_key(path, private_key)
+            return private_key
+
+
+def rotate_private_key(derive: Callable[[], ec.EllipticCurvePrivateKey], path: str = None):
+    """Derive a new root key and seal it, replacing the current one."""
+    path = path or get_keystore_path()
+    with _locked(path):
+        private_key = derive()
+        seal_private_key(path, private_key)
+        return private_key
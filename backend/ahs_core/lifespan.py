@@ -0,0 +1,55 @@
+"""
+ASGI lifespan of a worker: its background tasks start on the server's event loop
+at ``lifespan.startup`` and are stopped at ``lifespan.shutdown``.
+
+- the in-process session sweeper, if `AHS_SESSION_SWEEPER["in_process"]` is set
+- the precomputation of the root key's subkeys, see `AHS_ECC_SUBKEYS`
+- the batching of audit sessions saved by sync views, see `AHS_SESSION_WRITE_BEHIND`
+
+Routed as the ``lifespan`` protocol of the ASGI application. Servers without
+lifespan support run none of them, sessions are then swept by
+``manage.py sweepsessions --loop`` and subkeys derived on first use.
+"""
+import logging
+
+from django.conf import settings
+
+from backend.ahs_core import crypto_executor
+from backend.ahs_core.ecc import subkeys
+from backend.ahs_core.redis_engine import SessionStore, write_behind
+from backend.ahs_core.session_sweeper import session_sweeper
+
+logger = logging.getLogger(__name__)
+
+
+async def startup():
+    if getattr(settings, 'AHS_SESSION_SWEEPER', {}).get('in_process', False):
+        session_sweeper.ensure_running()
+    subkeys.ensure_precomputed()
+    if SessionStore.write_behind:
+        write_behind.start()
+
+
+async def shutdown():
+    session_sweeper.stop()
+    subkeys.stop()
+    if SessionStore.write_behind:
+        await write_behind.aflush()
+    crypto_executor.shutdown(wait=False)
+
+
+async def lifespan_application(scope, receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await startup()
+            except Exception as exc:
+                logger.exception(f"Worker startup failed: {exc}")
+                await send({'type': 'lifespan.startup.failed', 'message': str(exc)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await shutdown()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -0,0 +1,283 @@
+import asyncio
+import inspect
+import json
+import os
+import tempfile
+import time
+import timeit
+from types import SimpleNamespace
+from uuid import UUID, uuid4
+
+from asgiref.sync import sync_to_async
+from django.contrib.messages.storage import default_storage
+from django.core.management import BaseCommand
+from django.http import HttpResponse
+from django.test import RequestFactory
+
+from backend.ahs_auth.token import AHSToken, verified_tokens
+from backend.ahs_core.consumers.channelsmultiplexer import pack_frame, iter_frames
+from backend.ahs_core.consumers.cmd_parser import ArgumentBinder
+from backend.ahs_core import crypto_executor
+from backend.ahs_core.ecc import (
+    ECC, SessionKeyCache, aderive_key_from_string, aencrypt, create_ecc_keypair, decrypt_many,
+    SubkeyRegistry, derive_key_from_string, derive_subkey, encrypt_many, encrypt, session_keys,
+    verified_signatures,
+)
+from backend.ahs_core.keystore import load_sealed_private_key, seal_private_key
+from backend.ahs_core.utils import parse_func_signature
+
+
+class Command(BaseCommand):
+    help = "Runs microbenchmarks for hot paths of the AHS Admin Panel"
+
+    targets = ('demux', 'dispatch', 'token', 'request', 'rootkey', 'ecdh', 'crypto', 'verify', 'subkey')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'target',
+            nargs='?',
+            choices=self.targets + ('all',),
+            default='all',
+        )
+        parser.add_argument(
+            '-n', '--number',
+            type=int,
+            default=100000,
+            help="Number of iterations per benchmark",
+        )
+
+    def write_result(self, name: str, number: int, seconds: float):
+        self.stdout.write(
+            f"{name:<40} {number / seconds:>14,.0f} ops/s {seconds / number * 1e6:>10.3f} us/op"
+        )
+
+    def bench(self, name: str, stmt, number: int):
+        self.write_result(name, number, timeit.timeit(stmt, number=number))
+
+    def abench(self, name: str, afunc, number: int):
+        async def run():
+            start = time.perf_counter()
+            for _ in range(number):
+                await afunc()
+            return time.perf_counter() - start
+
+        self.write_result(name, number, asyncio.run(run()))
+
+    def bench_demux(self, number: int):
+        """
+        Compare the JSON multiplexer path (decode frame, re-encode payload, decode in the
+        child consumer) with the binary envelope path for a single terminal keystroke.
+        """
+        keystroke = 'l'
+        json_frame = json.dumps({'stream': 'terminal', 'payload': keystroke})
+        binary_frame = pack_frame(1, keystroke.encode())
+
+        def json_path():
+            content = json.loads(json_frame)
+            text = json.dumps(content['payload'])
+            json.loads(text).encode()
+
+        def binary_path():
+            for _, payload in iter_frames(binary_frame):
+                pass
+
+        self.stdout.write(self.style.SUCCESS("demux (terminal keystroke)"))
+        self.bench('json envelope', json_path, number)
+        self.bench('binary envelope', binary_path, number)
+
+    def bench_dispatch(self, number: int):
+        """
+        Compare per-call `inspect.signature().bind()` with the precompiled command binder.
+        """
+        async def get_bookmarks(uuid: UUID, user, id: int, active: bool = True):
+            yield
+
+        callbacks = {'get_bookmarks': {
+            'func': get_bookmarks,
+            'binder': ArgumentBinder('get_bookmarks', *parse_func_signature(get_bookmarks, ['user'])),
+        }}
+        func_args = [str(uuid4()), '42']
+        func_kwargs = {'active': 'false'}
+
+        def signature_bind():
+            sig = inspect.signature(callbacks['get_bookmarks']['func'])
+            bound_args = sig.bind(*func_args, None, **func_kwargs)
+            bound_args.apply_defaults()
+
+        def precompiled_bind():
+            callbacks['get_bookmarks']['binder'](func_args, func_kwargs)
+
+        self.stdout.write(self.style.SUCCESS("dispatch (get_bookmarks arguments)"))
+        self.bench('inspect.signature + bind', signature_bind, number)
+        self.bench('precompiled binder (with coercion)', precompiled_bind, number)
+
+    def bench_token(self, number: int):
+        """
+        Compare a full token verification (decode, signature, expiry) with a hit of
+        the verified-token cache.
+        """
+        token = str(AHSToken.create(SimpleNamespace(pk=42), session_key='0' * 32))
+
+        def full_verification():
+            AHSToken.from_string(token)
+
+        def cached_verification():
+            AHSToken.verify(token)
+
+        verified_tokens.clear()
+        self.stdout.write(self.style.SUCCESS("token (X-AHS-Token verification)"))
+        self.bench('parse + verify signature', full_verification, number)
+        self.bench('verified-token cache', cached_verification, number)
+
+    def bench_request(self, number: int):
+        """
+        Per-request cost of the AHS middleware by route class, compared with the eager
+        message storage (two thread pool hops) which every request paid before.
+        """
+        from backend.ahs_auth.middleware import AHSMiddleware
+
+        response = HttpResponse()
+
+        async def view(request):
+            return response
+
+        middleware = AHSMiddleware(view)
+        factory = RequestFactory()
+
+        def route(path: str):
+            return lambda: middleware(factory.get(path))
+
+        async def eager_messages():
+            request = factory.get('/dashboard/')
+            await middleware(request)
+            storage = await sync_to_async(default_storage)(request)
+            await sync_to_async(storage.update)(response)
+
+        self.stdout.write(self.style.SUCCESS("request (AHSMiddleware)"))
+        self.abench('static route', route('/static/js/app.js'), number)
+        self.abench('api route', route('/api/auth/webauthn/'), number)
+        self.abench('html route, lazy messages', route('/dashboard/'), number)
+        self.abench('html route, eager messages (before)', eager_messages, number)
+
+    def bench_rootkey(self, number: int):
+        """
+        Compare the worker startup cost of deriving the ECC root key (PBKDF2) with
+        loading it from the sealed keystore.
+        """
+        self.stdout.write(self.style.SUCCESS("rootkey (worker startup)"))
+        start = time.perf_counter()
+        private_key = ECC.derive_root_key()
+        self.write_result('derive (PBKDF2-SHA512)', 1, time.perf_counter() - start)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'root.keystore')
+            seal_private_key(path, private_key)
+            self.bench('load sealed keystore', lambda: load_sealed_private_key(path), min(number, 10000))
+
+    def bench_ecdh(self, number: int):
+        """
+        Compare encrypting session payloads for one peer with a key exchange per message
+        (the previous behaviour) with the cached session key and the batch API.
+        """
+        private_key, _ = create_ecc_keypair()
+        _, peer_public_key = create_ecc_keypair()
+        payload = json.dumps({'user_id': 42, 'sess_id': '0' * 32})
+        batch = [payload] * 100
+        uncached = SessionKeyCache(maxsize=0)
+
+        def per_message_exchange():
+            encrypt_payload = uncached.get(private_key, peer_public_key).encrypt
+            encrypt_payload(os.urandom(12), payload.encode(), None)
+
+        session_keys.clear()
+        number = min(number, 10000)
+        batches = max(number // len(batch), 1)
+        encrypted = encrypt_many(batch, private_key, peer_public_key)
+        self.stdout.write(self.style.SUCCESS("ecdh (session payload encryption, SECP521R1)"))
+        self.bench('ECDH + HKDF per message', per_message_exchange, batches)
+        self.bench('cached session key', lambda: encrypt(payload, private_key, peer_public_key), number)
+        self.write_result('encrypt_many (per message)', batches * len(batch), timeit.timeit(
+            lambda: encrypt_many(batch, private_key, peer_public_key), number=batches))
+        self.write_result('decrypt_many (per message)', batches * len(batch), timeit.timeit(
+            lambda: decrypt_many(encrypted, private_key, peer_public_key), number=batches))
+
+    def bench_crypto(self, number: int):
+        """
+        Encrypt payloads while a PBKDF2 key derivation runs, on the thread-sensitive
+        `sync_to_async` executor (the previous behaviour) and on the crypto pools.
+        """
+        private_key, _ = create_ecc_keypair()
+        _, peer_public_key = create_ecc_keypair()
+        payload = json.dumps({'user_id': 42, 'sess_id': '0' * 32})
+        salt = os.urandom(16)
+        number = min(number, 1000)
+
+        async def encrypt_during_derivation(derive, encrypt_payload):
+            derivation = asyncio.ensure_future(derive('benchmark', salt, 200000))
+            await asyncio.sleep(0)
+            start = time.perf_counter()
+            await asyncio.gather(*(encrypt_payload(payload, private_key, peer_public_key) for _ in range(number)))
+            seconds = time.perf_counter() - start
+            await derivation
+            return seconds
+
+        self.stdout.write(self.style.SUCCESS("crypto (encrypt during a key derivation)"))
+        self.write_result('sync_to_async', number, asyncio.run(encrypt_during_derivation(
+            sync_to_async(derive_key_from_string), sync_to_async(encrypt))))
+        self.write_result('crypto executor', number, asyncio.run(encrypt_during_derivation(
+            aderive_key_from_string, aencrypt)))
+        for pool in crypto_executor.stats():
+            self.stdout.write(
+                f"  {pool['name']} ({pool['kind']}, {pool['workers']} workers): {pool['submitted']} calls, "
+                f"peak queue depth {max(pool['peak_in_flight'] - pool['workers'], 0)}, "
+                f"avg {pool['avg_time'] * 1e3:.3f} ms"
+            )
+        crypto_executor.shutdown()
+
+    def bench_verify(self, number: int):
+        """
+        Compare verifying a batch of signed reports with one `averify` per signature
+        against `averify_many`, with a cold and a warm known-good cache.
+        """
+        reports = [json.dumps({'worker': i, 'status': 'ok'}).encode() for i in range(100)]
+        batch = [(report, ECC.sign(report)) for report in reports]
+        rounds = max(min(number, 10000) // len(batch), 1)
+
+        async def per_item():
+            for data, signature in batch:
+                await ECC.averify(data, signature)
+
+        async def batched(warm: bool):
+            if not warm:
+                verified_signatures.clear()
+            assert all(await ECC.averify_many(batch))
+
+        async def run(afunc, *args):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                await afunc(*args)
+            return time.perf_counter() - start
+
+        self.stdout.write(self.style.SUCCESS("verify (batches of 100 signatures, ES512)"))
+        self.write_result('averify per signature', rounds * len(batch), asyncio.run(run(per_item)))
+        self.write_result('averify_many, cold cache', rounds * len(batch), asyncio.run(run(batched, False)))
+        self.write_result('averify_many, warm cache', rounds * len(batch), asyncio.run(run(batched, True)))
+
+    def bench_subkey(self, number: int):
+        """
+        Compare deriving a per-app subkey (HKDF + scalar multiplication) on every call
+        with the subkey registry.
+        """
+        parent, _ = create_ecc_keypair()
+        registry = SubkeyRegistry(maxsize=16)
+        registry.get(parent, 1)
+        number = min(number, 10000)
+        self.stdout.write(self.style.SUCCESS("subkey (SECP521R1)"))
+        self.bench('derive_subkey', lambda: derive_subkey(parent.private_numbers(), 1), max(number // 10, 1))
+        self.bench('subkey registry', lambda: registry.get(parent, 1), number)
+
+    def handle(self, *args, **options):
+        target = options['target']
+        number = options['number']
+        for name in self.targets:
+            if target in (name, 'all'):
+                getattr(self, f'bench_{name}')(number)
@@ -0,0 +1,12 @@
+from django.core.management import BaseCommand
+
+from backend.ahs_core.ecc import ECC
+from backend.ahs_core.keystore import get_keystore_path
+
+
+class Command(BaseCommand):
+    help = "Derive a new ECC root key and seal it to the keystore (restart the workers afterwards)"
+
+    def handle(self, *args, **options):
+        ECC.rotate_root_key()
+        self.stdout.write(self.style.SUCCESS(f"Sealed a new root key to {get_keystore_path()}"))
@@ -0,0 +1,37 @@
+import os
+import sys
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Run the pre-forked shell pool of the terminal (see backend.ahs_core.shell_pool)"
+
+    def add_arguments(self, parser):
+        pool = getattr(settings, 'AHS_TERMINAL_SHELL_POOL', {})
+        parser.add_argument(
+            '--socket',
+            default=getattr(settings, 'AHS_TERMINAL_SHELL_POOL_SOCKET', None),
+            help="Path of the Unix socket to listen on",
+        )
+        parser.add_argument('--size', type=int, default=pool.get('size', 4))
+        parser.add_argument('--max-idle-age', type=float, default=pool.get('max_idle_age', 3600))
+        parser.add_argument('--max-shells', type=int, default=pool.get('max_shells'))
+
+    def handle(self, *args, **options):
+        if not options['socket']:
+            raise CommandError("Set AHS_TERMINAL_SHELL_POOL_SOCKET or pass --socket")
+        argv = [
+            sys.executable, '-m', 'backend.ahs_core.shell_pool',
+            '--socket', options['socket'],
+            '--size', str(options['size']),
+            '--max-idle-age', str(options['max_idle_age']),
+        ]
+        if options['max_shells'] is not None:
+            argv += ['--max-shells', str(options['max_shells'])]
+        argv += ['--', *getattr(settings, 'AHS_TERMINAL_SHELL', ['/bin/zsh'])]
+        self.stdout.write(f"Starting shell pool on {options['socket']}")
+        # replace this Django process by the small pool process, the shells are forked from it
+        os.chdir(settings.BASE_DIR)
+        os.execv(sys.executable, argv)
@@ -0,0 +1,33 @@
+import math
+import time
+
+from django.core.management import BaseCommand
+
+from backend.ahs_core.session_sweeper import session_sweeper
+
+
+class Command(BaseCommand):
+    help = "Delete expired AHS sessions in batches (see backend.ahs_core.session_sweeper)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=session_sweeper.batch_size)
+        parser.add_argument(
+            '--time-budget',
+            type=float,
+            default=None,
+            help="Seconds per sweep, unlimited unless --loop is given",
+        )
+        parser.add_argument('--loop', action='store_true', help="Keep sweeping every --interval seconds")
+        parser.add_argument('--interval', type=float, default=session_sweeper.interval)
+
+    def handle(self, *args, **options):
+        session_sweeper.batch_size = options['batch_size']
+        time_budget = options['time_budget']
+        if time_budget is None:
+            time_budget = session_sweeper.time_budget if options['loop'] else math.inf
+        while True:
+            stats = session_sweeper.tick(time_budget)
+            self.stdout.write(f"Session sweep: {stats}")
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
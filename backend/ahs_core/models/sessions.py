@@ -43,8 +43,8 @@ class AHSSession(Model):
 
     @classmethod
     def get_session_store_class(cls):
-        from backend.ahs_core.engines import AHSToken
-        return AHSToken
+        from backend.ahs_core.engines import SessionStore
+        return SessionStore
 
     class Meta:
         db_table = "django_session_ahs"
@@ -0,0 +1,261 @@
+"""
+Redis session engine for `SESSION_ENGINE_AHS`.
+
+Sessions are stored in the Django cache `AHS_SESSION_CACHE_ALIAS` (the project's
+Redis) and expire through Redis TTLs, so no `clear_expired` scans are needed.
+
+Saves of unchanged session data are coalesced: a worker rewrites a session it saved
+less than `AHS_SESSION_SAVE_COALESCE_INTERVAL` seconds ago only if its data changed,
+which turns a burst of requests with `SESSION_SAVE_EVERY_REQUEST` into one write.
+The TTL is refreshed at the next write, up to that interval late.
+
+Updates never recreate a session deleted meanwhile (e.g. by a logout), they raise
+`UpdateError` like Django's cache sessions. With django-redis that check is part of
+the write (``SET XX``).
+
+With `AHS_SESSION_WRITE_BEHIND` enabled, written and deleted sessions are also
+mirrored to :class:`AHSSession` for auditing, in batches every
+`AHS_SESSION_WRITE_BEHIND_INTERVAL` seconds. The table is never read.
+"""
+import asyncio
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.sessions.backends.base import CreateError, UpdateError
+from django.contrib.sessions.backends.cache import SessionStore as CacheSessionStore
+from django.core.cache import caches
+from django.db import DatabaseError
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'ahs:session:'
+
+
+class SessionWriteBehind:
+    """
+    Batches the audit copies of sessions written to Redis and upserts them into
+    :class:`AHSSession`, last write per session wins.
+
+    Sessions saved by sync views (executor threads) are batched on the worker's loop
+    too, the loop of the last async save or the one passed to :meth:`start`. Only
+    without any running loop, e.g. in a management command, each save is written
+    right away.
+    """
+
+    def __init__(self, interval: float = 5.0, max_pending: int = 1000):
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending: dict[str, tuple[str, object] | None] = {}
+        self._lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        # only touched on `_loop`
+        self._handle = None
+
+    def start(self, loop: asyncio.AbstractEventLoop = None):
+        """Batch the saves of all threads on `loop`, the running loop by default."""
+        self._loop = loop or asyncio.get_running_loop()
+
+    def enqueue(self, session_key: str, session_data: str, expire_date):
+        with self._lock:
+            self._pending[session_key] = (session_data, expire_date)
+        self._schedule()
+
+    def enqueue_delete(self, session_key: str):
+        with self._lock:
+            self._pending[session_key] = None
+        self._schedule()
+
+    def _schedule(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = self._loop
+            if loop is None or loop.is_closed() or not loop.is_running():
+                # no loop to flush later, e.g. in a management command
+                self.flush()
+                return
+            loop.call_soon_threadsafe(self._schedule_on, loop)
+            return
+        self._schedule_on(loop)
+
+    def _schedule_on(self, loop: asyncio.AbstractEventLoop):
+        if loop is not self._loop:
+            self._loop, self._handle = loop, None
+        with self._lock:
+            pending = len(self._pending)
+        if pending >= self.max_pending:
+            if self._handle is not None:
+                self._handle.cancel()
+            self._handle = None
+            loop.create_task(self.aflush())
+        elif self._handle is None and pending:
+            self._handle = loop.call_later(self.interval, lambda: loop.create_task(self.aflush()))
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if pending:
+            self.write(pending)
+
+    def write(self, pending: dict[str, tuple[str, object] | None]):
+        from backend.ahs_core.models import AHSSession
+
+        max_length = AHSSession._meta.get_field('session_data').max_length
+        sessions, deleted = [], []
+        for session_key, value in pending.items():
+            if value is None:
+                deleted.append(session_key)
+                continue
+            data, expire_date = value
+            # the audit row keeps the key and expiry of sessions too large for the column
+            sessions.append(AHSSession(
+                session_key=session_key,
+                session_data=data if len(data) <= max_length else '',
+                expire_date=expire_date,
+            ))
+        try:
+            if sessions:
+                AHSSession.objects.bulk_create(
+                    sessions,
+                    update_conflicts=True,
+                    unique_fields=['session_key'],
+                    update_fields=['session_data', 'expire_date'],
+                )
+            if deleted:
+                AHSSession.objects.filter(session_key__in=deleted).delete()
+        except DatabaseError as exc:
+            logger.warning(f"Writing {len(pending)} audit sessions failed: {exc}")
+            return
+        logger.debug(f"Wrote {len(sessions)} and deleted {len(deleted)} audit sessions")
+
+    async def aflush(self):
+        self._handle = None
+        await sync_to_async(self.flush)()
+
+
+write_behind = SessionWriteBehind(getattr(settings, 'AHS_SESSION_WRITE_BEHIND_INTERVAL', 5))
+
+
+class SessionStore(CacheSessionStore):
+    """
+    Redis session store, see the module docstring.
+    """
+    cache_key_prefix = KEY_PREFIX
+    coalesce_interval = getattr(settings, 'AHS_SESSION_SAVE_COALESCE_INTERVAL', 5)
+    write_behind = getattr(settings, 'AHS_SESSION_WRITE_BEHIND', False)
+
+    # Digest and time of the sessions last saved by this worker, see `_coalesce`.
+    # Shared by the loop and the threads of sync views.
+    _recent_saves: "OrderedDict[str, tuple[bytes, float]]" = OrderedDict()
+    _recent_saves_maxsize = 10000
+    _recent_saves_lock = threading.Lock()
+
+    def __init__(self, session_key=None):
+        super().__init__(session_key)
+        self._cache = caches[getattr(settings, 'AHS_SESSION_CACHE_ALIAS', 'default')]
+        # django-redis can overwrite a key only if it still exists (SET XX) in one round trip
+        self._set_xx = hasattr(self._cache, 'client')
+
+    def _digest(self, session_data: dict) -> bytes:
+        return hashlib.blake2b(self.serializer().dumps(session_data), digest_size=16).digest()
+
+    def _coalesce(self, session_data: dict) -> bool:
+        """True if the same data was saved by this worker a moment ago."""
+        with self._recent_saves_lock:
+            recent = self._recent_saves.get(self.session_key)
+        return (
+            recent is not None
+            and recent[0] == self._digest(session_data)
+            and time.monotonic() - recent[1] < self.coalesce_interval
+        )
+
+    def _saved(self, session_data: dict, expiry_age: int):
+        recent_saves = self._recent_saves
+        recent = (self._digest(session_data), time.monotonic())
+        with self._recent_saves_lock:
+            recent_saves[self.session_key] = recent
+            recent_saves.move_to_end(self.session_key)
+            while len(recent_saves) > self._recent_saves_maxsize:
+                recent_saves.popitem(last=False)
+        if self.write_behind:
+            write_behind.enqueue(
+                self.session_key,
+                self.encode(session_data),
+                timezone.now() + timedelta(seconds=expiry_age),
+            )
+
+    def _update(self, cache_key: str, session_data: dict, expiry_age: int) -> bool:
+        """
+        Overwrite the stored session, False if it no longer exists, e.g. because a
+        concurrent logout deleted it.
+        """
+        if self._set_xx:
+            return bool(self._cache.set(cache_key, session_data, expiry_age, xx=True))
+        if not self._cache.has_key(cache_key):
+            return False
+        self._cache.set(cache_key, session_data, expiry_age)
+        return True
+
+    async def _aupdate(self, cache_key: str, session_data: dict, expiry_age: int) -> bool:
+        if self._set_xx:
+            return await sync_to_async(self._update, thread_sensitive=False)(cache_key, session_data, expiry_age)
+        if not await self._cache.ahas_key(cache_key):
+            return False
+        await self._cache.aset(cache_key, session_data, expiry_age)
+        return True
+
+    def save(self, must_create=False):
+        if self.session_key is None:
+            return self.create()
+        session_data = self._get_session(no_load=must_create)
+        if not must_create and self._coalesce(session_data):
+            return
+        expiry_age = self.get_expiry_age()
+        if must_create:
+            if not self._cache.add(self.cache_key, session_data, expiry_age):
+                raise CreateError
+        elif not self._update(self.cache_key, session_data, expiry_age):
+            raise UpdateError
+        self._saved(session_data, expiry_age)
+
+    async def asave(self, must_create=False):
+        if self.session_key is None:
+            return await self.acreate()
+        session_data = await self._aget_session(no_load=must_create)
+        if not must_create and self._coalesce(session_data):
+            return
+        cache_key = await self.acache_key()
+        expiry_age = await self.aget_expiry_age()
+        if must_create:
+            if not await self._cache.aadd(cache_key, session_data, expiry_age):
+                raise CreateError
+        elif not await self._aupdate(cache_key, session_data, expiry_age):
+            raise UpdateError
+        self._saved(session_data, expiry_age)
+
+    def _deleted(self, session_key: str):
+        with self._recent_saves_lock:
+            self._recent_saves.pop(session_key, None)
+        if self.write_behind:
+            write_behind.enqueue_delete(session_key)
+
+    def delete(self, session_key=None):
+        session_key = session_key or self.session_key
+        if session_key is None:
+            return
+        super().delete(session_key)
+        self._deleted(session_key)
+
+    async def adelete(self, session_key=None):
+        session_key = session_key or self.session_key
+        if session_key is None:
+            return
+        await super().adelete(session_key)
+        self._deleted(session_key)
@@ -0,0 +1,154 @@
+"""
+Incremental sweeper of expired :class:`AHSSession` rows.
+
+Instead of one unbounded ``DELETE ... WHERE expire_date < now()``, expired sessions
+are deleted in batches of `batch_size` rows, walking the `expire_date` index with a
+keyset cursor, until the tick's `time_budget` (seconds) is spent. Rows left over are
+picked up by the next tick.
+
+Run it with ``python manage.py sweepsessions`` (once or ``--loop``), or in-process
+with `AHS_SESSION_SWEEPER["in_process"]`, where every worker runs
+:meth:`SessionSweeper.run` from the ASGI lifespan startup (servers without lifespan
+support need the management command). Workers take turns through a cache lock, so
+only one of them sweeps per `interval`.
+"""
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SweepStats:
+    batches: int = 0
+    rows_removed: int = 0
+    duration: float = 0.0
+    # seconds the oldest expired row left over has been expired, 0 if none
+    lag: float = 0.0
+    finished: bool = False
+
+    def __str__(self):
+        return (f"removed {self.rows_removed} rows in {self.batches} batches ({self.duration:.3f}s), "
+                f"lag {self.lag:.0f}s{'' if self.finished else ', more to sweep'}")
+
+
+class SessionSweeper:
+    lock_key = 'ahs:session_sweeper:lock'
+
+    def __init__(self, batch_size: int = 1000, time_budget: float = 0.5, interval: float = 60):
+        self.batch_size = batch_size
+        self.time_budget = time_budget
+        self.interval = interval
+        self.total_removed = 0
+        self.last_stats: SweepStats | None = None
+        self._task = None
+
+    @staticmethod
+    def get_model():
+        from backend.ahs_core.models import AHSSession
+        return AHSSession
+
+    def select_batch(self, now, cursor=None) -> list:
+        """``(expire_date, session_key)`` of the next `batch_size` sessions expired before `now` after `cursor`."""
+        expired = self.get_model().objects.filter(expire_date__lt=now)
+        if cursor is not None:
+            expire_date, session_key = cursor
+            expired = expired.filter(
+                Q(expire_date__gt=expire_date) | Q(expire_date=expire_date, session_key__gt=session_key))
+        return list(
+            expired.order_by('expire_date', 'session_key')
+            .values_list('expire_date', 'session_key')[:self.batch_size]
+        )
+
+    def sweep_batch(self, now, cursor=None):
+        """
+        Delete the next batch of sessions expired before `now` after `cursor`.
+
+        Returns:
+            The number of deleted rows and the cursor of the next batch, None once
+            the last batch was swept.
+        """
+        batch = self.select_batch(now, cursor)
+        if not batch:
+            return 0, None
+        # rows refreshed since they were selected are skipped by the expire_date filter
+        deleted, _ = self.get_model().objects.filter(
+            session_key__in=[session_key for _, session_key in batch],
+            expire_date__lt=now,
+        ).delete()
+        return deleted, batch[-1] if len(batch) == self.batch_size else None
+
+    def lag(self, now) -> float:
+        oldest = (self.get_model().objects.filter(expire_date__lt=now)
+                  .order_by('expire_date').values_list('expire_date', flat=True).first())
+        return (now - oldest).total_seconds() if oldest else 0.0
+
+    def tick(self, time_budget: float = None) -> SweepStats:
+        """
+        Sweep batches until all expired sessions are gone or `time_budget` (default:
+        the sweeper's, `math.inf` for no limit) is spent.
+        """
+        if time_budget is None:
+            time_budget = self.time_budget
+        stats = SweepStats()
+        now = timezone.now()
+        start = time.monotonic()
+        cursor = None
+        while True:
+            deleted, cursor = self.sweep_batch(now, cursor)
+            stats.batches += 1
+            stats.rows_removed += deleted
+            if cursor is None:
+                stats.finished = True
+                break
+            if time.monotonic() - start >= time_budget:
+                break
+        stats.duration = time.monotonic() - start
+        stats.lag = 0.0 if stats.finished else self.lag(now)
+        self.total_removed += stats.rows_removed
+        self.last_stats = stats
+        log = logger.info if stats.rows_removed else logger.debug
+        log(f"Session sweep: {stats}")
+        return stats
+
+    async def atick(self, time_budget: float = None) -> SweepStats:
+        return await sync_to_async(self.tick)(time_budget)
+
+    async def run(self):
+        """Sweep every `interval` seconds, skipping ticks another worker holds the lock for."""
+        while True:
+            try:
+                if await cache.aadd(self.lock_key, os.getpid(), self.interval):
+                    await self.atick()
+            except Exception as exc:
+                logger.exception(f"Session sweep failed: {exc}")
+            await asyncio.sleep(self.interval)
+
+    def ensure_running(self):
+        """Start :meth:`run` on the running loop, unless it is running there already."""
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._task = loop.create_task(self.run())
+
+    def stop(self):
+        task, self._task = self._task, None
+        if task is not None and not task.done():
+            task.cancel()
+
+
+_config = getattr(settings, 'AHS_SESSION_SWEEPER', {})
+
+session_sweeper = SessionSweeper(
+    batch_size=_config.get('batch_size', 1000),
+    time_budget=_config.get('time_budget', 0.5),
+    interval=_config.get('interval', 60),
+)
@@ -1,10 +1,15 @@
 import asyncio
 import collections
+import errno
+import fcntl
+import json
 import logging
 import os
 import pty
 import signal
+import socket
 import stat
+import termios
 import warnings
 from asyncio import (
     ReadTransport,
@@ -37,6 +42,111 @@ def remove_fd_writer(fd):
     loop.remove_writer(fd)
 
 
+def _set_result_unless_cancelled(fut, result):
+    if not fut.cancelled():
+        fut.set_result(result)
+
+
+async def wait_readable(fd: int):
+    """Waits until `fd` is readable."""
+    loop = asyncio.get_running_loop()
+    waiter = loop.create_future()
+    loop.add_reader(fd, lambda: waiter.done() or waiter.set_result(None))
+    try:
+        await waiter
+    finally:
+        loop.remove_reader(fd)
+
+
+def open_pidfd(pid: int) -> int | None:
+    """Returns a pidfd of the child `pid`, or None if the platform has no pidfd support."""
+    try:
+        return os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        return None
+
+
+async def wait_pid(pid: int, pidfd: int | None = None) -> int | None:
+    """
+    Waits for the child `pid` to exit and reaps it without blocking the event loop.
+
+    With a pidfd the exit is awaited as a readable event of the loop, otherwise the
+    blocking `waitpid` runs in the default executor.
+
+    Returns:
+        The exit code (negative signal number if killed by a signal), or None if the
+        child was already reaped elsewhere.
+    """
+    loop = asyncio.get_running_loop()
+    if pidfd is None:
+        try:
+            _, status = await loop.run_in_executor(None, os.waitpid, pid, 0)
+        except ChildProcessError:
+            return None
+        return os.waitstatus_to_exitcode(status)
+
+    while True:
+        try:
+            reaped, status = os.waitpid(pid, os.WNOHANG)
+        except ChildProcessError:
+            return None
+        if reaped:
+            return os.waitstatus_to_exitcode(status)
+        await wait_readable(pidfd)
+
+
+async def terminate_process_group(pid: int, pidfd: int | None = None, timeout: float = 5.0) -> int | None:
+    """
+    Hangs up the process group led by `pid` and reaps its leader.
+
+    Interactive shells ignore SIGTERM, so the group gets SIGHUP like on a closed
+    terminal, followed by SIGKILL if the leader didn't exit within `timeout` seconds.
+    """
+    for sig, sig_timeout in ((signal.SIGHUP, timeout), (signal.SIGKILL, None)):
+        try:
+            os.killpg(pid, sig)
+        except ProcessLookupError:
+            pass
+        try:
+            async with asyncio.timeout(sig_timeout):
+                returncode = await wait_pid(pid, pidfd)
+        except TimeoutError:
+            logger.warning(f"Process group {pid} didn't exit within {timeout}s, killing it")
+            continue
+        logger.info(f"Process group {pid} exited with {returncode} after {sig.name}")
+        return returncode
+
+
+def spawn_pty_shell(args: list[str]) -> tuple[int, int]:
+    """
+    Fork `args` into its own session with a new pseudo-terminal as controlling terminal.
+
+    Returns:
+        The child's pid and the PTY master's file descriptor.
+    """
+    master_fd, slave_fd = pty.openpty()
+    pid = os.fork()
+    if pid == 0:
+        # Child process
+        try:
+            os.setsid()
+            os.close(master_fd)  # Close the master FD in the child
+            fcntl.ioctl(slave_fd, termios.TIOCSCTTY, 0)  # Make the PTY the controlling terminal
+
+            # Redirect stdin, stdout, and stderr to the PTY slave
+            os.dup2(slave_fd, 0)
+            os.dup2(slave_fd, 1)
+            os.dup2(slave_fd, 2)
+            if slave_fd > 2:
+                os.close(slave_fd)
+
+            os.execvp(args[0], args)
+        finally:
+            os._exit(127)
+    os.close(slave_fd)
+    return pid, master_fd
+
+
 class FileDescriptorError(Exception):
     def __init__(self, fd, message):
         super().__init__(message)
@@ -73,7 +183,6 @@ class ReadFileDescriptorTransport(ReadTransport):
 
     def __init__(self, fd: int, protocol: Protocol, waiter=None, extra=None, loop: asyncio.AbstractEventLoop = None):
         super().__init__(extra)
-        self._extra = extra if extra else {}
         self._extra["fd"] = fd
 
         self._loop = loop if loop else asyncio.get_event_loop()
@@ -81,6 +190,8 @@ class ReadFileDescriptorTransport(ReadTransport):
         self._protocol = protocol
         self._closing = False
         self._paused = False
+        # reused for every read, only the bytes read are copied out
+        self._read_buffer = memoryview(bytearray(self.max_size))
 
         # Check if the FD is valid
         mode = os.fstat(self._fd).st_mode
@@ -97,32 +208,37 @@ class ReadFileDescriptorTransport(ReadTransport):
         # Schedule the FD to be read when data is available
         self._loop.call_soon(self._add_reader, self._fd, self._read_ready)
         if waiter is not None:
-            self._loop.call_soon(asyncio.Future.set_result, waiter,)
+            self._loop.call_soon(_set_result_unless_cancelled, waiter, None)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} fd={self._fd} paused={self._paused} closing={self._closing}>"
 
     def _add_reader(self, fd, callback):
         if not self.is_reading():
             return
-        add_fd_reader(fd, callback)
+        self._loop.add_reader(fd, callback)
 
     def is_reading(self):
         return not self._paused and not self._closing
 
     def _read_ready(self):
         try:
-            data = os.read(self._fd, self.max_size)
+            size = os.readv(self._fd, [self._read_buffer])
         except (BlockingIOError, InterruptedError):
-            pass
+            return
         except OSError as exc:
-            self._fatal_error(exc, "Fatal read error on FD transport")
+            if exc.errno != errno.EIO:
+                self._fatal_error(exc, "Fatal read error on FD transport")
+                return
+            # a PTY master reports EIO once the slave side is closed
+            size = 0
+        if size:
+            self._protocol.data_received(bytes(self._read_buffer[:size]))
         else:
-            if data:
-                self._protocol.data_received(data)
-            else:
-                # EOF case
-                self._closing = True
-                self._loop.remove_reader(self._fd)
-                # self._loop.call_soon(self._protocol.eof_received, )
-                self._loop.call_soon(self._call_connection_lost, None)
+            # EOF case
+            self._closing = True
+            self._loop.remove_reader(self._fd)
+            self._loop.call_soon(self._call_connection_lost, None)
 
     def pause_reading(self):
         if not self.is_reading():
@@ -134,7 +250,7 @@ class ReadFileDescriptorTransport(ReadTransport):
         if self._closing or not self._paused:
             return
         self._paused = False
-        add_fd_reader(self._fd, self._read_ready, (0,))
+        self._loop.add_reader(self._fd, self._read_ready)
 
     def close(self):
         if not self._closing:
@@ -152,6 +268,8 @@ class ReadFileDescriptorTransport(ReadTransport):
         self._loop.call_soon(self._call_connection_lost, exc)
 
     def _call_connection_lost(self, exc):
+        if self._fd is None:
+            return
         try:
             self._protocol.connection_lost(exc)
         finally:
@@ -168,13 +286,27 @@ class ReadFileDescriptorTransport(ReadTransport):
 
 
 class WriteFileDescriptorTransport(WriteTransport):
+    """
+    Non-blocking write transport of a file descriptor.
+
+    Data is written right away if possible, the rest is buffered and written once the
+    descriptor is writable. The protocol's `pause_writing` / `resume_writing` are
+    called when the buffer crosses the high / low water mark.
+    """
+    high_water = 64 * 1024
+
     def __init__(self, fd: int, protocol: BaseProtocol, waiter=None, extra=None, loop: asyncio.AbstractEventLoop = None,):
         super().__init__(extra)
+        self._extra["fd"] = fd
         self._loop = loop if loop else asyncio.get_event_loop()
         self._fd = fd
         self._protocol = protocol
         self._closing = False
+        self._closed = False
         self._buffer = bytearray()
+        self._protocol_paused = False
+        self._low_water = self.high_water // 4
+        self._high_water = self.high_water
 
         # Check if the FD is valid for writing
         mode = os.fstat(fd).st_mode
@@ -186,7 +318,26 @@ class WriteFileDescriptorTransport(WriteTransport):
         # Notify the protocol of the connection
         self._loop.call_soon(self._protocol.connection_made, self)
         if waiter is not None:
-            self._loop.call_soon(asyncio.Future.set_result, waiter,)
+            self._loop.call_soon(_set_result_unless_cancelled, waiter, None)
+
+    def __repr__(self):
+        return f"<{self.__class__.__name__} fd={self._fd} buffered={len(self._buffer)} closing={self._closing}>"
+
+    def get_write_buffer_size(self):
+        return len(self._buffer)
+
+    def get_write_buffer_limits(self):
+        return self._low_water, self._high_water
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is None:
+            high = self.high_water if low is None else 4 * low
+        if low is None:
+            low = high // 4
+        if not high >= low >= 0:
+            raise ValueError(f'high ({high!r}) must be >= low ({low!r}) must be >= 0')
+        self._high_water, self._low_water = high, low
+        self._maybe_pause_protocol()
 
     def write(self, data: bytes):
         if self._closing:
@@ -195,29 +346,82 @@ class WriteFileDescriptorTransport(WriteTransport):
             raise TypeError(f"Data must be bytes-like, not {type(data).__name__}.")
         if not data:
             return
+        if not self._buffer:
+            # fast path, nothing queued: write right away
+            try:
+                written = os.write(self._fd, data)
+            except (BlockingIOError, InterruptedError):
+                written = 0
+            except OSError as exc:
+                self._fatal_error(exc, "Fatal write error on FD transport")
+                return
+            if written == len(data):
+                return
+            data = memoryview(data)[written:]
+            self._loop.add_writer(self._fd, self._write_ready)
         self._buffer.extend(data)
-        add_fd_writer(self._fd, self._write_ready)
+        self._maybe_pause_protocol()
 
     def _write_ready(self):
         try:
             written = os.write(self._fd, self._buffer)
-            del self._buffer[:written]
         except (BlockingIOError, InterruptedError):
-            pass
+            return
         except OSError as exc:
+            self._buffer.clear()
             self._fatal_error(exc, "Fatal write error on FD transport")
-        finally:
-            if not self._buffer:
-                self._loop.remove_writer(self._fd)
-            if self._closing and not self._buffer:
+            return
+        del self._buffer[:written]
+        self._maybe_resume_protocol()
+        if not self._buffer:
+            self._loop.remove_writer(self._fd)
+            if self._closing:
                 self._close(None)
 
+    def _maybe_pause_protocol(self):
+        if len(self._buffer) <= self._high_water or self._protocol_paused:
+            return
+        self._protocol_paused = True
+        try:
+            self._protocol.pause_writing()
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except BaseException as exc:
+            self._loop.call_exception_handler(
+                {"message": "protocol.pause_writing() failed", "exception": exc,
+                 "transport": self, "protocol": self._protocol}
+            )
+
+    def _maybe_resume_protocol(self):
+        if not self._protocol_paused or len(self._buffer) > self._low_water:
+            return
+        self._protocol_paused = False
+        try:
+            self._protocol.resume_writing()
+        except (SystemExit, KeyboardInterrupt):
+            raise
+        except BaseException as exc:
+            self._loop.call_exception_handler(
+                {"message": "protocol.resume_writing() failed", "exception": exc,
+                 "transport": self, "protocol": self._protocol}
+            )
+
+    def can_write_eof(self):
+        return False
+
+    def is_closing(self):
+        return self._closing
+
     def close(self):
         if not self._closing:
             self._closing = True
             if not self._buffer:
                 self._close(None)
 
+    def abort(self):
+        self._buffer.clear()
+        self._close(None)
+
     def _fatal_error(self, exc, message="Fatal write error on FD transport"):
         self._loop.call_exception_handler(
             {"message": message, "exception": exc, "transport": self, "protocol": self._protocol}
@@ -225,7 +429,9 @@ class WriteFileDescriptorTransport(WriteTransport):
         self._close(exc)
 
     def _close(self, exc):
-        self._closing = True
+        if self._closed:
+            return
+        self._closing = self._closed = True
         self._loop.remove_writer(self._fd)
         self._loop.call_soon(self._call_connection_lost, exc)
 
@@ -253,7 +459,7 @@ class PTYTransport(BaseTransport):
     def get_returncode(self):
         raise NotImplementedError
 
-    def get_fd_transport(self, fd):
+    def get_pipe_transport(self, fd):
         """Get transport with number fd."""
         raise NotImplementedError
 
@@ -268,19 +474,19 @@ class PTYTransport(BaseTransport):
 
 
 class WritePtyConsumerProto(BaseProtocol):
+    """Protocol of the PTY master's write side, reports to the owning :class:`AHSPTYTransport`."""
 
-    def __init__(self, fd, loop: asyncio.AbstractEventLoop = None):
-        self._loop = loop if loop else asyncio.get_event_loop()
-        self.proc = AHSPTYTransport()
+    def __init__(self, proc: 'AHSPTYTransport', fd: int):
+        self.proc = proc
         self.fd = fd
-        self.consumer = None
+        self.pipe = None
         self.disconnected = False
 
     def connection_made(self, transport):
-        self.consumer = transport
+        self.pipe = transport
 
     def __repr__(self):
-        return f'<{self.__class__.__name__} fd={self.fd} consumers={self.consumer!r}>'
+        return f'<{self.__class__.__name__} fd={self.fd} pipe={self.pipe!r}>'
 
     def connection_lost(self, exc):
         self.disconnected = True
@@ -295,94 +501,156 @@ class WritePtyConsumerProto(BaseProtocol):
 
 
 class ReadPtyConsumerProto(WritePtyConsumerProto, Protocol):
+    """Protocol of the PTY master's read side, reports to the owning :class:`AHSPTYTransport`."""
 
     def data_received(self, data):
         self.proc._consumer_data_received(self.fd, data)
 
 
 class PtyShellProcess:
-    __slots__ = ('proc', 'pid', 'master_fd', 'slave_fd', '_read_task', '_loop',
-                 'reader', 'writer', '_consumer_send_coro', '_writer', '_read_transport', '_write_transport')
+    """
+    A shell running in its own session on the slave side of a new pseudo-terminal.
+
+    The PTY master's file descriptor is handed over to the transports of
+    :class:`AHSPTYTransport`, which close it.
+    """
+    __slots__ = ('args', 'pid', 'pidfd', 'master_fd', 'returncode')
 
-    def __init__(self, loop: AbstractEventLoop = None):
-        self._loop: AbstractEventLoop = loop if loop else asyncio.get_event_loop()
+    def __init__(self, args: list[str]):
+        self.args = list(args)
         self.master_fd: int | None = None
         self.pid: int | None = None
-        self.reader: StreamReader | None = None
-        self.writer: StreamWriter | None = None
-        self._read_transport: ReadFileDescriptorTransport | None = None
-        self._write_transport: WriteFileDescriptorTransport | None = None
+        self.pidfd: int | None = None
+        self.returncode: int | None = None
         self.get_pty() # creates pty
 
     def get_pty(self):
-        master_fd, slave_fd = pty.openpty()
-        pid, m = pty.fork()
-        if pid == 0:
-            # Child process
-            os.close(master_fd)  # Close the master FD in the child
+        self.pid, self.master_fd = spawn_pty_shell(self.args)
+        self.pidfd = open_pidfd(self.pid)
 
-            # Redirect stdin, stdout, and stderr to the PTY slave
-            os.dup2(slave_fd, 0)
-            os.dup2(slave_fd, 1)
-            os.dup2(slave_fd, 2)
-            os.close(slave_fd)
+    def __repr__(self):
+        return f"<ShellProcess pid={self.pid} master_fd={self.master_fd} returncode={self.returncode}>"
 
-            # Execute a command
-            # os.execvp("sh", ["sh", "-c", f"echo shit-{os.getpid()}-{os.getppid()} | nc localhost 8888"])
-            os.execvp('/bin/bash', ['/bin/bash'])
-        else:
-            os.close(slave_fd)
-            self.master_fd, self.pid = master_fd, pid
+    def poll(self) -> int | None:
+        return self.returncode
 
-    def __repr__(self):
-        return f"<ShellProcess pid={self.pid} master_fd={self.master_fd} >"
+    def send_signal(self, sig: int):
+        """Send `sig` to the shell's process group."""
+        if self.returncode is not None:
+            return
+        try:
+            os.killpg(self.pid, sig)
+        except ProcessLookupError:
+            logger.warning(f"Process group {self.pid} does not exist.")
+
+    def terminate(self):
+        """Hang up the shell, interactive shells ignore SIGTERM."""
+        self.send_signal(signal.SIGHUP)
 
     def kill(self):
-        """Immediately kill the child process."""
-        if self.pid:
-            try:
-                os.kill(self.pid, signal.SIGKILL)  # Send SIGKILL to terminate the process
-                logger.info(f"Shell process {self.pid} killed successfully.")
-            except ProcessLookupError:
-                logger.warning(f"Process {self.pid} does not exist.")
-            except Exception as e:
-                logger.error(f"Failed to kill process {self.pid}: {e}")
-        else:
-            logger.error("No process to kill.")
+        """Immediately kill the shell's process group."""
+        self.send_signal(signal.SIGKILL)
+
+    async def wait(self) -> int:
+        """Wait until the shell exited, reap it and return its exit code."""
+        if self.returncode is None:
+            returncode = await wait_pid(self.pid, self.pidfd)
+            # None: reaped elsewhere, the exit status is unknown
+            self.returncode = -1 if returncode is None else returncode
+            if self.pidfd is not None:
+                os.close(self.pidfd)
+                self.pidfd = None
+        return self.returncode
+
+
+class PooledPtyShellProcess(PtyShellProcess):
+    """
+    A shell leased from the pre-forked shell pool (:mod:`backend.ahs_core.shell_pool`).
+
+    The pool passes the PTY master and a pidfd of the shell over the lease socket
+    (SCM_RIGHTS). It reports the shell's exit code on the socket, and hangs up the
+    shell once the socket is closed.
+    """
+    __slots__ = ('lease',)
+
+    def __init__(self, pid: int, master_fd: int, pidfd: int | None, lease: socket.socket):
+        self.args = []
+        self.pid = pid
+        self.master_fd = master_fd
+        self.pidfd = pidfd
+        self.lease = lease
+        self.returncode = None
+
+    @classmethod
+    async def acquire(cls, path: str) -> 'PooledPtyShellProcess':
+        """
+        Lease a shell from the pool listening on the Unix socket `path`.
 
-    def terminate(self):
-        """Gracefully terminate the child process."""
-        if self.pid:
-            try:
-                os.kill(self.pid, signal.SIGTERM)  # Send SIGTERM to allow graceful termination
-                logger.info(f"Shell process {self.pid} terminated successfully.")
-            except ProcessLookupError:
-                logger.warning(f"Process {self.pid} does not exist.")
-            except Exception as e:
-                logger.error(f"Failed to terminate process {self.pid}: {e}")
-        else:
-            logger.error("No process to terminate.")
+        Raises:
+            OSError: If the pool is unreachable or has no shell to hand out.
+        """
+        loop = asyncio.get_running_loop()
+        lease = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        lease.setblocking(False)
+        try:
+            await loop.sock_connect(lease, path)
+            await loop.sock_sendall(lease, b'{"op": "acquire"}\n')
+            await wait_readable(lease.fileno())
+            message, fds, _, _ = socket.recv_fds(lease, 4096, 2)
+        except BaseException:
+            lease.close()
+            raise
+        response = json.loads(message or b'{}')
+        if 'error' in response or len(fds) != 2:
+            for fd in fds:
+                os.close(fd)
+            lease.close()
+            raise OSError(f"Shell pool {path}: {response.get('error', 'no shell received')}")
+        master_fd, pidfd = fds
+        return cls(response['pid'], master_fd, pidfd, lease)
 
-    def cleanup(self):
-        """Clean up resources (close file descriptors and reap child process)."""
-        if self.master_fd:
-            try:
-                os.close(self.master_fd)
-            except OSError as e:
-                logger.error(f"Failed to close master_fd {self.master_fd}: {e}")
-            logger.info(f"Closed master_fd {self.master_fd}.")
+    def __repr__(self):
+        return f"<PooledShellProcess pid={self.pid} master_fd={self.master_fd} returncode={self.returncode}>"
 
-        if self.pid:
+    async def wait(self) -> int:
+        """Wait for the exit code reported by the pool."""
+        if self.returncode is None:
+            loop = asyncio.get_running_loop()
+            line = bytearray()
             try:
-                os.waitpid(self.pid, 0)  # Reap the child process
-                logger.info(f"Reaped process {self.pid}.")
-            except ChildProcessError:
-                logger.warning(f"No child process found with pid {self.pid}.")
-            except Exception as e:
-                logger.error(f"Error while reaping process {self.pid}: {e}")
+                while not line.endswith(b'\n'):
+                    chunk = await loop.sock_recv(self.lease, 256)
+                    if not chunk:
+                        break
+                    line += chunk
+            except OSError:
+                pass
+            if line.endswith(b'\n'):
+                self.returncode = json.loads(line)['returncode']
+            else:
+                # the pool went away, the pidfd still tells when the shell exits
+                await wait_readable(self.pidfd)
+                self.returncode = -1
+            self.lease.close()
+            os.close(self.pidfd)
+            self.pidfd = None
+        return self.returncode
 
 
 class AHSPTYTransport(PTYTransport):
+    """
+    Subprocess transport of a :class:`PtyShellProcess`.
+
+    Modelled after asyncio's subprocess transports: the protocol (an
+    :class:`asyncio.SubprocessProtocol`) gets the shell's output through
+    `pipe_data_received(1, data)` and `process_exited()` once the shell exited.
+    `write()` feeds the shell's input without blocking, the protocol's
+    `pause_writing` / `resume_writing` are called when the input buffer crosses the
+    write buffer limits. `pause_reading` / `resume_reading` stop and resume reading
+    the shell's output, so the shell blocks once the kernel's PTY buffer is full.
+
+    Use :func:`create_pty_shell` to create one.
+    """
 
     def __init__(self, protocol, args, waiter=None, extra=None, loop: AbstractEventLoop = None ,**kwargs):
         super().__init__(extra)
@@ -396,15 +664,19 @@ class AHSPTYTransport(PTYTransport):
         self._pending_calls = collections.deque()
         self._pipes = {}
         self._finished = False
+        self._exit_future = self._loop.create_future()
+        self._write_buffer_limits = (kwargs.get('write_high_water'), kwargs.get('write_low_water'))
 
-        # Create the child process: set the _proc attribute
+        # Create the child process (unless a pooled one was passed): set the _proc attribute
         try:
-            self._proc = PtyShellProcess(self._loop)
+            self._proc = kwargs.get('process') or PtyShellProcess(args)
         except:
             self.close()
             raise
 
-        self._extra = {'subprocess': self._proc}
+        self._pid = self._proc.pid
+        self._extra['subprocess'] = self._proc
+        self._extra['master_fd'] = self._proc.master_fd
 
         if self._loop.get_debug():
             if isinstance(args, (bytes, str)):
@@ -434,14 +706,8 @@ class AHSPTYTransport(PTYTransport):
             info.append(f'stdin={stdin.pipe}')
 
         stdout = self._pipes.get(1)
-        stderr = self._pipes.get(2)
-        if stdout is not None and stderr is stdout:
+        if stdout is not None:
             info.append(f'stdout=stderr={stdout.pipe}')
-        else:
-            if stdout is not None:
-                info.append(f'stdout={stdout.pipe}')
-            if stderr is not None:
-                info.append(f'stderr={stderr.pipe}')
 
         return '<{}>'.format(' '.join(info))
 
@@ -460,7 +726,7 @@ class AHSPTYTransport(PTYTransport):
         self._closed = True
 
         for proto in self._pipes.values():
-            if proto is None:
+            if proto is None or proto.pipe is None:
                 continue
             proto.pipe.close()
 
@@ -474,12 +740,7 @@ class AHSPTYTransport(PTYTransport):
             if self._loop.get_debug():
                 logger.warning('Close running child process: kill %r', self)
 
-            try:
-                self._proc.kill()
-            except ProcessLookupError:
-                pass
-
-            # Don't clear the _proc reference yet: _post_init() may still run
+            self._proc.kill()
 
     def __del__(self, _warn=warnings.warn):
         if not self._closed:
@@ -514,23 +775,55 @@ class AHSPTYTransport(PTYTransport):
         self._check_proc()
         self._proc.kill()
 
+    def write(self, data: bytes):
+        """Write `data` to the shell's input without blocking."""
+        self._pipes[0].pipe.write(data)
+
+    def get_write_buffer_size(self):
+        return self._pipes[0].pipe.get_write_buffer_size()
+
+    def pause_reading(self):
+        """Stop reading the shell's output."""
+        self._pipes[1].pipe.pause_reading()
+
+    def resume_reading(self):
+        self._pipes[1].pipe.resume_reading()
+
+    async def aclose(self, timeout: float = 5.0):
+        """
+        Hang up the shell, kill it if it didn't exit within `timeout` seconds, close
+        the transport and wait until the protocol saw `connection_lost`.
+        """
+        if self._returncode is None and self._proc is not None:
+            self._proc.terminate()
+            try:
+                async with asyncio.timeout(timeout):
+                    await self._exited()
+            except TimeoutError:
+                logger.warning(f"Process group {self._pid} didn't exit within {timeout}s, killing it")
+                self._proc.kill()
+        self.close()
+        return await self._wait()
+
     async def _connect_pipes(self, waiter):
         try:
             proc = self._proc
             loop = self._loop
 
-            if proc.stdin is not None:
-                _, pipe = await loop.connect_write_pipe(
-                    lambda: WritePtyConsumerProto(self, self._proc),
-                    proc.stdin)
-                self._pipes[0] = pipe
+            # the read and the write transport each own a descriptor of the PTY master
+            read_waiter = loop.create_future()
+            read_proto = ReadPtyConsumerProto(self, 1)
+            ReadFileDescriptorTransport(proc.master_fd, read_proto, read_waiter, loop=loop)
+            self._pipes[1] = read_proto
 
-            if proc.stdout is not None:
-                _, pipe = await loop.connect_read_pipe(
-                    lambda: ReadPtyConsumerProto(self, self._proc),
-                    proc.stderr)
-                self._pipes[2] = pipe
+            write_waiter = loop.create_future()
+            write_proto = WritePtyConsumerProto(self, 0)
+            write_transport = WriteFileDescriptorTransport(os.dup(proc.master_fd), write_proto, write_waiter, loop=loop)
+            write_transport.set_write_buffer_limits(*self._write_buffer_limits)
+            self._pipes[0] = write_proto
 
+            await asyncio.gather(read_waiter, write_waiter)
+            loop.create_task(self._watch_exit())
 
             loop.call_soon(self._protocol.connection_made, self)
             for callback, data in self._pending_calls:
@@ -545,6 +838,15 @@ class AHSPTYTransport(PTYTransport):
             if waiter is not None and not waiter.cancelled():
                 waiter.set_result(None)
 
+    async def _watch_exit(self):
+        returncode = await self._proc.wait()
+        self._exit_future.set_result(returncode)
+        self._process_exited(returncode)
+
+    async def _exited(self):
+        """Wait until the shell exited, the pipes may still be open."""
+        await asyncio.shield(self._exit_future)
+
     def _call(self, cb, *data):
         if self._pending_calls is not None:
             self._pending_calls.append((cb, data))
@@ -562,10 +864,6 @@ class AHSPTYTransport(PTYTransport):
         if self._loop.get_debug():
             logger.info('%r exited with return code %r', self, returncode)
         self._returncode = returncode
-        if self._proc.returncode is None:
-            # asyncio uses a child watcher: copy the status into the Popen
-            # object. On Python 3.6, it is required to avoid a ResourceWarning.
-            self._proc.returncode = returncode
         self._call(self._protocol.process_exited)
 
         self._try_finish()
@@ -574,7 +872,7 @@ class AHSPTYTransport(PTYTransport):
         """Wait until the process exit and return the process return code.
 
         This method is a coroutine."""
-        if self._returncode is not None:
+        if self._finished:
             return self._returncode
 
         waiter = self._loop.create_future()
@@ -603,6 +901,36 @@ class AHSPTYTransport(PTYTransport):
             self._protocol = None
 
 
+async def create_pty_shell(protocol_factory, args: list[str], loop: AbstractEventLoop = None,
+                           pool: str | None = None, **kwargs):
+    """
+    Start `args` on a new pseudo-terminal, like :meth:`loop.subprocess_exec`.
+
+    With `pool` (the socket path of a shell pool) a pre-forked shell of the pool is
+    used instead, `args` only apply if the pool is unavailable.
+
+    Returns:
+        The :class:`AHSPTYTransport` and the protocol created by `protocol_factory`.
+    """
+    loop = loop if loop else asyncio.get_running_loop()
+    process = None
+    if pool:
+        try:
+            process = await PooledPtyShellProcess.acquire(pool)
+        except OSError as exc:
+            logger.warning(f"Shell pool unavailable, forking the shell: {exc}")
+    protocol = protocol_factory()
+    waiter = loop.create_future()
+    transport = AHSPTYTransport(protocol, args, waiter, loop=loop, process=process, **kwargs)
+    try:
+        await waiter
+    except BaseException:
+        transport.close()
+        await transport._wait()
+        raise
+    return transport, protocol
+
+
 class ReadFDProtocol(Protocol):
 
     def __init__(self, fd, consumer_send_func: callable = None):
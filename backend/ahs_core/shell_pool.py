@@ -0,0 +1,252 @@
+"""
+Pre-forked shell pool for terminal sessions.
+
+A small helper process keeps `size` shells warm on their own pseudo-terminals, so a
+terminal session starts without forking the ASGI worker and without waiting for the
+shell's startup files. Workers lease a shell over a Unix socket, see
+:meth:`backend.ahs_core.shell.PooledPtyShellProcess.acquire`:
+
+1. the worker sends ``{"op": "acquire"}``,
+2. the pool answers ``{"pid": ...}`` with the PTY master and a pidfd of the shell
+   attached (SCM_RIGHTS),
+3. the pool sends ``{"returncode": ...}`` once the shell exited,
+4. the pool hangs up the shell when the worker closes the socket.
+
+Warm shells older than `max_idle_age` seconds are recycled, `max_shells` limits the
+warm and leased shells together. Only depends on the standard library so it stays
+small, start it with ``python manage.py shellpool``.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import time
+from collections import deque
+from dataclasses import dataclass, field
+
+from backend.ahs_core.shell import spawn_pty_shell, open_pidfd
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class WarmShell:
+    pid: int
+    master_fd: int
+    pidfd: int
+    started: float = field(default_factory=time.monotonic)
+
+    def close_fds(self):
+        for fd in (self.master_fd, self.pidfd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class ShellPoolServer:
+    def __init__(
+            self,
+            path: str,
+            args: list[str],
+            size: int = 4,
+            max_idle_age: float | None = 3600,
+            max_shells: int | None = None,
+            kill_timeout: float = 5,
+    ):
+        self.path = path
+        self.args = args
+        self.size = size
+        self.max_idle_age = max_idle_age
+        self.max_shells = max_shells
+        self.kill_timeout = kill_timeout
+        self.warm: deque[WarmShell] = deque()
+        self.leases: dict[int, socket.socket] = {}
+        self._refill_handle = None
+
+    def spawn(self) -> WarmShell:
+        pid, master_fd = spawn_pty_shell(self.args)
+        pidfd = open_pidfd(pid)
+        if pidfd is None:
+            os.killpg(pid, signal.SIGKILL)
+            os.close(master_fd)
+            raise OSError("Shell pool requires pidfd support (Linux >= 5.3)")
+        logger.debug(f"Spawned warm shell {pid}")
+        return WarmShell(pid, master_fd, pidfd)
+
+    def fill(self):
+        """Spawn warm shells until the pool has `size` of them."""
+        self._refill_handle = None
+        while len(self.warm) < self.size and (
+                self.max_shells is None or len(self.warm) + len(self.leases) < self.max_shells):
+            try:
+                self.warm.append(self.spawn())
+            except OSError as exc:
+                logger.error(f"Spawning a warm shell failed: {exc}")
+                return
+
+    def schedule_fill(self, delay: float = 0):
+        if self._refill_handle is None:
+            self._refill_handle = asyncio.get_running_loop().call_later(delay, self.fill)
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        stop = asyncio.Event()
+        loop.add_signal_handler(signal.SIGCHLD, self.reap)
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop.set)
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        os.chmod(self.path, 0o600)
+        server.listen()
+        server.setblocking(False)
+
+        self.fill()
+        logger.info(f"Shell pool listening on {self.path} ({len(self.warm)} warm shells of {self.args})")
+        tasks = [loop.create_task(self.accept(server)), loop.create_task(self.recycle())]
+        try:
+            await stop.wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            server.close()
+            os.unlink(self.path)
+            while self.warm:
+                self.discard(self.warm.popleft())
+            for pid in list(self.leases):
+                self.send_signal(pid, signal.SIGHUP)
+
+    async def accept(self, server: socket.socket):
+        loop = asyncio.get_running_loop()
+        while True:
+            conn, _ = await loop.sock_accept(server)
+            conn.setblocking(False)
+            loop.create_task(self.handle(conn))
+
+    async def handle(self, conn: socket.socket):
+        """Hand out a warm shell and hold its lease until the worker closes `conn`."""
+        loop = asyncio.get_running_loop()
+        try:
+            request = json.loads(await loop.sock_recv(conn, 4096) or b'{}')
+            if request.get('op') != 'acquire':
+                return
+            if not self.warm:
+                self.fill()
+            if not self.warm:
+                await loop.sock_sendall(conn, b'{"error": "no shell available"}\n')
+                return
+            shell = self.warm.popleft()
+            try:
+                socket.send_fds(conn, [json.dumps({'pid': shell.pid}).encode() + b'\n'],
+                                [shell.master_fd, shell.pidfd])
+            except OSError:
+                self.discard(shell)
+                raise
+            # the worker owns the shell's descriptors now
+            shell.close_fds()
+            self.leases[shell.pid] = conn
+            self.schedule_fill()
+            logger.debug(f"Leased shell {shell.pid}")
+
+            # the lease ends when the worker closes the connection
+            try:
+                await loop.sock_recv(conn, 1)
+            except OSError:
+                pass
+            if shell.pid in self.leases:
+                self.send_signal(shell.pid, signal.SIGHUP)
+                loop.call_later(self.kill_timeout, self.send_signal, shell.pid, signal.SIGKILL)
+        except (OSError, ValueError) as exc:
+            logger.warning(f"Lease request failed: {exc}")
+        finally:
+            conn.close()
+
+    def send_signal(self, pid: int, sig: int):
+        """Signal a leased shell, unless it was reaped already and its pid may be reused."""
+        if pid not in self.leases:
+            return
+        try:
+            os.killpg(pid, sig)
+        except ProcessLookupError:
+            pass
+
+    @staticmethod
+    def discard(shell: WarmShell):
+        """Hang up a warm shell which was taken out of the pool, it's reaped by :meth:`reap`."""
+        try:
+            os.killpg(shell.pid, signal.SIGHUP)
+        except ProcessLookupError:
+            pass
+        shell.close_fds()
+
+    def reap(self):
+        """SIGCHLD handler: reap exited shells and report the exit code of leased ones."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            returncode = os.waitstatus_to_exitcode(status)
+            conn = self.leases.pop(pid, None)
+            if conn is not None:
+                logger.debug(f"Leased shell {pid} exited with {returncode}")
+                try:
+                    conn.send(json.dumps({'returncode': returncode}).encode() + b'\n')
+                except OSError:
+                    pass
+                self.schedule_fill()
+                continue
+            for shell in list(self.warm):
+                if shell.pid == pid:
+                    logger.warning(f"Warm shell {pid} exited with {returncode}")
+                    self.warm.remove(shell)
+                    shell.close_fds()
+                    # back off, a shell which exits right away would spin otherwise
+                    self.schedule_fill(1)
+
+    async def recycle(self):
+        """Replace warm shells which are older than `max_idle_age`."""
+        if not self.max_idle_age:
+            return
+        while True:
+            await asyncio.sleep(min(60.0, self.max_idle_age))
+            now = time.monotonic()
+            while self.warm and now - self.warm[0].started > self.max_idle_age:
+                shell = self.warm.popleft()
+                logger.debug(f"Recycling warm shell {shell.pid}")
+                self.discard(shell)
+            self.fill()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--socket', required=True, help="Path of the Unix socket to listen on")
+    parser.add_argument('--size', type=int, default=4, help="Number of warm shells")
+    parser.add_argument('--max-idle-age', type=float, default=3600,
+                        help="Seconds after which a warm shell is replaced (0 = never)")
+    parser.add_argument('--max-shells', type=int, default=None, help="Maximum of warm and leased shells")
+    parser.add_argument('--log-level', default='INFO')
+    parser.add_argument('shell', nargs='*', default=['/bin/zsh'])
+    options = parser.parse_args(argv)
+    logging.basicConfig(level=options.log_level, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+
+    server = ShellPoolServer(
+        options.socket,
+        options.shell,
+        size=options.size,
+        max_idle_age=options.max_idle_age,
+        max_shells=options.max_shells,
+    )
+    asyncio.run(server.serve())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,630 @@
+import asyncio
+import math
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from types import SimpleNamespace
+from uuid import UUID, uuid4
+
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.base import UpdateError
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from backend.ahs_core.consumers.channelsmultiplexer import AsyncJsonWebsocketDemultiplexer, pack_frame, iter_frames
+from backend.ahs_core.consumers.cmd_parser import ArgumentBinder, CommandMapper
+from backend.ahs_core.consumers.command import Command
+from backend.ahs_core.consumers.command_cache import CommandCache, MISSING
+from backend.ahs_core.consumers.command_dispatcher import AHSCommandConsumer
+from backend.ahs_core.consumers.scheduler import FairCommandScheduler
+from backend.ahs_core.consumers.stream_queue import StreamQueue, StreamQueueOverflow
+from backend.ahs_core.consumers.terminal_dispatcher import (
+    AsyncWebsocketTerminal, pack_input, iter_input, OP_DATA, OP_RESIZE, INPUT_RESIZE,
+)
+from backend.ahs_core.consumers import terminal_session
+from backend.ahs_core.consumers.terminal_session import ScrollbackBuffer
+from backend.ahs_core.crypto_executor import CryptoPool
+from backend.ahs_core.ecc import (
+    SubkeyRegistry, VerifiedSignatureCache, create_ecc_keypair, decrypt, decrypt_many, encrypt, encrypt_many,
+    session_keys, subkeys,
+)
+from backend.ahs_core.keystore import (
+    KeystoreError, load_or_create_private_key, load_sealed_private_key, seal_private_key,
+)
+from backend.ahs_core.lifespan import lifespan_application
+from backend.ahs_core.models import AHSSession
+from backend.ahs_core.redis_engine import SessionStore as RedisSessionStore, SessionWriteBehind
+from backend.ahs_core.session_sweeper import SessionSweeper
+from backend.ahs_core.user_cache import UserCache
+
+
+class BinaryEnvelopeTests(SimpleTestCase):
+    def test_roundtrip_multiple_frames(self):
+        data = pack_frame(0, b'\xa1ab') + pack_frame(1, b'ls\r')
+        self.assertEqual(list(iter_frames(data)), [(0, b'\xa1ab'), (1, b'ls\r')])
+
+    def test_empty_payload(self):
+        self.assertEqual(list(iter_frames(pack_frame(1, b''))), [(1, b'')])
+
+    def test_truncated_payload(self):
+        with self.assertRaises(ValueError):
+            list(iter_frames(pack_frame(1, b'abc')[:-1]))
+
+    def test_truncated_header(self):
+        with self.assertRaises(ValueError):
+            list(iter_frames(b'\x01\x00'))
+
+
+class RefusingConsumer(AsyncJsonWebsocketConsumer):
+    async def connect(self):
+        await self.close(code=4003)
+
+
+class AcceptingConsumer(AsyncJsonWebsocketConsumer):
+    async def connect(self):
+        await self.accept()
+
+
+class RefusalDemultiplexer(AsyncJsonWebsocketDemultiplexer):
+    applications = {}
+    lazy_streams = True
+
+
+class DemultiplexerRefusalTests(SimpleTestCase):
+    def get_communicator(self):
+        application = RefusalDemultiplexer.as_asgi(
+            refusing=RefusingConsumer.as_asgi(),
+            accepting=AcceptingConsumer.as_asgi(),
+        )
+        return WebsocketCommunicator(application, '/ws/')
+
+    async def test_connection_closed_when_every_stream_refused(self):
+        communicator = self.get_communicator()
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        await communicator.send_json_to({'stream': 'refusing', 'control': 'subscribe'})
+        self.assertEqual(await communicator.receive_output(), {'type': 'websocket.close', 'code': 4003})
+        await communicator.wait()
+
+    async def test_connection_kept_open_for_accepting_stream(self):
+        communicator = self.get_communicator()
+        await communicator.connect()
+        await communicator.send_json_to({'stream': 'accepting', 'control': 'subscribe'})
+        await communicator.send_json_to({'stream': 'refusing', 'control': 'subscribe'})
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+
+class TerminalInputTests(SimpleTestCase):
+    def test_roundtrip_multiple_records(self):
+        data = pack_input(OP_RESIZE, INPUT_RESIZE.pack(120, 40)) + pack_input(OP_DATA, b'ls\r')
+        records = [(opcode, bytes(payload)) for opcode, payload in iter_input(data)]
+        self.assertEqual(records, [(OP_RESIZE, b'\x00x\x00('), (OP_DATA, b'ls\r')])
+
+    def test_truncated_record(self):
+        with self.assertRaises(ValueError):
+            list(iter_input(pack_input(OP_DATA, b'abc')[:-1]))
+
+
+class TerminalAuthenticationTests(SimpleTestCase):
+    async def test_unauthenticated_connection_refused(self):
+        communicator = WebsocketCommunicator(AsyncWebsocketTerminal.as_asgi(), '/ws/terminal/')
+        communicator.scope['user'] = AnonymousUser()
+        communicator.scope['url_route'] = {'args': (), 'kwargs': {'socket_url': 'terminal'}}
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+        self.assertNotIn('None:terminal', terminal_session._sessions)
+
+
+class StreamQueueTests(SimpleTestCase):
+    @staticmethod
+    def frame(data: bytes):
+        return {'type': 'websocket.receive', 'bytes': data}
+
+    async def test_coalesce_merges_binary_frames(self):
+        queue = StreamQueue('terminal', maxsize=1, policy='coalesce')
+        await queue.put_frame(self.frame(b'a'))
+        await queue.put_frame(self.frame(b'b'))
+        self.assertEqual(await queue.get(), self.frame(b'ab'))
+        self.assertEqual(queue.metrics()['coalesced'], 1)
+
+    async def test_drop_oldest_keeps_control_messages(self):
+        queue = StreamQueue('terminal', maxsize=1, policy='drop_oldest')
+        await queue.put_frame(self.frame(b'a'))
+        await queue.put_frame(self.frame(b'b'))
+        queue.put_control({'type': 'websocket.disconnect'})
+        self.assertEqual(await queue.get(), self.frame(b'b'))
+        self.assertEqual(await queue.get(), {'type': 'websocket.disconnect'})
+        self.assertEqual(queue.metrics()['dropped'], 1)
+
+    async def test_block_waits_for_consumer_but_not_control_messages(self):
+        queue = StreamQueue('terminal', maxsize=1)
+        await queue.put_frame(self.frame(b'a'))
+        blocked = asyncio.ensure_future(queue.put_frame(self.frame(b'b')))
+        queue.put_control({'type': 'websocket.disconnect'})
+        await asyncio.sleep(0)
+        self.assertFalse(blocked.done())
+        self.assertEqual(await queue.get(), self.frame(b'a'))
+        await asyncio.wait_for(blocked, 1)
+        self.assertEqual(await queue.get(), {'type': 'websocket.disconnect'})
+        self.assertEqual(await queue.get(), self.frame(b'b'))
+        self.assertTrue(queue.empty())
+
+    async def test_close_policy_raises(self):
+        queue = StreamQueue('command', maxsize=1, policy='close')
+        await queue.put_frame(self.frame(b'a'))
+        with self.assertRaises(StreamQueueOverflow):
+            await queue.put_frame(self.frame(b'b'))
+
+
+class ArgumentBinderTests(SimpleTestCase):
+    def setUp(self):
+        self.binder = ArgumentBinder('get_bookmarks', ['uuid', 'id'], {'active': True},
+                                     {'uuid': UUID, 'id': int, 'active': bool})
+
+    def test_binds_and_coerces(self):
+        uuid = uuid4()
+        self.assertEqual(
+            self.binder([str(uuid), '42'], {'active': 'false'}),
+            {'uuid': uuid, 'id': 42, 'active': False},
+        )
+
+    def test_applies_defaults(self):
+        self.assertTrue(self.binder([str(uuid4()), 1], None)['active'])
+
+    def test_missing_and_unknown_arguments(self):
+        with self.assertRaises(TypeError):
+            self.binder([str(uuid4())], None)
+        with self.assertRaises(TypeError):
+            self.binder([str(uuid4()), 1], {'foo': 1})
+
+
+class FairCommandSchedulerTests(SimpleTestCase):
+    async def test_saturated_user_does_not_block_others(self):
+        scheduler = FairCommandScheduler(max_concurrency=4, max_per_user=1)
+        await scheduler.acquire('a')
+        queued = asyncio.ensure_future(scheduler.acquire('a'))
+        await asyncio.sleep(0)
+        self.assertEqual(scheduler.stats()['waiting_per_user'], {'a': 1})
+        await asyncio.wait_for(scheduler.acquire('b'), 0.1)
+        self.assertEqual(scheduler.stats()['running_per_user'], {'a': 1, 'b': 1})
+        scheduler.release('a')
+        await asyncio.wait_for(queued, 0.1)
+
+    async def test_waiting_users_served_round_robin(self):
+        scheduler = FairCommandScheduler(max_concurrency=1, max_per_user=1)
+        await scheduler.acquire('a')
+        order = []
+
+        async def run(user_key):
+            async with scheduler.slot(user_key):
+                order.append(user_key)
+
+        tasks = [asyncio.ensure_future(run(user_key)) for user_key in ('a', 'a', 'b')]
+        await asyncio.sleep(0)
+        scheduler.release('a')
+        await asyncio.wait_for(asyncio.gather(*tasks), 1)
+        self.assertEqual(order, ['a', 'b', 'a'])
+
+
+class CryptoPoolTests(SimpleTestCase):
+    def test_stats(self):
+        pool = CryptoPool('test', max_workers=1)
+
+        async def run():
+            results = await asyncio.gather(pool.run(pow, 2, 8), pool.run(pow, 2, 'x'), return_exceptions=True)
+            self.assertEqual(results[0], 256)
+            self.assertIsInstance(results[1], TypeError)
+
+        asyncio.run(run())
+        pool.shutdown()
+        stats = pool.stats()
+        self.assertEqual((stats['submitted'], stats['failed'], stats['in_flight']), (2, 1, 0))
+        self.assertEqual(stats['peak_in_flight'], 2)
+
+
+class KeystoreTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'state', 'root.keystore')
+
+    def test_roundtrip(self):
+        private_key, _ = create_ecc_keypair()
+        os.makedirs(os.path.dirname(self.path))
+        seal_private_key(self.path, private_key)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        self.assertEqual(load_sealed_private_key(self.path).private_numbers(), private_key.private_numbers())
+
+    def test_other_secret_key_fails(self):
+        os.makedirs(os.path.dirname(self.path))
+        seal_private_key(self.path, create_ecc_keypair()[0])
+        with override_settings(SECRET_KEY='other' * 10):
+            with self.assertRaises(KeystoreError):
+                load_sealed_private_key(self.path)
+
+    def test_derived_once(self):
+        derived = []
+
+        def derive():
+            derived.append(create_ecc_keypair()[0])
+            return derived[-1]
+
+        first = load_or_create_private_key(derive, self.path)
+        second = load_or_create_private_key(derive, self.path)
+        self.assertEqual(len(derived), 1)
+        self.assertEqual(second.private_numbers(), first.private_numbers())
+
+
+class SessionKeyCacheTests(SimpleTestCase):
+    def setUp(self):
+        session_keys.clear()
+        self.alice, self.alice_public = create_ecc_keypair()
+        self.bob, self.bob_public = create_ecc_keypair()
+
+    def test_roundtrip_shares_one_key_per_pair(self):
+        messages = encrypt_many(['a', 'b'], self.alice, self.bob_public)
+        self.assertEqual(decrypt_many(messages, self.bob, self.alice_public), ['a', 'b'])
+        self.assertEqual(decrypt(encrypt('c', self.alice, self.bob_public), self.bob, self.alice_public), 'c')
+        self.assertEqual(len(session_keys), 2)
+
+    def test_tampered_message_is_rejected(self):
+        message = encrypt('a', self.alice, self.bob_public)
+        with self.assertRaises(Exception):
+            decrypt(message[:-4] + 'AAAA', self.bob, self.alice_public)
+
+    def test_concurrent_gets_with_evictions(self):
+        peers = [create_ecc_keypair()[1] for _ in range(6)]
+        maxsize, session_keys.maxsize = session_keys.maxsize, 2
+        try:
+            with ThreadPoolExecutor(8) as executor:
+                results = list(executor.map(
+                    lambda i: session_keys.get(self.alice, peers[i % len(peers)]), range(400)))
+        finally:
+            session_keys.maxsize = maxsize
+        self.assertEqual(len(results), 400)
+        self.assertLessEqual(len(session_keys), 2)
+
+
+class SubkeyRegistryTests(SimpleTestCase):
+    def test_memoized_per_parent_and_index(self):
+        registry = SubkeyRegistry(maxsize=2)
+        parent, _ = create_ecc_keypair()
+        other, _ = create_ecc_keypair()
+        subkey = registry.get(parent, 1)
+        self.assertIs(registry.get(parent, 1), subkey)
+        self.assertNotEqual(registry.get(other, 1).private_numbers(), subkey.private_numbers())
+        registry.clear()
+        self.assertIsNone(registry.get_cached(parent, 1))
+
+
+@override_settings(AHS_SESSION_SWEEPER={'in_process': False})
+class LifespanTests(SimpleTestCase):
+    async def test_startup_and_shutdown(self):
+        messages = asyncio.Queue()
+        sent = []
+
+        async def send(message):
+            sent.append(message['type'])
+
+        precompute, subkeys.precompute = subkeys.precompute, 0
+        try:
+            await messages.put({'type': 'lifespan.startup'})
+            await messages.put({'type': 'lifespan.shutdown'})
+            await asyncio.wait_for(lifespan_application({'type': 'lifespan'}, messages.get, send), 5)
+        finally:
+            subkeys.precompute = precompute
+        self.assertEqual(sent, ['lifespan.startup.complete', 'lifespan.shutdown.complete'])
+
+
+class VerifiedSignatureCacheTests(SimpleTestCase):
+    def test_lru(self):
+        cache = VerifiedSignatureCache(maxsize=2)
+        keys = [cache.key(data, b'signature') for data in (b'a', b'b', b'c')]
+        cache.add(keys[0])
+        cache.add(keys[1])
+        self.assertIn(keys[0], cache)
+        cache.add(keys[2])
+        self.assertNotIn(keys[1], cache)
+        self.assertNotIn(cache.key(b'a', b'other'), cache)
+
+
+class CommandPendingLimitTests(SimpleTestCase):
+    def setUp(self):
+        async def pending_limit_command(user):
+            await asyncio.sleep(10)
+
+        CommandMapper.register_django_callback('ahs_core', 'pending_limit_command', pending_limit_command)
+        self.addCleanup(CommandMapper.callbacks.pop, 'pending_limit_command')
+
+    async def test_requests_beyond_limit_are_refused(self):
+        consumer = AHSCommandConsumer()
+        consumer.scope = {'user': None, 'url_route': {'kwargs': {'socket_url': 'test'}}}
+        consumer.channel_name = 'test.channel'
+        consumer.command_max_pending = 3
+        sent = []
+
+        async def send_json(content, close=False):
+            sent.append(content)
+
+        consumer.send_json = send_json
+        for unique_id in range(5):
+            await consumer.command_request({'func_name': 'pending_limit_command', 'unique_id': unique_id})
+        # superseding a pending command keeps the count
+        await consumer.command_request({'func_name': 'pending_limit_command', 'unique_id': 0})
+        try:
+            self.assertEqual(sorted(consumer.command_tasks), [0, 1, 2])
+            self.assertEqual([message['unique_id'] for message in sent], [3, 4])
+            self.assertEqual(sent[0]['error'], 'Too many pending commands')
+        finally:
+            await consumer.cancel_commands()
+
+
+class CommandChunkTests(SimpleTestCase):
+    @staticmethod
+    def make_command(callback) -> Command:
+        return Command(
+            func_name=callback.__name__, func_args=[], func_kwargs={}, owner=None,
+            channel_name='test.channel', page_name='', app_name='test', unique_id=1,
+            socket_url='/ws/test/', callback=callback, deadline=None,
+        )
+
+    async def test_partial_chunk_flushed_while_generator_is_busy(self):
+        async def slow_generator():
+            yield 1
+            await asyncio.sleep(0.5)
+            yield 2
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        chunks = []
+        command = self.make_command(slow_generator)
+        async for chunk, final in command.iter_chunks(slow_generator()):
+            chunks.append((chunk, final, loop.time() - start))
+        self.assertEqual([(chunk, final) for chunk, final, _ in chunks], [([1], False), ([2], True)])
+        self.assertLess(chunks[0][2], command.chunk_interval + 0.2)
+
+    async def test_cancellation_closes_generator(self):
+        closed = asyncio.Event()
+
+        async def endless_generator():
+            try:
+                yield 1
+                await asyncio.sleep(10)
+            finally:
+                closed.set()
+
+        async def consume():
+            async for _ in self.make_command(endless_generator).iter_chunks(endless_generator()):
+                pass
+
+        task = asyncio.ensure_future(consume())
+        await asyncio.sleep(0.1)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+        self.assertTrue(closed.is_set())
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CommandCacheTests(SimpleTestCase):
+    def setUp(self):
+        caches['default'].clear()
+        self.cache = CommandCache('get_bookmarks', timeout=60, owner_field='owner__user_id')
+
+    async def test_roundtrip(self):
+        self.assertIs(await self.cache.aget(1, {'id': 1}), MISSING)
+        await self.cache.aset(1, {'id': 1}, {'chunked': False, 'data': 'x'})
+        self.assertEqual(await self.cache.aget(1, {'id': 1}), {'chunked': False, 'data': 'x'})
+        self.assertIs(await self.cache.aget(2, {'id': 1}), MISSING)
+
+    async def test_invalidate_owner(self):
+        await self.cache.aset(1, {'id': 1}, 'a')
+        await self.cache.aset(2, {'id': 1}, 'b')
+        self.cache.invalidate(1)
+        self.cache._local.clear()
+        self.assertIs(await self.cache.aget(1, {'id': 1}), MISSING)
+        self.assertEqual(await self.cache.aget(2, {'id': 1}), 'b')
+
+    async def test_invalidate_all(self):
+        await self.cache.aset(1, {'id': 1}, 'a')
+        self.cache.invalidate()
+        self.assertIs(await self.cache.aget(1, {'id': 1}), MISSING)
+
+    async def test_invalidation_while_running_wins(self):
+        value, key = await self.cache.alookup(1, {'id': 1})
+        self.assertIs(value, MISSING)
+        self.cache.invalidate(1)
+        await self.cache.aset(1, {'id': 1}, 'stale', key)
+        self.assertIs(await self.cache.aget(1, {'id': 1}), MISSING)
+
+    async def test_invalidate_instance_resolves_owner_field(self):
+        await self.cache.aset(1, {'id': 1}, 'a')
+        await self.cache.aset(2, {'id': 1}, 'b')
+        bookmark = SimpleNamespace(owner_id=7, owner=SimpleNamespace(pk=7, user_id=1))
+        self.cache.invalidate_instance(sender=None, instance=bookmark)
+        self.assertIs(await self.cache.aget(1, {'id': 1}), MISSING)
+        self.assertEqual(await self.cache.aget(2, {'id': 1}), 'b')
+
+
+class UserCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.cache = UserCache(timeout=60, maxsize=2)
+
+    def test_returns_copies(self):
+        self.cache.set(SimpleNamespace(pk=1, name='alice'))
+        user = self.cache.get('1')
+        user.name = 'bob'
+        self.assertEqual(self.cache.get(1).name, 'alice')
+
+    def test_invalidate_instance(self):
+        self.cache.set(SimpleNamespace(pk=1))
+        self.cache.invalidate_instance(sender=None, instance=SimpleNamespace(pk=1))
+        self.assertIsNone(self.cache.get(1))
+
+    def test_load_racing_invalidation_is_not_cached(self):
+        version = self.cache.version
+        self.cache.invalidate(1)
+        self.cache.set(SimpleNamespace(pk=1), version)
+        self.assertIsNone(self.cache.get(1))
+
+    def test_lru_and_expiry(self):
+        for pk in (1, 2, 3):
+            self.cache.set(SimpleNamespace(pk=pk))
+        self.assertIsNone(self.cache.get(1))
+        self.cache.timeout = -1
+        self.cache.set(SimpleNamespace(pk=4))
+        self.assertIsNone(self.cache.get(4))
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class RedisSessionStoreTests(SimpleTestCase):
+    def cached(self, session_key):
+        return caches['default'].get(RedisSessionStore.cache_key_prefix + session_key)
+
+    async def test_unchanged_saves_are_coalesced(self):
+        session = RedisSessionStore()
+        await session.aset('a', 1)
+        await session.asave()
+        await caches['default'].aset(RedisSessionStore.cache_key_prefix + session.session_key, {'marker': 1})
+        await session.asave()
+        self.assertEqual(self.cached(session.session_key), {'marker': 1})
+        await session.aset('b', 2)
+        await session.asave()
+        self.assertEqual(self.cached(session.session_key), {'a': 1, 'b': 2})
+
+    async def test_cycle_key(self):
+        session = RedisSessionStore()
+        await session.aset('a', 1)
+        await session.asave()
+        old_key = session.session_key
+        await session.acycle_key()
+        self.assertIsNone(self.cached(old_key))
+        self.assertEqual(self.cached(session.session_key), {'a': 1})
+
+    async def test_save_after_concurrent_logout(self):
+        session = RedisSessionStore()
+        await session.aset('uid', 1)
+        await session.asave()
+        request = RedisSessionStore(session.session_key)
+        self.assertEqual(await request.aget('uid'), 1)
+        await session.adelete()
+        await request.aset('x', 2)
+        with self.assertRaises(UpdateError):
+            await request.asave()
+        self.assertIsNone(self.cached(session.session_key))
+
+    def test_sync_save_after_concurrent_logout(self):
+        session = RedisSessionStore()
+        session['uid'] = 1
+        session.save()
+        request = RedisSessionStore(session.session_key)
+        self.assertEqual(request['uid'], 1)
+        session.delete()
+        request['x'] = 2
+        with self.assertRaises(UpdateError):
+            request.save()
+        self.assertIsNone(self.cached(session.session_key))
+
+
+class SessionWriteBehindTests(SimpleTestCase):
+    class RecordingWriteBehind(SessionWriteBehind):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.written = []
+
+        def write(self, pending):
+            self.written.append(pending)
+
+    async def test_saves_of_threads_are_batched_on_the_loop(self):
+        write_behind = self.RecordingWriteBehind(interval=0.05)
+        write_behind.start()
+
+        def save_sessions():
+            for index in range(10):
+                write_behind.enqueue(f'session{index}', 'data', None)
+
+        await asyncio.to_thread(save_sessions)
+        self.assertEqual(write_behind.written, [])
+        await asyncio.sleep(0.2)
+        self.assertEqual(len(write_behind.written), 1)
+        self.assertEqual(len(write_behind.written[0]), 10)
+
+    def test_written_right_away_without_loop(self):
+        write_behind = self.RecordingWriteBehind()
+        write_behind.enqueue('session', 'data', None)
+        self.assertEqual(write_behind.written, [{'session': ('data', None)}])
+
+    def test_concurrent_saves_with_evictions(self):
+        def save(index):
+            session = RedisSessionStore(f'session{index % 16:032}')
+            session._saved({'index': index}, 60)
+            return session._coalesce({'index': index})
+
+        maxsize, RedisSessionStore._recent_saves_maxsize = RedisSessionStore._recent_saves_maxsize, 2
+        try:
+            with ThreadPoolExecutor(8) as executor:
+                results = list(executor.map(save, range(400)))
+        finally:
+            RedisSessionStore._recent_saves_maxsize = maxsize
+            RedisSessionStore._recent_saves.clear()
+        self.assertEqual(len(results), 400)
+
+
+class SessionSweeperTests(TestCase):
+    def setUp(self):
+        now = timezone.now()
+        for index in range(5):
+            AHSSession.objects.create(
+                session_key=f'expired{index}', session_data='', expire_date=now - timedelta(hours=index + 1))
+        for index in range(2):
+            AHSSession.objects.create(
+                session_key=f'live{index}', session_data='', expire_date=now + timedelta(hours=1))
+
+    def remaining(self):
+        return sorted(AHSSession.objects.values_list('session_key', flat=True))
+
+    def test_sweeps_in_batches(self):
+        stats = SessionSweeper(batch_size=2).tick(math.inf)
+        self.assertEqual((stats.batches, stats.rows_removed, stats.lag, stats.finished), (3, 5, 0.0, True))
+        self.assertEqual(self.remaining(), ['live0', 'live1'])
+
+    def test_stops_when_time_budget_is_spent(self):
+        sweeper = SessionSweeper(batch_size=2)
+        stats = sweeper.tick(0)
+        self.assertEqual((stats.batches, stats.rows_removed, stats.finished), (1, 2, False))
+        # the oldest left over expired 3 hours ago
+        self.assertAlmostEqual(stats.lag, 3 * 3600, delta=60)
+        self.assertIs(sweeper.last_stats, stats)
+        sweeper.tick(math.inf)
+        self.assertEqual(sweeper.total_removed, 5)
+
+    def test_skips_rows_refreshed_mid_batch(self):
+        class RefreshingSweeper(SessionSweeper):
+            def select_batch(self, now, cursor=None):
+                batch = super().select_batch(now, cursor)
+                AHSSession.objects.filter(session_key='expired4').update(expire_date=now + timedelta(hours=1))
+                return batch
+
+        stats = RefreshingSweeper(batch_size=10).tick(math.inf)
+        self.assertEqual(stats.rows_removed, 4)
+        self.assertEqual(self.remaining(), ['expired4', 'live0', 'live1'])
+
+
+class ScrollbackBufferTests(SimpleTestCase):
+    def test_keeps_most_recent_output(self):
+        buffer = ScrollbackBuffer(8)
+        buffer.write(b'abcde')
+        buffer.write(b'fghij')
+        self.assertEqual(buffer.snapshot(), b'cdefghij')
+        self.assertEqual(len(buffer), 8)
+
+    def test_write_larger_than_buffer(self):
+        buffer = ScrollbackBuffer(4)
+        buffer.write(b'ab')
+        buffer.write(b'0123456789')
+        self.assertEqual(buffer.snapshot(), b'6789')
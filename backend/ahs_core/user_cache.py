@@ -0,0 +1,99 @@
+import copy
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Tuple
+
+from django.conf import settings
+from django.contrib.auth.base_user import AbstractBaseUser
+from django.db.models.signals import post_save, post_delete
+
+logger = logging.getLogger(__name__)
+
+
+class UserCache:
+    """
+    Process-local TTL cache of user rows, keyed by the `user_id` of the token payload.
+
+    Entries live for `timeout` seconds, at most `maxsize` of them are kept (LRU).
+    Saving or deleting a user invalidates its entry in the process that saved it,
+    other workers can serve the stale row for at most `timeout` seconds.
+
+    Every lookup returns a copy, so requests can't leak changes of their user into
+    the cache or into each other. Loads racing an invalidation are not stored, see
+    :meth:`set`::
+
+        version = user_cache.version
+        user = user_cache.get(user_id)
+        if user is None:
+            user = User.objects.get(pk=user_id)
+            user_cache.set(user, version)
+    """
+
+    def __init__(self, timeout: float = 60.0, maxsize: int = 4096, model=None):
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.version = 0
+        self._local: "OrderedDict[Any, Tuple[float, AbstractBaseUser]]" = OrderedDict()
+        model = model or settings.AUTH_USER_MODEL
+        post_save.connect(self.invalidate_instance, sender=model, weak=False,
+                          dispatch_uid=f'ahs:user_cache:{id(self)}:save')
+        post_delete.connect(self.invalidate_instance, sender=model, weak=False,
+                            dispatch_uid=f'ahs:user_cache:{id(self)}:delete')
+
+    def __len__(self):
+        return len(self._local)
+
+    @staticmethod
+    def _key(user_id) -> str:
+        return str(user_id)
+
+    def get(self, user_id) -> AbstractBaseUser | None:
+        """Return a copy of the cached user, or None."""
+        if not self.timeout:
+            return None
+        key = self._key(user_id)
+        entry = self._local.get(key)
+        if entry is None:
+            return None
+        expires, user = entry
+        if expires <= time.monotonic():
+            del self._local[key]
+            return None
+        self._local.move_to_end(key)
+        return copy.copy(user)
+
+    def set(self, user: AbstractBaseUser, version: int | None = None):
+        """
+        Cache `user`. `version` is :attr:`version` from before the user was loaded,
+        the user isn't cached if an invalidation happened since.
+        """
+        if not self.timeout or (version is not None and version != self.version):
+            return
+        key = self._key(user.pk)
+        self._local[key] = (time.monotonic() + self.timeout, copy.copy(user))
+        self._local.move_to_end(key)
+        while len(self._local) > self.maxsize:
+            self._local.popitem(last=False)
+
+    def invalidate(self, user_id=None):
+        """Drop the entry of `user_id`, or every entry if `user_id` is None."""
+        self.version += 1
+        if user_id is None:
+            self._local.clear()
+        else:
+            self._local.pop(self._key(user_id), None)
+        logger.debug(f"Invalidated user cache for user {user_id}")
+
+    def invalidate_instance(self, sender, instance, **kwargs):
+        """`post_save` / `post_delete` receiver of the user model."""
+        self.invalidate(instance.pk)
+
+    def __repr__(self):
+        return f"<UserCache timeout={self.timeout} size={len(self._local)}/{self.maxsize}>"
+
+
+user_cache = UserCache(
+    timeout=getattr(settings, 'AHS_USER_CACHE_TIMEOUT', 60),
+    maxsize=getattr(settings, 'AHS_USER_CACHE_MAXSIZE', 4096),
+)
@@ -476,7 +476,7 @@ def get_ahs_session_store():
     """
     Return the AHS session engine.
     """
-    return import_module(settings.SESSION_ENGINE_AHS).AHSToken
+    return import_module(settings.SESSION_ENGINE_AHS).SessionStore
 
 
 def get_ahs_session_model():
@@ -10,7 +10,7 @@ from backend.ahs_core.consumers.cmd_parser import websocket_cmd
 logger = logging.getLogger(__name__)
 User = get_user_model()
 
-@websocket_cmd
+@websocket_cmd(cache=300, depends_on=(Category,), owner_field='owner__user_id')
 async def get_bm_categories(user):
     """
     Fetch all active bookmark categories associated with a specific user.
@@ -40,7 +40,7 @@ async def get_bm_categories(user):
         yield await CategorySerializer(cat).adata
 
 
-@websocket_cmd
+@websocket_cmd(cache=300, depends_on=(Bookmark,), owner_field='owner__user_id')
 async def get_bookmarks(uuid: UUID, user: User, id: int):
     """
     Fetch bookmarks associated with a specific UUID and user.
@@ -9,8 +9,6 @@ from django.core.exceptions import ImproperlyConfigured
 from django.core.management import ManagementUtility
 from dotenv import load_dotenv
 
-from backend.ahs_core.ecc import load_private_key_from_file, derive_from_private_root_key, derive_subkey
-
 load_dotenv()
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -18,6 +16,12 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = environ.get('SECRET_KEY')
 
 RUNTIME_SECRET_KEY = secrets.token_urlsafe(48)
+# Sealed ECC root key, derived on the first start and by `manage.py rotaterootkey` only.
+# Kept out of the source tree (with its .lock and .tmp files), by default in $XDG_STATE_HOME/ahs.
+AHS_ROOT_KEYSTORE_PATH = environ.get(
+    'AHS_ROOT_KEYSTORE_PATH',
+    Path(environ.get('XDG_STATE_HOME') or Path.home() / '.local' / 'state') / 'ahs' / 'root.keystore',
+)
 
 INSTALLED_APPS = [
     # Core Apps
@@ -190,6 +194,103 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Upstream queue bounds per multiplexed websocket stream.
+# policy: block | drop_oldest | coalesce | close
+AHS_MULTIPLEXER_STREAM_QUEUES = {
+    "default": {"maxsize": 64, "policy": "block"},
+    "command": {"maxsize": 64, "policy": "close"},
+    "terminal": {"maxsize": 256, "policy": "coalesce", "max_coalesce_bytes": 64 * 1024},
+}
+# Start stream applications on their first frame and tear them down when idle (seconds, None = never).
+AHS_MULTIPLEXER_LAZY_STREAMS = True
+AHS_MULTIPLEXER_STREAM_IDLE_TIMEOUTS = {
+    "default": 300,
+    "terminal": 1800,
+}
+# Async generator websocket commands send their output in chunks (items, max. seconds per chunk).
+AHS_COMMAND_RESPONSE_CHUNK_SIZE = 50
+AHS_COMMAND_RESPONSE_CHUNK_INTERVAL = 0.05
+# Concurrently running websocket commands per connection, per worker and per user and worker.
+AHS_COMMAND_CONNECTION_CONCURRENCY = 4
+AHS_COMMAND_WORKER_CONCURRENCY = 32
+AHS_COMMAND_USER_CONCURRENCY = 8
+# Running and waiting websocket commands per connection, further requests are refused.
+AHS_COMMAND_CONNECTION_MAX_PENDING = 32
+# Default and maximum deadline of a websocket command request (seconds).
+AHS_COMMAND_TIMEOUT = 30
+AHS_COMMAND_MAX_TIMEOUT = 300
+# Terminal output is coalesced into websocket frames of at most BUFFER_SIZE bytes
+# for at most COALESCE_INTERVAL seconds. Reading the shell's output pauses while more
+# than OUTPUT_HIGH_WATER bytes wait for the websocket, receiving input waits while more
+# than INPUT_HIGH_WATER bytes wait for the shell.
+AHS_TERMINAL_SHELL = ["/bin/zsh"]
+AHS_TERMINAL_OUTPUT_BUFFER_SIZE = 64 * 1024
+AHS_TERMINAL_OUTPUT_COALESCE_INTERVAL = 0.005
+AHS_TERMINAL_OUTPUT_HIGH_WATER = 256 * 1024
+AHS_TERMINAL_INPUT_HIGH_WATER = 64 * 1024
+# Socket of the pre-forked shell pool (`manage.py shellpool`), None forks shells in the worker.
+AHS_TERMINAL_SHELL_POOL_SOCKET = os.environ.get('AHS_SHELL_POOL_SOCKET')
+AHS_TERMINAL_SHELL_POOL = {"size": 4, "max_idle_age": 3600, "max_shells": 64}
+# Terminal sessions survive disconnects for DETACHED_TIMEOUT seconds (0 = hang up right away)
+# and replay up to SCROLLBACK_SIZE bytes of output on reattach (mmap files in SCROLLBACK_DIR if set).
+AHS_TERMINAL_SESSION_DETACHED_TIMEOUT = 3600
+AHS_TERMINAL_SCROLLBACK_SIZE = 1024 * 1024
+AHS_TERMINAL_SCROLLBACK_DIR = None
+# Seconds a terminal's shell gets to exit after SIGHUP before it is killed.
+AHS_TERMINAL_TERMINATE_TIMEOUT = 5
+# Results of websocket commands declared with @websocket_cmd(cache=...): shared cache alias,
+# lifetime (seconds) and size of the per-worker LRU in front of it.
+AHS_COMMAND_CACHE_ALIAS = "default"
+AHS_COMMAND_CACHE_LOCAL_TIMEOUT = 5
+AHS_COMMAND_CACHE_LOCAL_MAXSIZE = 1024
+
+# Per-worker cache of the user rows of token authenticated requests: lifetime (seconds,
+# 0 disables it) and size. Saving or deleting a user invalidates it.
+AHS_USER_CACHE_TIMEOUT = 60
+AHS_USER_CACHE_MAXSIZE = 4096
+
+# Signed X-AHS-Token tokens: "HS256" (HMAC subkey of SECRET_KEY) or "ES512" (ECC root
+# key), lifetime in seconds and size of the per-worker cache of verified tokens.
+AHS_TOKEN_ALGORITHM = "HS256"
+AHS_TOKEN_LIFETIME = 12 * 60 * 60
+AHS_TOKEN_CACHE_SIZE = 4096
+
+# Per-worker cache of ECDH + HKDF session keys of (own key, peer key) pairs used by
+# ecc.encrypt/decrypt: number of pairs and lifetime in seconds.
+AHS_ECDH_KEY_CACHE = {
+    "maxsize": 1024,
+    "ttl": 300,
+}
+
+# State of pending WebAuthn ceremonies: "redis" (GETDEL on the django-redis cache
+# `cache_alias`, needs Redis >= 6.2) or "local" (per process), lifetime in seconds.
+AHS_WEBAUTHN_CHALLENGE_STORE = {
+    "backend": "redis",
+    "cache_alias": "default",
+    "timeout": 120,
+}
+
+# Per-worker cache of (data hash, signature) pairs verified by ECC.verify_many.
+AHS_ECC_SIGNATURE_CACHE_SIZE = 4096
+
+# Per-worker registry of derived ECC subkeys: size and number of root key subkeys
+# (indexes 0..precompute-1) derived in the background when an ASGI worker starts.
+AHS_ECC_SUBKEYS = {
+    "maxsize": 1024,
+    "precompute": 16,
+}
+
+# Executors of the async crypto helpers (ecc, webauthn, ES512 tokens): key derivations
+# ("kdf") and short signs/verifies ("crypto") each run on a "process" or "thread"
+# pool, workers default to min(4, cpu count).
+AHS_CRYPTO_EXECUTOR = {
+    "kdf": "process",
+    "kdf_workers": 2,
+    "crypto": "thread",
+    "crypto_workers": 4,
+    "start_method": "forkserver",
+}
+
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
@@ -233,9 +334,36 @@ MEDIA_URL = '/media/'
 
 SESSION_ENGINE = 'django.contrib.sessions.backends.db'
 SESSION_ENGINE_AHS = 'backend.ahs_core.engines'
+# Redis sessions: SESSION_ENGINE_AHS = 'backend.ahs_core.redis_engine'. Unchanged sessions
+# are rewritten at most every AHS_SESSION_SAVE_COALESCE_INTERVAL seconds per worker, the
+# write-behind mirrors them to AHSSession for auditing.
+AHS_SESSION_CACHE_ALIAS = "default"
+AHS_SESSION_SAVE_COALESCE_INTERVAL = 5
+AHS_SESSION_WRITE_BEHIND = False
+AHS_SESSION_WRITE_BEHIND_INTERVAL = 5
+
+# Batched deletion of expired AHSSession rows: rows per batch, seconds per tick, seconds
+# between ticks and whether ASGI workers run it themselves from the lifespan startup (else:
+# manage.py sweepsessions).
+AHS_SESSION_SWEEPER = {
+    "batch_size": 1000,
+    "time_budget": 0.5,
+    "interval": 60,
+    "in_process": False,
+}
 SESSION_MODEL_AHS = "ahs_core.AHSSession"
 SESSION_TOKEN_EXPIRATION_TIME = 60 * 60 * 24 * 7  # 7 days
 
+# Path prefixes of the AHS middlewares' route classes. Static and health routes skip
+# session, user, token and messages, API routes get no message storage, everything
+# else is an HTML route. A prefix matches whole path segments: "/health" matches "/health"
+# and "/health/db", not "/healthcheck".
+AHS_MIDDLEWARE_ROUTE_CLASSES = {
+    "static": (STATIC_URL, MEDIA_URL, "/favicon.ico"),
+    "health": ("/health",),
+    "api": ("/api/",),
+}
+
 AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',
 ]
@@ -196,7 +196,11 @@ export const useSocket = (
             commandsRef.current[app][cmd] && 
             commandsRef.current[app][cmd][uniqueId]) {
           const { handler, args } = commandsRef.current[app][cmd][uniqueId];
-          handler(data.data, ...args);
+          if (data.chunk) {
+            data.data.forEach((item: any) => handler(item, ...args));
+          } else {
+            handler(data.data, ...args);
+          }
         }
       } else {
         if (onMessage) {